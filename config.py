@@ -5,10 +5,74 @@ class Config:
     def __init__(self):
         self.disambiguator = "BERT"  # "BERT" for the BER disambiguator or "MLE" for MLE disambiguator
         self.base_path = os.getcwd()
-        self.rawdata_path = 'data/primary_data'
+        self.rawdata_path = 'data/primary_data'  # a directory, a zip or tar release, or a folder inside one
         self.author_meta_path = 'json/author_meta'
         self.text_meta_path = 'json/text_meta'
+        self.author_csv_path = 'author_master.csv'  # one row per author, updated from author_meta_path
+        self.text_csv_path = 'text_master.csv'  # one row per text, updated from text_meta_path
+        self.update_metadata_csv = True  # bring both CSVs up to date at the end of a run
         self.text_content_path = 'json/text_content'
         self.use_gpu = True
         self.use_multiprocessing = True  # Set this to False to disable multiprocessing
         self.num_processes = 4  # Set the number of processes to use
+        self.use_analysis_service = True  # analyze small runs through a running analysis service when there is one
+        self.analysis_service_max_bytes = 20 * 1024 * 1024  # raw bytes of pending files above which the pool is used
+        self.analysis_socket_path = 'cache/analysis.sock'  # see pipeline/analysis_service.py
+        self.share_model = True  # load the disambiguator once in the parent, forked workers share it copy-on-write
+        self.torch_threads = None  # torch threads per worker, None divides the cores between the processes
+        self.max_tasks_per_worker = None  # replace a worker after this many files or page ranges, None keeps it
+        self.split_large_files = True  # analyze files above split_threshold in page ranges across all processes
+        self.split_threshold = 30 * 1024 * 1024  # bytes
+        self.split_pages = 200  # pages per range sent to a worker
+        self.split_ranges_in_flight = 16  # ranges submitted before waiting on the oldest one
+        self.file_limit = None  # process at most this many pending files per run, None for all of them
+        self.use_analysis_cache = True  # persist word-level analyses between runs (MLE only, BERT depends on context)
+        self.analysis_cache_path = 'cache/analysis_cache.db'
+        self.analysis_cache_size = 2000000  # number of cached word types kept before least recently used are evicted
+        self.use_batch_scheduler = True  # batch BERT windows across pages instead of one call per page
+        self.bert_batch_size = 64
+        self.bert_window_size = 128  # max words per window sent to BERT
+        self.bert_pages_per_batch = 256  # pages collected before their windows are bucketed and run
+        self.clean_text_engine = "fast"  # "fast" for the single pass extractor, "oimdp" to build oimdp's document
+        self.page_budget = 1800  # size of the pages cut from texts without page markers, in page_budget_unit
+        self.page_budget_unit = "chars"  # "chars" of text without tags, or "tokens" estimated as words
+        self.page_split_paragraphs = False  # also cut paragraphs above the budget at spaces in those texts
+        self.split_oversized_pages = False  # cut printed pages above the budget into sub pages (sub_page 1, 2, ...)
+        self.stream_large_files = True  # clean files above stream_threshold a batch of pages at a time
+        self.stream_threshold = 20 * 1024 * 1024  # bytes
+        self.stream_chunk_size = 1024 * 1024  # characters of raw text read before a batch of pages is cleaned
+        self.max_pages_in_flight = 64  # pages submitted to the analysis threads before waiting on the oldest
+        self.analysis_workers = None  # analysis threads per process, None picks a default for the disambiguator
+        self.write_queue_size = 64  # analyzed pages waiting for the writer thread before analysis is held back
+        self.output_sink = "pages"  # "pages" for one JSON file per page, "ndjson" or "es_bulk" for one file per text,
+        # "es" to index pages directly into Elasticsearch at es_url
+        self.compress_output = False  # gzip the ndjson and es_bulk files
+        self.sink_flush_pages = 256  # pages buffered by the sink between writes
+        self.page_manifests = True  # "pages" sink: only rewrite pages whose content changed, delete stale pages and
+        # list the changes in <text>.changes.json next to the page folder
+        self.token_encoding = "dicts"  # "dicts" for one object per token, "columnar" for parallel arrays per page,
+        # "interned" for columnar with lemma, root and POS ids into token_vocab_path (see pipeline/token_codec.py)
+        # bump pipeline_version when changing it so finished files are written again
+        self.token_vocab_path = 'json/token_vocab.db'
+        self.token_offsets = False  # add "start" and "end" to every token, the span of page_text its word comes from,
+        # so hits can be highlighted without analyzing the page again (bump pipeline_version when changing it)
+        self.corpus_stats_path = 'json/stats'  # per-text lemma/root/POS frequencies and the merged corpus tables,
+        # None disables them (see pipeline/corpus_stats.py)
+        self.es_page_index = 'pages'  # index named in the es_bulk action lines
+        self.es_doc_id = '{text_id}-{volume_num}-{page_num}'  # page document id, filled from the page fields
+        self.es_url = None  # e.g. 'http://localhost:9200', None disables indexing
+        self.es_auth = None  # (user, password) for the cluster
+        self.es_text_index = 'texts'  # text metadata documents, indexed by text_id when es_url is set
+        self.es_author_index = 'authors'  # author metadata documents, indexed by author_id
+        self.es_bulk_docs = 1000  # documents per _bulk request
+        self.es_bulk_bytes = 10 * 1024 * 1024  # max bytes per _bulk request
+        self.es_queue_size = 4  # bulk requests waiting to be sent before the pipeline is held back
+        self.metadata_path = 'master_meta.xlsx'  # OpenITI master metadata sheet
+        self.metadata_index_path = 'cache/metadata_index.pkl'  # compiled from metadata_path, rebuilt when it changes
+        self.pipeline_version = '1'  # bump when a change alters the output, finished files are then processed again
+        self.checkpoint_path = 'cache/checkpoint.db'  # per-file status, content hash and progress for resuming
+        self.checkpoint_every = 500  # pages between progress records of a file being processed
+        self.metrics_path = 'metrics'  # per-file metrics (files.jsonl) and a Prometheus textfile, None disables them
+        self.metrics_every = 10  # files between rewrites of the Prometheus textfile
+        self.profile_files = []  # raw file names (or parts of them) to run with the sampling profiler
+        self.profile_interval = 0.005  # seconds between profiler samples
@@ -1,72 +1,228 @@
 import os
+import gc
+import logging
+import traceback
 import multiprocessing
+import multiprocessing.util
 from config import Config
 from pipeline.text_parser import TextParser
-from camel_tools.disambig.mle import MLEDisambiguator
-from camel_tools.disambig.bert import BERTUnfactoredDisambiguator
+from pipeline.analysis_cache import AnalysisCache, model_version
+from pipeline.batch_scheduler import BatchScheduler
+from pipeline.es_indexer import EsBulkIndexer
+from pipeline.metadata_index import load_metadata_index
+from pipeline.checkpoint import CheckpointStore
+from pipeline.progress import ProgressReporter
+from pipeline.corpus_stats import merge_corpus_stats
+from pipeline.json_meta_csv import consolidate_metadata
+from pipeline.metrics import get_metrics, MetricsAggregator, memory_breakdown
+from pipeline.progress import format_bytes
+from pipeline.analysis_service import AnalysisClient
+from pipeline.input_source import list_raw_files, file_size
 
 config = Config()
 
 
+# intra-op threads per process, so processes x threads does not oversubscribe the cores
+def torch_threads():
+    if config.torch_threads:
+        return config.torch_threads
+    processes = config.num_processes if config.use_multiprocessing else 1
+    return max(1, (os.cpu_count() or 1) // processes)
+
+
+# only the BERT disambiguator runs on torch, MLE runs neither need it nor pay for importing it
+def set_torch_threads(disambiguator_type, threads):
+    if disambiguator_type != "BERT":
+        return
+    import torch
+    torch.set_num_threads(threads)
+
+
+def format_memory(memory):
+    return "; ".join(f"{key} {format_bytes(value)}" for key, value in memory.items())
+
+
 class ParserWorker:
-    def __init__(self, disambiguator_type, use_gpu):
-        if disambiguator_type == "BERT":
-            self.disambiguator = BERTUnfactoredDisambiguator.pretrained(batch_size=64,
-                                                                        cache_size=100000,
-                                                                        pretrained_cache=False,
-                                                                        ranking_cache_size=0)
-        else:
-            self.disambiguator = MLEDisambiguator.pretrained()
-        self.parser_instance = TextParser(self.disambiguator)
+    def __init__(self, disambiguator_type, use_gpu, metadata_index=None, disambiguator=None):
+        # imported only where pages are analyzed here, a run through the analysis service skips camel_tools
+        from pipeline.camel_analyzer import load_disambiguator
+        from pipeline.preprocessor import get_preprocessor
+        # a disambiguator loaded by the parent before forking is used as is
+        if disambiguator is None:
+            disambiguator = load_disambiguator(disambiguator_type, config.bert_batch_size)
+        self.disambiguator = disambiguator
+        get_preprocessor()  # build the preprocessing tables once before the first page
+        self.cache = None
+        if config.use_analysis_cache and disambiguator_type == "MLE":
+            self.cache = AnalysisCache(config.analysis_cache_path, disambiguator_type,
+                                       model_version(self.disambiguator), config.analysis_cache_size)
+        self.scheduler = None
+        if config.use_batch_scheduler and disambiguator_type == "BERT":
+            self.scheduler = BatchScheduler(self.disambiguator, config.bert_batch_size, config.bert_window_size)
+        self.indexer = None
+        if config.es_url:
+            self.indexer = EsBulkIndexer(config.es_url, config.es_bulk_docs, config.es_bulk_bytes,
+                                         config.es_queue_size, auth=config.es_auth)
+        self.checkpoint = CheckpointStore(config.checkpoint_path)
+        self.parser_instance = TextParser(self.disambiguator, self.cache, self.scheduler, self.indexer,
+                                          metadata_index, self.checkpoint)
 
     def get_data(self, raw_file):
         return self.parser_instance.get_data(raw_file, self.parser_instance.disambiguator)
 
 
-def get_processed_files():
-    processed_files = set()
-    if os.path.exists('file_processing.log'):
-        with open('file_processing.log', 'r') as log_file:
-            for line in log_file:
-                if "Processed file" in line:
-                    filename = line.split("Processed file")[1].split(";")[0].strip()
-                    processed_files.add(filename)
-    return processed_files
-
-
-def parse_directory(path, num_files=1000):
+# files not finished yet, or finished with different content, disambiguator or pipeline version
+# path is a directory of raw files or a release archive, see pipeline/input_source.py
+def parse_directory(path, num_files=None):
     print("Collecting filenames to be processed...")
-    processed_files = set(get_processed_files())
-    all_files = os.listdir(path)
-    filtered_files = [file for file in all_files if 'ara' in file and file not in processed_files]
-    sorted_filtered_files = sorted(filtered_files)
-    limited_files = sorted_filtered_files[:num_files]
-    files_to_process = [os.path.join(path, item) for item in limited_files]
+    raw_files = list_raw_files(path)
+    checkpoint = CheckpointStore(config.checkpoint_path)
+    imported = checkpoint.import_log('file_processing.log', raw_files, config.disambiguator, config.pipeline_version,
+                                     config.output_sink)
+    if imported:
+        print(f"Marked {imported} files processed in file_processing.log as done in {config.checkpoint_path}")
+    pending_files = checkpoint.pending(raw_files, config.disambiguator, config.pipeline_version)
+    checkpoint.close()
+    files_to_process = pending_files[:num_files] if num_files else pending_files
     return files_to_process
 
 
-def worker_init(disambiguator_type, use_gpu):
+# longest processing time first: the biggest files start early so the run does not end waiting on one of them
+def schedule_files(files):
+    return sorted(files, key=file_size, reverse=True)
+
+
+def worker_init(disambiguator_type, use_gpu, metadata_index=None, disambiguator=None):
     global worker_instance
-    worker_instance = ParserWorker(disambiguator_type, use_gpu)
+    set_torch_threads(disambiguator_type, torch_threads())
+    before = memory_breakdown()
+    worker_instance = ParserWorker(disambiguator_type, use_gpu, metadata_index, disambiguator)
+    logging.info(f"Worker {os.getpid()} started; before setup {format_memory(before)};"
+                 f" after setup {format_memory(memory_breakdown())}")
+    # pool workers leave through multiprocessing's exit handlers, also when replaced after max_tasks_per_worker
+    multiprocessing.util.Finalize(None, log_worker_exit, exitpriority=10)
+
 
+def log_worker_exit():
+    logging.info(f"Worker {os.getpid()} exiting; {format_memory(memory_breakdown())}")
 
+
+# analyses of one page range of a file split across the pool, with the metrics recorded while analyzing it
+def worker_analyze_range(texts):
+    parser = worker_instance.parser_instance
+    metrics = get_metrics()
+    metrics.collect()
+    results = parser.analyze_texts(texts, parser.disambiguator)
+    if parser.cache is not None:
+        parser.cache.flush()
+    return results, metrics.collect()
+
+
+# the parent cleans, numbers and writes files itself while the analysis happens elsewhere: in the pool for the
+# page ranges of large files (range_analyzer), or in the analysis service (analysis_client)
+def process_in_parent(files, metadata_index, progress, file_sizes, report, **analysis):
+    indexer = None
+    if config.es_url:
+        indexer = EsBulkIndexer(config.es_url, config.es_bulk_docs, config.es_bulk_bytes, config.es_queue_size,
+                                auth=config.es_auth)
+    checkpoint = CheckpointStore(config.checkpoint_path)
+    parser = TextParser(None, indexer=indexer, metadata_index=metadata_index, checkpoint=checkpoint, **analysis)
+    for raw_file in files:
+        error = None
+        try:
+            parser.get_data(raw_file, None)
+        except Exception as e:
+            logging.error(f"Error processing file {raw_file}: {str(e)}, Traceback: {traceback.format_exc()}")
+            error = f"{type(e).__name__}: {e}"
+        progress.update(os.path.basename(raw_file), file_sizes[raw_file], error)
+        report(parser.file_metrics)
+    if indexer is not None:
+        indexer.close()
+    checkpoint.close()
+
+
+# a failing file is logged and reported instead of stopping the whole pool, the checkpoint marks it failed
+# the metrics record of the file goes back to the parent with the result
 def worker_func(raw_file):
-    return worker_instance.get_data(raw_file)
+    error = None
+    try:
+        worker_instance.get_data(raw_file)
+    except Exception as e:
+        logging.error(f"Error processing file {raw_file}: {str(e)}, Traceback: {traceback.format_exc()}")
+        error = f"{type(e).__name__}: {e}"
+    return raw_file, error, worker_instance.parser_instance.file_metrics
 
 
 if __name__ == "__main__":
     base_path = os.getcwd()
-    files_to_process = parse_directory(config.rawdata_path)
+    files_to_process = schedule_files(parse_directory(config.rawdata_path, config.file_limit))
     print("Collecting done.")
+    # compiled or loaded once here, forked workers inherit it instead of each reading the xlsx
+    metadata_index = load_metadata_index(config.metadata_path, config.metadata_index_path)
+
+    file_sizes = {raw_file: file_size(raw_file) for raw_file in files_to_process}
+
+    # a running analysis service already holds the model, then nothing is loaded or forked here. It analyzes one
+    # batch at a time for files processed one after another, so larger runs go to the pool instead
+    client = None
+    if config.use_analysis_service and sum(file_sizes.values()) <= config.analysis_service_max_bytes:
+        client = AnalysisClient.connect(config.analysis_socket_path, config.disambiguator)
+
+    disambiguator = None
+    if client is None and config.use_multiprocessing and config.share_model:
+        # no intra-op thread pool may exist in the parent when it forks, the workers set their own thread count
+        set_torch_threads(config.disambiguator, 1)
+        from pipeline.camel_analyzer import load_disambiguator
+        disambiguator = load_disambiguator(config.disambiguator, config.bert_batch_size)
+        gc.freeze()  # keeps the collector from writing to, and so copying, the pages of objects loaded so far
+        logging.info(f"Parent {os.getpid()} loaded the {config.disambiguator} model;"
+                     f" {format_memory(memory_breakdown())}")
+
+    progress = ProgressReporter(len(files_to_process), sum(file_sizes.values()))
+    aggregator = MetricsAggregator(config.metrics_path) if config.metrics_path else None
+
+    # file records from every worker are appended to one JSON lines file and summed into the Prometheus textfile
+    def report(file_metrics):
+        if aggregator is None or file_metrics is None:
+            return
+        aggregator.add(file_metrics)
+        if progress.done_files % config.metrics_every == 0:
+            aggregator.write_prometheus()
 
-    if config.use_multiprocessing:
-        with multiprocessing.Pool(processes=config.num_processes,
-                                  initializer=worker_init,
-                                  initargs=(config.disambiguator, config.use_gpu)) as pool:
+    if client is not None:
+        print("Processing files through the analysis service...")
+        process_in_parent(files_to_process, metadata_index, progress, file_sizes, report, analysis_client=client)
+        client.close()
+    elif config.use_multiprocessing:
+        # forked workers inherit the initargs instead of unpickling them, so the shared model is not copied
+        context = multiprocessing.get_context("fork") if disambiguator is not None else multiprocessing
+        with context.Pool(processes=config.num_processes,
+                          initializer=worker_init,
+                          initargs=(config.disambiguator, config.use_gpu, metadata_index, disambiguator),
+                          maxtasksperchild=config.max_tasks_per_worker) as pool:
             print(f"Processing files with multiprocessing...")
-            pool.map(worker_func, files_to_process)
+            split_files = []
+            if config.split_large_files:
+                split_files = [raw_file for raw_file in files_to_process
+                               if file_sizes[raw_file] >= config.split_threshold]
+                process_in_parent(split_files, metadata_index, progress, file_sizes, report,
+                                  range_analyzer=lambda texts: pool.apply_async(worker_analyze_range, (texts,)))
+            whole_files = [raw_file for raw_file in files_to_process if raw_file not in split_files]
+            # one file at a time, so an idle worker always takes the largest file left
+            for raw_file, error, file_metrics in pool.imap_unordered(worker_func, whole_files, chunksize=1):
+                progress.update(os.path.basename(raw_file), file_sizes[raw_file], error)
+                report(file_metrics)
     else:
         print("Processing files without multiprocessing...")
-        worker_instance = ParserWorker(config.disambiguator, config.use_gpu)
-        for raw_file in files_to_process:
-            worker_instance.get_data(raw_file)
+        worker_init(config.disambiguator, config.use_gpu, metadata_index)
+        for raw_file, error, file_metrics in map(worker_func, files_to_process):
+            progress.update(os.path.basename(raw_file), file_sizes[raw_file], error)
+            report(file_metrics)
+    if aggregator is not None:
+        aggregator.write_prometheus()
+    if config.corpus_stats_path:
+        # fold the sidecars of the texts processed in this run into the corpus, author and century tables
+        merge_corpus_stats(config.corpus_stats_path)
+    if config.update_metadata_csv:
+        consolidate_metadata(config)
+    print(progress.summary())
@@ -0,0 +1,144 @@
+import os
+import sqlite3
+import threading
+import time
+import logging
+import camel_tools
+from pipeline.metrics import get_metrics
+
+
+# persistent cache of word-level analyses shared by all pool workers and kept between runs
+class AnalysisCache:
+    def __init__(self, path, disambiguator_type, model_version, max_entries=2000000, flush_every=5000):
+        self.path = path
+        self.disambiguator_type = disambiguator_type
+        self.model_version = model_version
+        self.max_entries = max_entries
+        self.flush_every = flush_every
+        self.context_free = disambiguator_type == "MLE"  # MLE analyses do not depend on the sentence
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self._memory = {}  # in-process copy of rows already read or written
+        self._pending = {}  # new rows waiting to be written
+        self._touched = set()  # cached tokens used since the last flush
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS analyses (
+                    disambiguator TEXT NOT NULL,
+                    model_version TEXT NOT NULL,
+                    token TEXT NOT NULL,
+                    lem TEXT NOT NULL,
+                    rt TEXT NOT NULL,
+                    pos TEXT NOT NULL,
+                    last_used INTEGER NOT NULL,
+                    UNIQUE (disambiguator, model_version, token)
+                )""")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS analyses_last_used ON analyses (last_used)")
+
+    # look up a list of tokens and return a dict of token -> (lemma, root, pos) for the ones found
+    def get_many(self, tokens):
+        found = {}
+        with self._lock:
+            unknown = []
+            for token in dict.fromkeys(tokens):
+                if token in self._memory:
+                    found[token] = self._memory[token]
+                else:
+                    unknown.append(token)
+
+            # sqlite limits the number of bound parameters, so query in slices
+            for start in range(0, len(unknown), 500):
+                chunk = unknown[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self.connection.execute(
+                    f"SELECT token, lem, rt, pos FROM analyses"
+                    f" WHERE disambiguator = ? AND model_version = ? AND token IN ({placeholders})",
+                    [self.disambiguator_type, self.model_version, *chunk]).fetchall()
+                for token, lem, rt, pos in rows:
+                    found[token] = self._memory[token] = (lem, rt, pos)
+
+            hits = sum(token in found for token in tokens)
+            self.hits += hits
+            self.misses += len(tokens) - hits
+            self._touched.update(found)
+        metrics = get_metrics()
+        metrics.count("cache_hits", hits)
+        metrics.count("cache_misses", len(tokens) - hits)
+        return found
+
+    def put_many(self, analyses):
+        with self._lock:
+            for token, value in analyses.items():
+                self._memory[token] = value
+                self._pending[token] = value
+            if len(self._pending) + len(self._touched) >= self.flush_every:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not self._pending and not self._touched:
+            return
+        now = int(time.time())
+        key = (self.disambiguator_type, self.model_version)
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO analyses (disambiguator, model_version, token, lem, rt, pos, last_used)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(*key, token, *value, now) for token, value in self._pending.items()])
+            self.connection.executemany(
+                "UPDATE analyses SET last_used = ? WHERE disambiguator = ? AND model_version = ? AND token = ?",
+                [(now, *key, token) for token in self._touched - self._pending.keys()])
+            self._evict()
+        self._pending.clear()
+        self._touched.clear()
+        # the in-process copy is only a read-through layer, keep it from growing without bound
+        if len(self._memory) > self.max_entries:
+            self._memory.clear()
+
+    # drop the least recently used rows once the table grows past max_entries
+    def _evict(self):
+        count = self.connection.execute("SELECT COUNT(*) FROM analyses").fetchone()[0]
+        excess = count - self.max_entries
+        if excess > 0:
+            self.connection.execute(
+                "DELETE FROM analyses WHERE rowid IN"
+                " (SELECT rowid FROM analyses ORDER BY last_used LIMIT ?)", (excess,))
+            self.evicted += excess
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evicted": self.evicted,
+        }
+
+    def log_stats(self, label=""):
+        stats = self.stats()
+        logging.info(f"Analysis cache {label};"
+                     f" {stats['hits']} hits;"
+                     f" {stats['misses']} misses;"
+                     f" {stats['hit_rate']:.2%} hit rate;"
+                     f" {stats['evicted']} evicted")
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+
+# version string stored with each cached row so a model or camel_tools upgrade invalidates old entries
+def model_version(disambiguator):
+    return f"{type(disambiguator).__name__}-{camel_tools.__version__}"
@@ -0,0 +1,209 @@
+import os
+import json
+import time
+import socket
+import signal
+import struct
+import logging
+import argparse
+import threading
+import socketserver
+from pipeline.metrics import get_metrics
+
+# long-running local analysis daemon: keeps a disambiguator (and its word cache or batch scheduler) loaded and
+# analyzes batches of page texts for pipeline runs over a Unix socket, so a small run skips the model load
+#
+# messages in both directions are a 4 byte big-endian length followed by that many bytes of UTF-8 JSON
+#   {"op": "ping"}                 -> {"disambiguator": "MLE", "model_version": "...", "pid": 123}
+#   {"op": "analyze", "texts": []} -> {"results": [analysis of each text], "metrics": {...}}
+#   {"op": "shutdown"}             -> {"ok": true}
+# an analyze request with "offsets": true adds the start and end of each token in its page text
+# a request that fails is answered with {"error": "..."}
+
+HEADER = struct.Struct(">I")
+MAX_MESSAGE = 1 << 30
+
+
+def send_message(sock, message):
+    data = json.dumps(message, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+def _receive_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+# the next message, None when the other side closed the connection
+def receive_message(sock):
+    header = _receive_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+    size, = HEADER.unpack(header)
+    if size > MAX_MESSAGE:
+        raise ValueError(f"message of {size} bytes exceeds the limit")
+    data = _receive_exactly(sock, size)
+    if data is None:
+        raise ConnectionError("connection closed in the middle of a message")
+    return json.loads(data)
+
+
+class _UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class AnalysisService:
+    def __init__(self, socket_path, disambiguator_type, config):
+        # imported here so the client side of this module stays free of camel_tools and torch
+        from pipeline.camel_analyzer import load_disambiguator, analyze_texts
+        from pipeline.analysis_cache import AnalysisCache, model_version
+        from pipeline.batch_scheduler import BatchScheduler
+        from pipeline.preprocessor import get_preprocessor
+
+        self.socket_path = socket_path
+        self.disambiguator_type = disambiguator_type
+        self.analyze_texts = analyze_texts
+        start_time = time.time()
+        self.disambiguator = load_disambiguator(disambiguator_type, config.bert_batch_size)
+        self.model_version = model_version(self.disambiguator)
+        get_preprocessor()
+        self.cache = None
+        if config.use_analysis_cache and disambiguator_type == "MLE":
+            self.cache = AnalysisCache(config.analysis_cache_path, disambiguator_type, self.model_version,
+                                       config.analysis_cache_size)
+        self.scheduler = None
+        if config.use_batch_scheduler and disambiguator_type == "BERT":
+            self.scheduler = BatchScheduler(self.disambiguator, config.bert_batch_size, config.bert_window_size)
+        logging.info(f"Analysis service loaded {disambiguator_type} in {time.time() - start_time:.2f} secs")
+        self._lock = threading.Lock()  # one batch at a time, the scheduler and the disambiguator are not shared
+        self.server = None
+
+    def handle(self, request):
+        op = request.get("op")
+        if op == "ping":
+            return {"disambiguator": self.disambiguator_type, "model_version": self.model_version, "pid": os.getpid()}
+        if op == "analyze":
+            with self._lock:
+                metrics = get_metrics()
+                metrics.collect()
+                results = self.analyze_texts(request["texts"], self.disambiguator, self.cache, self.scheduler,
+                                             request.get("offsets", False))
+                return {"results": results, "metrics": metrics.collect()}
+        if op == "shutdown":
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
+            return {"ok": True}
+        raise ValueError(f"unknown op: {op}")
+
+    def serve_forever(self):
+        service = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                while True:
+                    request = receive_message(self.request)
+                    if request is None:
+                        return
+                    try:
+                        response = service.handle(request)
+                    except Exception as e:
+                        logging.exception(f"Analysis service request failed: {e}")
+                        response = {"error": f"{type(e).__name__}: {e}"}
+                    send_message(self.request, response)
+
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)  # left by a service that did not shut down
+        directory = os.path.dirname(self.socket_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.server = _UnixServer(self.socket_path, Handler)
+        os.chmod(self.socket_path, 0o600)
+        print(f"Analysis service ({self.disambiguator_type}) listening on {self.socket_path}")
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            os.remove(self.socket_path)
+            if self.cache is not None:
+                self.cache.close()
+
+
+# client side, one connection shared by the threads of a TextParser
+class AnalysisClient:
+    def __init__(self, socket_path, timeout=None):
+        self.socket_path = socket_path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(socket_path)
+        self._lock = threading.Lock()
+
+    # a client of the service at socket_path, or None when no service runs there or it has another disambiguator
+    @classmethod
+    def connect(cls, socket_path, disambiguator_type):
+        if not os.path.exists(socket_path):
+            return None
+        try:
+            client = cls(socket_path, timeout=10)  # a stale socket file or a hung service must not stall the run
+            info = client.request({"op": "ping"})
+            client.sock.settimeout(None)  # analyzing a batch takes as long as it takes
+        except (OSError, RuntimeError) as e:
+            logging.warning(f"Analysis service at {socket_path} not reachable: {e}")
+            return None
+        if info["disambiguator"] != disambiguator_type:
+            logging.warning(f"Analysis service at {socket_path} runs {info['disambiguator']},"
+                            f" not {disambiguator_type}")
+            client.close()
+            return None
+        logging.info(f"Using the analysis service at {socket_path} (pid {info['pid']}, {info['model_version']})")
+        return client
+
+    def request(self, message):
+        with self._lock:
+            send_message(self.sock, message)
+            response = receive_message(self.sock)
+        if response is None:
+            raise ConnectionError("analysis service closed the connection")
+        if "error" in response:
+            raise RuntimeError(f"analysis service: {response['error']}")
+        return response
+
+    # analyses in the same form TextParser.analyze_texts returns, the service's stage timings are added to ours
+    def analyze(self, texts, offsets=False):
+        response = self.request({"op": "analyze", "texts": texts, "offsets": offsets})
+        get_metrics().merge(response["metrics"])
+        return response["results"]
+
+    def shutdown(self):
+        return self.request({"op": "shutdown"})
+
+    def close(self):
+        self.sock.close()
+
+
+def main(argv=None):
+    from config import Config
+    config = Config()
+    arg_parser = argparse.ArgumentParser(description="Keep a disambiguator loaded and analyze pages for pipeline runs")
+    arg_parser.add_argument("--disambiguator", choices=["MLE", "BERT"], default=config.disambiguator)
+    arg_parser.add_argument("--socket", default=config.analysis_socket_path)
+    arg_parser.add_argument("--stop", action="store_true", help="shut down the service running at --socket")
+    args = arg_parser.parse_args(argv)
+    logging.basicConfig(filename='analysis_service.log', level=logging.INFO, format='%(asctime)s - %(message)s')
+
+    if args.stop:
+        client = AnalysisClient(args.socket)
+        client.shutdown()
+        client.close()
+        return
+    service = AnalysisService(args.socket, args.disambiguator, config)
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=service.server.shutdown).start())
+    service.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
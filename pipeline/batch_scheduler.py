@@ -0,0 +1,72 @@
+import logging
+import traceback
+from pipeline.metrics import get_metrics
+
+
+# groups page tokens from many pages into length-bucketed windows so the BERT disambiguator runs full batches
+class BatchScheduler:
+    def __init__(self, disambiguator, batch_size=64, window_size=128, batches_per_call=8):
+        self.disambiguator = disambiguator
+        self.batch_size = batch_size
+        self.window_size = window_size  # max words per sequence sent to BERT
+        self.batches_per_call = batches_per_call  # batches handed to disambiguate_sentences at once
+        self.windows_run = 0
+        self.tokens_run = 0
+        self.padded_tokens = 0
+
+    # split each page into bounded windows, keeping (page index, start offset) to scatter results back
+    def _make_windows(self, analyzers):
+        windows = []
+        page_tokens = []
+        for n, analyzer in enumerate(analyzers):
+            try:
+                tokens = analyzer.tokenize()
+            except Exception as e:
+                logging.error(f"Error tokenizing page: {str(e)}, Traceback: {traceback.format_exc()}")
+                analyzer.set_error(e)
+                tokens = None
+            page_tokens.append(tokens)
+            if tokens:
+                for start in range(0, len(tokens), self.window_size):
+                    windows.append((n, start, tokens[start:start + self.window_size]))
+        return windows, page_tokens
+
+    def _run(self, chunk):
+        sentences = [window for _, _, window in chunk]
+        self.windows_run += len(sentences)
+        for start in range(0, len(sentences), self.batch_size):
+            lengths = [len(sentence) for sentence in sentences[start:start + self.batch_size]]
+            self.tokens_run += sum(lengths)
+            self.padded_tokens += max(lengths) * len(lengths)
+        with get_metrics().timer("disambiguate"):
+            return self.disambiguator.disambiguate_sentences(sentences)
+
+    # disambiguate a group of TextAnalyzers created with analyze=False
+    def analyze(self, analyzers):
+        windows, page_tokens = self._make_windows(analyzers)
+        results = [[None] * len(tokens) if tokens else [] for tokens in page_tokens]
+        failed = set()
+
+        # bucket by length so every batch holds sequences of similar size and little padding
+        windows.sort(key=lambda window: len(window[2]))
+        call_size = self.batch_size * self.batches_per_call
+        for start in range(0, len(windows), call_size):
+            chunk = windows[start:start + call_size]
+            try:
+                disambiguated = self._run(chunk)
+            except Exception as e:
+                logging.error(f"Error in batch disambiguation: {str(e)}, Traceback: {traceback.format_exc()}")
+                for n, _, _ in chunk:
+                    if n not in failed:
+                        analyzers[n].set_error(e)
+                        failed.add(n)
+                continue
+            for (n, offset, window), words in zip(chunk, disambiguated):
+                results[n][offset:offset + len(window)] = words
+
+        for n, (analyzer, tokens) in enumerate(zip(analyzers, page_tokens)):
+            if tokens is not None and n not in failed:
+                analyzer.apply_disambiguation(results[n])
+
+    def padding_ratio(self):
+        return self.padded_tokens / self.tokens_run if self.tokens_run else 1.0
@@ -0,0 +1,424 @@
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import time
+from types import SimpleNamespace
+
+from pipeline.preprocessor import Preprocessor
+from pipeline.markdown_cleaner import MAGIC_VALUE
+
+# words used to build synthetic Arabic page text, with diacritics, tatweel and hamza forms the cleaners touch
+SAMPLE_WORDS = [
+    "قال", "حدثنا", "أخبرنا", "عن", "رسول", "الله", "صلى", "عليه", "وسلم", "الصَّلاةُ", "إلى", "على",
+    "كِتَابُ", "الطهارة", "باب", "ما", "جاء", "فِي", "مسألة", "وقد", "ذكر", "آخر", "ٱلْحَمْدُ", "المدينة",
+    "رحمه", "تعالى", "ـــ", "أبو", "بن", "محمد", "الأول", "الثانية", "مكة", "هذه", "فإن", "قيل"
+]
+SAMPLE_NOISE = ["،", ".", ":", "؟", "(", ")", "«", "»", "123", "٣٤", "ms", "Vol", "[22]", "‹", "›"]
+
+
+def synthetic_page_text(rng, words=300):
+    parts = ["<p>"]
+    for i in range(words):
+        parts.append(rng.choice(SAMPLE_NOISE) if rng.random() < 0.08 else rng.choice(SAMPLE_WORDS))
+        if i and i % 60 == 0:
+            parts.append("</p><p>")
+    parts.append("</p>")
+    return " ".join(parts)
+
+
+def synthetic_pages(megabytes, seed=0):
+    rng = random.Random(seed)
+    pages = []
+    size = 0
+    while size < megabytes * 1024 * 1024:
+        page = synthetic_page_text(rng)
+        pages.append(page)
+        size += len(page.encode('utf-8'))
+    return pages
+
+
+# a synthetic OpenITI mARkdown text: metadata header, pages across volumes, ### | and ### || headings,
+# verse, continuation lines, morphological and editorial annotations the cleaners have to remove.
+# with paginated=False no page markers are written, which sends the text through chunk_and_page
+def synthetic_markdown(rng, paragraphs=400, paginated=True, volume_pages=300):
+    lines = ["######OpenITI#", "", "#META# 000.SortField :: synthetic", "#META# 010.AuthorNAME :: مؤلف",
+             "#META# 020.BookTITLE :: كتاب", "#META#Header#End#", ""]
+    volume, page = 1, 1
+    for _ in range(paragraphs):
+        words = [rng.choice(SAMPLE_WORDS) for _ in range(rng.randint(3, 40))]
+        if paginated and rng.random() < 0.3:
+            words.insert(rng.randint(0, len(words)), f"PageV{volume:02d}P{page:03d}")
+            page += 1
+            if page > volume_pages:
+                volume, page = volume + 1, 1
+        if rng.random() < 0.05:
+            words.insert(0, rng.choice(["@QB@", "ms12", "#12#", "CHECK", "¬"]))
+        text = " ".join(words)
+        kind = rng.random()
+        if kind < 0.06:
+            lines.append("### | " + text)
+        elif kind < 0.09:
+            lines.append("### || " + text)
+        elif kind < 0.13:
+            lines.append("# " + text + " %~% " + text)
+        elif kind < 0.18:
+            lines.append("~~" + text)
+        elif kind < 0.19:
+            lines.append("#~:category: " + text)
+        else:
+            lines.append("# " + text)
+    return "\n".join(lines) + "\n"
+
+
+# texts adding up to about megabytes of raw mARkdown, a share of them without page markers
+def synthetic_corpus(megabytes, seed=0, unpaginated=0.2, paragraphs=400):
+    rng = random.Random(seed)
+    texts = []
+    size = 0
+    while size < megabytes * 1024 * 1024:
+        text = synthetic_markdown(rng, paragraphs, paginated=rng.random() >= unpaginated)
+        texts.append(text)
+        size += len(text.encode('utf-8'))
+    return texts
+
+
+# mARkdown tags the clean text extractors treat differently from plain text, including malformed ones
+SAMPLE_ANNOTATIONS = ["Milestone300", "ms12", "msA3", "%~%", "@MATN@", "@HUKM@", "@YD450", "@YB12", "@YA63",
+                      "@PER01", "@PER02", "@P01", "@TOP01", "@T02", "@SRC01", "@SOC01", "@S03",
+                      "@QB@", "PageV02P010", "PageVaP9", "#$#FROM", "#$#TOWA"]
+# malformed tags oimdp raises on, to check that the extractor fails on the same texts
+SAMPLE_FAILING_ANNOTATIONS = ["@S1", "@Pxx", "@ab@c_d@"]
+SAMPLE_LINE_STARTS = ["# ", "~~", "# $RWY$ ", "### | ", "### || ", "### |EDITOR| ", "### $DIC_NIS$ ",
+                      "### $BIO_MAN$ ", "### $ ", "### @ ", "#$#FROM ", "#~:topic: ", "PageV01P005 ", "#", ""]
+
+
+# a synthetic text whose lines mix every line type and phrase level tag oimdp knows, for the differential
+# check of the clean text extractors; a share of failing texts get one malformed tag, the rest parse
+def annotated_markdown(rng, paragraphs=6, failing=0.05):
+    lines = [MAGIC_VALUE, "#META# 000.SortField :: synthetic", "#META#Header#End#"]
+    # replace_chapter_headings ends a heading at the first "P", which would cut the tags holding one in two
+    heading_annotations = [annotation for annotation in SAMPLE_ANNOTATIONS if "P" not in annotation]
+    for _ in range(paragraphs):
+        start = rng.choice(SAMPLE_LINE_STARTS)
+        annotations = heading_annotations if start.startswith("###") else SAMPLE_ANNOTATIONS
+        words = [rng.choice(SAMPLE_WORDS) for _ in range(rng.randint(0, 20))]
+        for _ in range(rng.choice([0, 0, 1, 2, 3])):
+            words.insert(rng.randint(0, len(words)), rng.choice(annotations))
+        lines.append(start + " ".join(words))
+    if rng.random() < failing:
+        line = rng.randrange(3, len(lines))
+        lines[line] += " " + rng.choice(SAMPLE_FAILING_ANNOTATIONS)
+    return "\n".join(lines) + "\n"
+
+
+def read_files(paths):
+    texts = []
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as file:
+            texts.append(file.read())
+    return texts
+
+
+# page texts of real files, cleaned the way TextParser sees them
+def corpus_pages(paths):
+    from pipeline.markdown_cleaner import clean_text
+
+    pages = []
+    for text in read_files(paths):
+        for line in clean_text(text).splitlines():
+            pages.append(line.rsplit("a11b", 2)[0])
+    return pages
+
+
+def _time(func, pages, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for page in pages:
+            func(page)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+# compare the fused preprocessor with the original chain: identical output and seconds per MB
+def bench_preprocess(pages, repeat=3):
+    start = time.perf_counter()
+    preprocessor = Preprocessor()
+    build_seconds = time.perf_counter() - start
+
+    mismatches = sum(1 for page in pages if preprocessor(page) != preprocessor.reference(page))
+    megabytes = sum(len(page.encode('utf-8')) for page in pages) / (1024 * 1024)
+    fused = _time(preprocessor, pages, repeat)
+    reference = _time(preprocessor.reference, pages, repeat)
+    return {
+        "stage": "preprocess",
+        "pages": len(pages),
+        "megabytes": round(megabytes, 3),
+        "build_seconds": round(build_seconds, 3),
+        "reference_sec_per_mb": round(reference / megabytes, 4),
+        "fused_sec_per_mb": round(fused / megabytes, 4),
+        "speedup": round(reference / fused, 2),
+        "mismatched_pages": mismatches,
+    }
+
+
+# golden-output check of the compiled rewrite engines against the original one-pattern-at-a-time loop
+def bench_rewrite(texts):
+    import oimdp
+    from pipeline.markdown_cleaner import reg_replace, replacements, chapter_heading_rules, \
+        chapter_heading_engine, replacement_engine
+
+    mismatches = 0
+    reference_seconds = 0.0
+    engine_seconds = 0.0
+    for text in texts:
+        start = time.perf_counter()
+        reference = reg_replace(text, dict(chapter_heading_rules))
+        reference_seconds += time.perf_counter() - start
+        oi_clean = oimdp.parse(reference).get_clean_text()
+        start = time.perf_counter()
+        reference_clean = reg_replace(oi_clean, replacements)
+        reference_seconds += time.perf_counter() - start
+
+        start = time.perf_counter()
+        converted = chapter_heading_engine(text)
+        engine_seconds += time.perf_counter() - start
+        oi_clean = oimdp.parse(converted).get_clean_text()
+        start = time.perf_counter()
+        clean = replacement_engine(oi_clean)
+        engine_seconds += time.perf_counter() - start
+
+        if converted != reference or clean != reference_clean:
+            mismatches += 1
+    return {
+        "stage": "rewrite",
+        "texts": len(texts),
+        "mismatched_texts": mismatches,
+        "reference_seconds": round(reference_seconds, 4),
+        "engine_seconds": round(engine_seconds, 4),
+        "heading_rules": chapter_heading_engine.report(),
+        "replacement_rules": replacement_engine.report(),
+    }
+
+
+def _outcome(extract, text):
+    try:
+        return extract(text), None
+    except Exception as e:
+        return None, type(e).__name__
+
+
+# differential check of the single pass clean text extractor against oimdp on texts as clean_text hands them
+# over (after replace_chapter_headings): same clean text, or both failing, for every text. matched_texts counts
+# the texts both turned into the same clean text, the only ones whose output was compared
+def bench_clean_text(texts, repeat=3):
+    from pipeline.markdown_cleaner import replace_chapter_headings, extract_clean_text, oimdp_clean_text
+
+    converted = [replace_chapter_headings(text) for text in texts]
+    mismatches = []
+    matched = 0
+    both_failed = 0
+    for number, text in enumerate(converted):
+        reference, reference_error = _outcome(oimdp_clean_text, text)
+        clean, error = _outcome(extract_clean_text, text)
+        if reference_error and error:
+            both_failed += 1
+        elif reference == clean and not reference_error and not error:
+            matched += 1
+        else:
+            first = None
+            if reference is not None and clean is not None:
+                first = next((n for n, (a, b) in enumerate(zip(reference.split("\n"), clean.split("\n"))) if a != b),
+                             min(reference.count("\n"), clean.count("\n")))
+            mismatches.append({"text": number, "oimdp_error": reference_error, "extract_error": error,
+                               "first_differing_line": first})
+
+    def timed(extract):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for text in converted:
+                _outcome(extract, text)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    megabytes = sum(len(text.encode('utf-8')) for text in converted) / (1024 * 1024)
+    oimdp_seconds = timed(oimdp_clean_text)
+    extract_seconds = timed(extract_clean_text)
+    return {
+        "stage": "clean_text",
+        "texts": len(texts),
+        "megabytes": round(megabytes, 3),
+        "matched_texts": matched,
+        "mismatched_texts": len(mismatches),
+        "both_failed": both_failed,
+        "mismatches": mismatches[:20],
+        "oimdp_sec_per_mb": round(oimdp_seconds / megabytes, 4),
+        "extract_sec_per_mb": round(extract_seconds / megabytes, 4),
+        "speedup": round(oimdp_seconds / extract_seconds, 2) if extract_seconds else None,
+    }
+
+
+# stands in for the CAMeL disambiguators so the pipeline can be timed without models
+class StubDisambiguator:
+    def disambiguate(self, words):
+        return [SimpleNamespace(word=word, analyses=[SimpleNamespace(
+            analysis={'lex': word, 'root': word[:3], 'pos': 'noun'})]) for word in words]
+
+    def disambiguate_sentences(self, sentences):
+        return [self.disambiguate(sentence) for sentence in sentences]
+
+
+PIPELINE_STAGES = ["replace_chapter_headings", "clean_text", "replacements", "chunk_and_page", "parse_page",
+                   "preprocess", "tokenize", "disambiguate", "json_pages", "json_ndjson"]
+
+
+# time every stage of cleaning and parsing separately over the same texts, disambiguation uses the stub
+# the clean text stage is reported under the metrics stage name of the engine, "extract" or "oimdp"
+# page_budget (a markdown_cleaner.PageBudget) cuts the texts without page markers, page_tokens shows how even
+# the resulting pages are, offsets adds the token offsets stage of Config.token_offsets
+def bench_pipeline(texts, engine="fast", page_budget=None, offsets=False):
+    from camel_tools.tokenizers.word import simple_word_tokenize
+    from pipeline.markdown_cleaner import replace_chapter_headings, replacement_engine, clean_text_engines, \
+        default_page_budget
+    from pipeline.text_parser import TextParser
+    from pipeline.camel_analyzer import TextAnalyzer
+
+    extract, extract_stage = clean_text_engines[engine]
+    stages = dict.fromkeys([extract_stage if stage == "clean_text" else stage for stage in PIPELINE_STAGES], 0.0)
+    if offsets:
+        stages["offsets"] = 0.0
+
+    def timed(stage, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        stages[stage] += time.perf_counter() - start
+        return result
+
+    disambiguator = StubDisambiguator()
+    parser = TextParser(disambiguator, metadata_index={})
+    pages = 0
+    page_tokens = []
+    page_budget = page_budget or default_page_budget
+    for text in texts:
+        converted = timed("replace_chapter_headings", replace_chapter_headings, text)
+        oi_clean = timed(extract_stage, extract, converted)
+        replaced = timed("replacements", replacement_engine, oi_clean)
+        cleaned = timed("chunk_and_page", page_budget.paginate, replaced)
+
+        parser.last_vol_num = None
+        parser.last_page_num = 0
+        for order, line in enumerate(cleaned.splitlines(), start=1):
+            if order == 1 and line == "a11b00a11b000":
+                continue
+            page_text, vol_num, page_num, chapters = timed("parse_page", parser.parse_page, line)
+            analyzer = TextAnalyzer(page_text, disambiguator, analyze=False)
+            preprocessed = timed("preprocess", analyzer._preprocess, page_text)
+            tokens = timed("tokenize", simple_word_tokenize, preprocessed)
+            result = timed("disambiguate", analyzer._disambiguate, tokens)
+            if offsets:
+                analyzer.spans = timed("offsets", lambda: analyzer._tokenize_with_offsets()[1])
+                result = analyzer._add_offsets(result)
+            page_data = {
+                "text_uri": "synthetic", "text_id": "synthetic", "volume_num": int(vol_num.lstrip('0')),
+                "page_num": int(page_num.lstrip('0')), "page_text": page_text, "chapter_headings": chapters,
+                "order": order, "tokens": result
+            }
+            timed("json_pages", lambda data: json.dumps(data, ensure_ascii=False, indent=4), page_data)
+            timed("json_ndjson", lambda data: json.dumps(data, ensure_ascii=False, separators=(',', ':')),
+                  page_data)
+            pages += 1
+            page_tokens.append(len(result))
+
+    megabytes = sum(len(text.encode('utf-8')) for text in texts) / (1024 * 1024)
+    total = sum(stages.values())
+    tokens_total = sum(page_tokens)
+    page_tokens.sort()
+    return {
+        "stage": "pipeline",
+        "texts": len(texts),
+        "megabytes": round(megabytes, 3),
+        "pages": pages,
+        "tokens": tokens_total,
+        "total_seconds": round(total, 4),
+        "tokens_per_second": round(tokens_total / total, 1) if total else 0.0,
+        "page_tokens": {"min": page_tokens[0], "median": page_tokens[len(page_tokens) // 2],
+                        "p95": page_tokens[int(len(page_tokens) * 0.95)], "max": page_tokens[-1]} if pages else {},
+        "stages": {stage: {"seconds": round(seconds, 4),
+                           "sec_per_mb": round(seconds / megabytes, 4),
+                           "share": round(seconds / total, 4) if total else 0.0}
+                   for stage, seconds in stages.items()},
+    }
+
+
+# where and when a result was measured, so saved results from different commits can be told apart
+def run_info():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {"commit": commit, "python": platform.python_version(), "machine": platform.machine(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+# per-stage time of a result relative to a saved baseline, above 1 is slower
+def compare_stages(result, baseline):
+    return {stage: round(timing["seconds"] / baseline["stages"][stage]["seconds"], 3)
+            for stage, timing in result.get("stages", {}).items()
+            if baseline.get("stages", {}).get(stage, {}).get("seconds")}
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Microbenchmarks for the mutun pipeline")
+    arg_parser.add_argument("stage", choices=["pipeline", "preprocess", "rewrite", "clean_text"])
+    arg_parser.add_argument("files", nargs="*", help="raw OpenITI files to benchmark on (synthetic text if empty)")
+    arg_parser.add_argument("--mb", type=float, default=2, help="size of the synthetic text in MB")
+    arg_parser.add_argument("--repeat", type=int, default=3)
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--unpaginated", type=float, default=0.2,
+                            help="share of synthetic texts without page markers (pipeline stage)")
+    arg_parser.add_argument("--engine", choices=["fast", "oimdp"], default="fast",
+                            help="clean text engine of the pipeline stage")
+    arg_parser.add_argument("--page-budget", type=int, default=1800, help="page size of texts without page markers")
+    arg_parser.add_argument("--page-unit", choices=["chars", "tokens"], default="chars")
+    arg_parser.add_argument("--split-paragraphs", action="store_true", help="cut paragraphs above the page budget")
+    arg_parser.add_argument("--offsets", action="store_true", help="also time the token offsets (pipeline stage)")
+    arg_parser.add_argument("--output", help="write the results as JSON to this file")
+    arg_parser.add_argument("--baseline", help="earlier --output file to compare the stage timings with")
+    args = arg_parser.parse_args()
+
+    if args.stage == "pipeline":
+        texts = read_files(args.files) if args.files else synthetic_corpus(args.mb, args.seed, args.unpaginated)
+        from pipeline.markdown_cleaner import PageBudget
+        result = bench_pipeline(texts, args.engine,
+                                PageBudget(args.page_budget, args.page_unit, args.split_paragraphs), args.offsets)
+    elif args.stage == "preprocess":
+        pages = corpus_pages(args.files) if args.files else synthetic_pages(args.mb)
+        result = bench_preprocess(pages, args.repeat)
+    elif args.stage == "clean_text":
+        rng = random.Random(args.seed)
+        texts = read_files(args.files) if args.files else \
+            synthetic_corpus(args.mb, args.seed, args.unpaginated) + [annotated_markdown(rng) for _ in range(5000)]
+        result = bench_clean_text(texts, args.repeat)
+    else:
+        rng = random.Random(args.seed)
+        texts = read_files(args.files) if args.files else [synthetic_markdown(rng) for _ in range(20)]
+        result = bench_rewrite(texts)
+    result["run"] = run_info()
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as infile:
+            result["relative_to_baseline"] = compare_stages(result, json.load(infile))
+    print(json.dumps(result, indent=4))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as outfile:
+            json.dump(result, outfile, indent=4)
+
+
+if __name__ == "__main__":
+    main()
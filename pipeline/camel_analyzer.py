@@ -1,104 +1,184 @@
-import regex
-import re
 import logging
 from camel_tools.tokenizers.word import simple_word_tokenize
-from camel_tools.utils.normalize import normalize_unicode, normalize_alef_maksura_ar, normalize_alef_ar, \
-    normalize_teh_marbuta_ar
-from camel_tools.utils.charmap import CharMapper
-from camel_tools.utils.charsets import UNICODE_PUNCT_SYMBOL_CHARSET
 from camel_tools.utils.dediac import dediac_ar
 import traceback
+from pipeline.preprocessor import get_preprocessor
+from pipeline.metrics import get_metrics
+
+
+# camel_tools disambiguators are imported only when loaded, the BERT one pulls in torch and transformers
+def load_disambiguator(disambiguator_type, bert_batch_size=64):
+    if disambiguator_type == "BERT":
+        from camel_tools.disambig.bert import BERTUnfactoredDisambiguator
+        return BERTUnfactoredDisambiguator.pretrained(batch_size=bert_batch_size,
+                                                      cache_size=100000,
+                                                      pretrained_cache=False,
+                                                      ranking_cache_size=0)
+    from camel_tools.disambig.mle import MLEDisambiguator
+    return MLEDisambiguator.pretrained()
+
+
+# analyses of a list of page texts: batched through a BatchScheduler (BERT) or page by page, through the
+# word cache when there is one
+def analyze_texts(texts, disambiguator, cache=None, scheduler=None, offsets=False):
+    if scheduler is not None:
+        analyzers = [TextAnalyzer(text, disambiguator, analyze=False, offsets=offsets) for text in texts]
+        scheduler.analyze(analyzers)
+        return [analyzer.get_analysis_result() for analyzer in analyzers]
+    return [TextAnalyzer(text, disambiguator, cache, offsets=offsets).get_analysis_result() for text in texts]
 
 
 class TextAnalyzer:
-    def __init__(self, text, disambiguator):
-        self.arclean = CharMapper.builtin_mapper('arclean')  # create a character mapper for arabic cleaning
+    def __init__(self, text, disambiguator, cache=None, analyze=True, offsets=False):
+        self.preprocessor = get_preprocessor()  # shared per process, built once per worker
         self.disambiguator = disambiguator
+        self.cache = cache  # optional AnalysisCache shared across pages and runs
         self.text = text  # store the input text
-        self.analysis_result = self._analyze()  # analyze the text upon initialization
-
-    # private methods for text preprocessing
-    def _strip_html(self, text):
-        # remove HTML tags from the text using regular expressions
-        html_tags_pattern = re.compile(r'<[^>]+>')
-        stripped_text = html_tags_pattern.sub('', text)
-        return stripped_text
-
-    def _strip_punct(self, text):
-        # remove punctuation symbols from the text
-        stripped_text = ''.join(c for c in text if c not in UNICODE_PUNCT_SYMBOL_CHARSET)
-        return stripped_text
-
-    def _strip_latin(self, text):
-        # remove latin characters from the text using regular expressions
-        stripped_text = regex.sub(r'[\p{Latin}]', '', text)
-        return stripped_text
-
-    def _strip_num(self, text):
-        # remove digits from the text
-        stripped_text = ''.join(c for c in text if not c.isdigit())
-        return stripped_text
+        self.offsets = offsets  # add the start and end in text of the word each token comes from
+        self.spans = None  # (start, end) of every token, set by tokenize when offsets are asked for
+        self.analysis_result = None
+        if analyze:
+            self.analysis_result = self._analyze()  # analyze the text upon initialization
+        # with analyze=False a BatchScheduler calls tokenize() and apply_disambiguation() instead
 
     def _preprocess(self, text):
-        # preprocess the text by applying various cleaning and normalization steps
-        text = self.arclean(text)  # clean Arabic characters
-        text = self._strip_html(text)  # remove HTML tags
-        text = self._strip_punct(text)  # remove punctuation
-        text = self._strip_latin(text)  # remove Latin characters
-        text = self._strip_num(text)  # remove digits
-        text = normalize_unicode(text)  # normalize Unicode characters
-        text = normalize_alef_ar(text)  # normalize Arabic alif characters
-        text = normalize_alef_maksura_ar(text)  # normalize alif maksura characters
-        text = normalize_teh_marbuta_ar(text)  # normalize ta marbuta characters
-        return text
+        # preprocess the text by applying the cleaning and normalization steps fused in Preprocessor
+        with get_metrics().timer("preprocess"):
+            return self.preprocessor(text)
 
-    def _analyze(self):
-        try:
-            preprocessed_text = self._preprocess(self.text)  # preprocess the input text
-            tokens = simple_word_tokenize(preprocessed_text)  # tokenize the preprocessed text
-            disambig = self.disambiguator.disambiguate(tokens)  # disambiguate tokenized words in a batch
+    @staticmethod
+    def _tokenize(text):
+        with get_metrics().timer("tokenize"):
+            return simple_word_tokenize(text)
+
+    # tokens of the page and the span of text of the word each one comes from, a word that NFKC expands into
+    # several tokens gives all of them its span. The tokens are checked against the ones of the whole page
+    # preprocessed at once, the page keeps those and goes without offsets if they differ
+    def _tokenize_with_offsets(self):
+        with get_metrics().timer("offsets"):
+            tokens = []
+            spans = []
+            for word, start, end in self.preprocessor.words(self.text):
+                word_tokens = simple_word_tokenize(word)
+                tokens.extend(word_tokens)
+                spans.extend([(start, end)] * len(word_tokens))
+        expected = self._tokenize(self._preprocess(self.text))
+        if tokens != expected:
+            logging.warning(f"Token offsets differ from the page tokens, no offsets for page: {self.text[:80]}")
+            get_metrics().count("offset_mismatches")
+            return expected, None
+        return tokens, spans
+
+    def _add_offsets(self, output):
+        if self.spans is not None:
+            for token, (start, end) in zip(output, self.spans):
+                token["start"] = start
+                token["end"] = end
+        return output
+
+    # pick lemma, root and part-of-speech out of a disambiguated word
+    def _extract_features(self, d):
+        if not d.analyses:
+            raise ValueError(f"No analyses found for token: {d.word}")
+
+        lemma = next(
+            (dediac_ar(analysis.analysis['lex']) for analysis in d.analyses if 'lex' in analysis.analysis),
+            None)
+        root = next((analysis.analysis['root'] for analysis in d.analyses if 'root' in analysis.analysis),
+                    None)
+        pos = next((analysis.analysis['pos'] for analysis in d.analyses if 'pos' in analysis.analysis),
+                   None)
+
+        if lemma is None or root is None or pos is None:
+            raise ValueError(f"Incomplete analysis for token: {d.word}")
+        return lemma, root, pos
 
-            # prepare the analysis based on certain morphological features
-            output = []
-            for i, d in enumerate(disambig, start=1):
+    def _disambiguate(self, tokens):
+        disambig = self.disambiguator.disambiguate(tokens)  # disambiguate tokenized words in a batch
+        return self._build_output(disambig)
+
+    def _build_output(self, disambig):
+        # prepare the analysis based on certain morphological features
+        output = []
+        for i, d in enumerate(disambig, start=1):
+            try:
+                logging.debug(f"Processing token {i}: {d.word}")
+                lemma, root, pos = self._extract_features(d)
+                analysis_dict = {
+                    "index": i,
+                    "tok": d.word,  # Token
+                    "lem": lemma,  # lemma
+                    "rt": root,  # root
+                    "pos": pos,  # part-of-speech
+                }
+                output.append(analysis_dict)  # add analysis dictionary to the output list
+            except Exception as token_error:
+                logging.error(
+                    f"Error processing token: {d.word}, Error: {str(token_error)}, Traceback: {traceback.format_exc()}")
+                output.append({
+                    "index": i,
+                    "tok": d.word if hasattr(d, 'word') else None,
+                    "error": str(token_error)
+                })
+        return output
+
+    # context-free disambiguation through the cache, only word types not seen before reach the disambiguator
+    def _disambiguate_cached(self, tokens):
+        known = self.cache.get_many(tokens)
+        missing = [token for token in dict.fromkeys(tokens) if token not in known]
+        errors = {}
+        if missing:
+            fresh = {}
+            for d in self.disambiguator.disambiguate(missing):
                 try:
-                    logging.debug(f"Processing token {i}: {d.word}")
-                    if not d.analyses:
-                        raise ValueError(f"No analyses found for token: {d.word}")
-
-                    lemma = next(
-                        (dediac_ar(analysis.analysis['lex']) for analysis in d.analyses if 'lex' in analysis.analysis),
-                        None)
-                    root = next((analysis.analysis['root'] for analysis in d.analyses if 'root' in analysis.analysis),
-                                None)
-                    pos = next((analysis.analysis['pos'] for analysis in d.analyses if 'pos' in analysis.analysis),
-                               None)
-
-                    if lemma is None or root is None or pos is None:
-                        raise ValueError(f"Incomplete analysis for token: {d.word}")
-
-                    analysis_dict = {
-                        "index": i,
-                        "tok": d.word,  # Token
-                        "lem": lemma,  # lemma
-                        "rt": root,  # root
-                        "pos": pos,  # part-of-speech
-                    }
-                    output.append(analysis_dict)  # add analysis dictionary to the output list
+                    fresh[d.word] = self._extract_features(d)
                 except Exception as token_error:
                     logging.error(
                         f"Error processing token: {d.word}, Error: {str(token_error)}, Traceback: {traceback.format_exc()}")
-                    output.append({
-                        "index": i,
-                        "tok": d.word if hasattr(d, 'word') else None,
-                        "error": str(token_error)
-                    })
+                    errors[d.word] = str(token_error)
+            self.cache.put_many(fresh)
+            known.update(fresh)
+
+        output = []
+        for i, token in enumerate(tokens, start=1):
+            if token in known:
+                lemma, root, pos = known[token]
+                output.append({"index": i, "tok": token, "lem": lemma, "rt": root, "pos": pos})
+            else:
+                output.append({"index": i, "tok": token, "error": errors.get(token, "No analysis returned")})
+        return output
+
+    def _analyze(self):
+        try:
+            tokens = self.tokenize()  # preprocess and tokenize the input text
+            with get_metrics().timer("disambiguate"):
+                if self.cache is not None and self.cache.context_free:
+                    output = self._disambiguate_cached(tokens)
+                else:
+                    output = self._disambiguate(tokens)
             logging.debug("Disambiguation completed")
-            return output
+            return self._add_offsets(output)
         except Exception as e:
             logging.error(f"Error in analyzing text: {str(e)}, Traceback: {traceback.format_exc()}")
             logging.debug(f"Preprocessed text: {self.text}")  # log first 100 characters of the input text
             return {"error": str(e)}
 
+    # public entry points for disambiguation done outside the analyzer
+    def tokenize(self):
+        if self.offsets:
+            tokens, self.spans = self._tokenize_with_offsets()
+            return tokens
+        return self._tokenize(self._preprocess(self.text))
+
+    def apply_disambiguation(self, disambig):
+        try:
+            self.analysis_result = self._add_offsets(self._build_output(disambig))
+        except Exception as e:
+            self.set_error(e)
+
+    def set_error(self, error):
+        logging.error(f"Error in analyzing text: {str(error)}")
+        self.analysis_result = {"error": str(error)}
+
     def get_analysis_result(self):
         return self.analysis_result
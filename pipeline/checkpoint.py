@@ -0,0 +1,149 @@
+import os
+import time
+import sqlite3
+import threading
+from pipeline.input_source import file_hash, file_stat, text_name
+
+
+# where a file stopped, used to pick up a partial file after the last page known to be written
+class ResumeState:
+    def __init__(self, pages_seen=0, page_count=1, total_tokens=0):
+        self.pages_seen = pages_seen  # cleaned page lines consumed, including pages that failed analysis
+        self.page_count = page_count
+        self.total_tokens = total_tokens
+
+
+# names of the files logged as processed in file_processing.log, the record of finished files before the store
+def logged_files(log_path):
+    names = set()
+    if os.path.exists(log_path):
+        with open(log_path, encoding="utf-8", errors="replace") as log_file:
+            for line in log_file:
+                if "Processed file" in line:
+                    names.add(line.split("Processed file")[1].split(";")[0].strip())
+    return names
+
+
+# transactional record of every raw file the pipeline has started, shared by all pool workers
+# a file is skipped only when it finished with the same content hash, disambiguator and pipeline version
+class CheckpointStore:
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.row_factory = sqlite3.Row
+        with self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS files (
+                    file_name TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    sha256 TEXT NOT NULL,
+                    disambiguator TEXT NOT NULL,
+                    pipeline_version TEXT NOT NULL,
+                    output_sink TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    pages_seen INTEGER NOT NULL DEFAULT 0,
+                    page_count INTEGER NOT NULL DEFAULT 0,
+                    total_tokens INTEGER NOT NULL DEFAULT 0,
+                    started_at REAL,
+                    finished_at REAL,
+                    seconds REAL,
+                    error TEXT
+                )""")
+
+    # hash of the raw file, read again only when its size or modification time changed
+    def _hash(self, path, stat, row):
+        if row is not None and (row["size"], row["mtime_ns"]) == stat:
+            return row["sha256"]
+        return file_hash(path)
+
+    def _row(self, file_name):
+        return self.connection.execute("SELECT * FROM files WHERE file_name = ?", (file_name,)).fetchone()
+
+    # an empty store is seeded once from the log of earlier versions, so the first run after upgrading does not
+    # process again the files it records; the log does not say how they were processed, they are taken as done with
+    # their current content and the current disambiguator, pipeline version and sink
+    def import_log(self, log_path, paths, disambiguator, pipeline_version, output_sink):
+        with self._lock:
+            if self.connection.execute("SELECT 1 FROM files LIMIT 1").fetchone() is not None:
+                return 0
+        names = logged_files(log_path)
+        rows = []
+        for path in paths:
+            file_name = os.path.basename(path)
+            if file_name in names or text_name(file_name) in names:
+                size, mtime_ns = file_stat(path)
+                rows.append((file_name, size, mtime_ns, file_hash(path), disambiguator, pipeline_version, output_sink,
+                             time.time()))
+        with self._lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO files (file_name, size, mtime_ns, sha256, disambiguator, pipeline_version,"
+                " output_sink, status, finished_at) VALUES (?, ?, ?, ?, ?, ?, ?, 'done', ?)", rows)
+        return len(rows)
+
+    # files still to process: never started, unfinished, or finished with other content or another setup
+    def pending(self, paths, disambiguator, pipeline_version):
+        with self._lock:
+            rows = {row["file_name"]: row for row in self.connection.execute("SELECT * FROM files")}
+
+        pending = []
+        for path in paths:
+            row = rows.get(os.path.basename(path))
+            if row is None or row["status"] != "done" or row["disambiguator"] != disambiguator \
+                    or row["pipeline_version"] != pipeline_version:
+                pending.append(path)
+                continue
+            stat = file_stat(path)
+            if self._hash(path, stat, row) != row["sha256"]:
+                pending.append(path)
+        return pending
+
+    # mark a file as running; returns where to resume when an earlier run of the same content stopped part way
+    # and its pages went to the same resumable sink
+    def begin(self, path, disambiguator, pipeline_version, output_sink, resumable=True):
+        file_name = os.path.basename(path)
+        size, mtime_ns = stat = file_stat(path)
+        with self._lock:
+            row = self._row(file_name)
+            sha256 = self._hash(path, stat, row)
+            resume = ResumeState()
+            if resumable and row is not None and row["status"] != "done" and row["sha256"] == sha256 \
+                    and row["disambiguator"] == disambiguator and row["pipeline_version"] == pipeline_version \
+                    and row["output_sink"] == output_sink:
+                resume = ResumeState(row["pages_seen"], row["page_count"], row["total_tokens"])
+            with self.connection:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO files (file_name, size, mtime_ns, sha256, disambiguator,"
+                    " pipeline_version, output_sink, status, pages_seen, page_count, total_tokens, started_at)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, 'running', ?, ?, ?, ?)",
+                    (file_name, size, mtime_ns, sha256, disambiguator, pipeline_version, output_sink,
+                     resume.pages_seen, resume.page_count, resume.total_tokens, time.time()))
+        return resume
+
+    # called once the pages up to pages_seen are known to be written
+    def progress(self, path, state):
+        with self._lock, self.connection:
+            self.connection.execute(
+                "UPDATE files SET pages_seen = ?, page_count = ?, total_tokens = ? WHERE file_name = ?",
+                (state.pages_seen, state.page_count, state.total_tokens, os.path.basename(path)))
+
+    def finish(self, path, page_count, total_tokens, seconds):
+        with self._lock, self.connection:
+            self.connection.execute(
+                "UPDATE files SET status = 'done', page_count = ?, total_tokens = ?, finished_at = ?, seconds = ?,"
+                " error = NULL WHERE file_name = ?",
+                (page_count, total_tokens, time.time(), seconds, os.path.basename(path)))
+
+    def fail(self, path, error):
+        with self._lock, self.connection:
+            self.connection.execute(
+                "UPDATE files SET status = 'failed', finished_at = ?, error = ? WHERE file_name = ?",
+                (time.time(), str(error), os.path.basename(path)))
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,252 @@
+import os
+import json
+import sqlite3
+import hashlib
+import argparse
+import logging
+from collections import Counter
+
+# lemma, root and part-of-speech frequencies kept while the pages of a text stream through the parser
+#
+# every text gets a sidecar <stats_path>/texts/<text_id>.json; merge_corpus_stats folds the sidecars into
+# corpus, author and century tables in <stats_path>/corpus_stats.db. The database keeps the sidecar each text
+# was merged with, so a text processed again is merged by taking its old counts out and adding the new ones
+
+FIELDS = ("lem", "rt", "pos")
+DB_NAME = "corpus_stats.db"
+
+
+# hijri century of an author's death year, "" when the year is unknown
+def death_century(au_death):
+    try:
+        year = int(au_death)
+    except (TypeError, ValueError):
+        return ""
+    return str((year - 1) // 100 + 1) if year > 0 else ""
+
+
+class TextStats:
+    def __init__(self, counts=None, pages=0, tokens=0, pages_seen=0, complete=True):
+        self.counts = {field: Counter((counts or {}).get(field, {})) for field in FIELDS}
+        self.pages = pages
+        self.tokens = tokens
+        self.pages_seen = pages_seen  # page lines consumed when this state was taken, used on resume
+        self.complete = complete  # False when a resumed text had no partial counts to carry on from
+
+    # tokens in the analyzer's dict form, tokens that failed analysis are not counted
+    def add(self, tokens):
+        analyzed = [token for token in tokens if "error" not in token]
+        for field in FIELDS:
+            self.counts[field].update(token[field] for token in analyzed)
+        self.pages += 1
+        self.tokens += len(analyzed)
+
+    # a copy for the writer thread, taken when pages_seen page lines have been consumed
+    def snapshot(self, pages_seen):
+        return TextStats(self.counts, self.pages, self.tokens, pages_seen, self.complete)
+
+    def to_dict(self, text_meta, author_meta):
+        return {"text_id": text_meta["text_id"], "author_id": author_meta["author_id"],
+                "century": death_century(author_meta["au_death"]), "pages": self.pages, "tokens": self.tokens,
+                "pages_seen": self.pages_seen, "complete": self.complete,
+                **{field: dict(self.counts[field]) for field in FIELDS}}
+
+
+def sidecar_path(stats_path, text_id, partial=False):
+    return os.path.join(stats_path, "texts", f"{text_id}{'.part' if partial else ''}.json")
+
+
+def save_sidecar(stats_path, data, partial=False):
+    path = sidecar_path(stats_path, data["text_id"], partial)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", 'w', encoding='utf-8') as outfile:
+        json.dump(data, outfile, ensure_ascii=False, separators=(',', ':'))
+    os.replace(path + ".tmp", path)
+
+
+# the partial counts of an interrupted text, when they were taken at the page the checkpoint resumes from
+def load_partial(stats_path, text_id, pages_seen):
+    path = sidecar_path(stats_path, text_id, partial=True)
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as file:
+            data = json.load(file)
+        if data["pages_seen"] == pages_seen:
+            return TextStats({field: data[field] for field in FIELDS}, data["pages"], data["tokens"],
+                             data["pages_seen"], data["complete"])
+    logging.warning(f"No partial corpus statistics for {text_id} at page {pages_seen}, counting from there")
+    return TextStats(pages_seen=pages_seen, complete=False)
+
+
+def remove_partial(stats_path, text_id):
+    path = sidecar_path(stats_path, text_id, partial=True)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+class CorpusStats:
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS counts (
+                    level TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    field TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    count INTEGER NOT NULL,
+                    PRIMARY KEY (level, key, field, value)
+                ) WITHOUT ROWID""")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS totals (
+                    level TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    texts INTEGER NOT NULL,
+                    pages INTEGER NOT NULL,
+                    tokens INTEGER NOT NULL,
+                    PRIMARY KEY (level, key)
+                )""")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS applied (
+                    text_id TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    sha256 TEXT NOT NULL,
+                    sidecar TEXT NOT NULL
+                )""")
+
+    @staticmethod
+    def _groups(data):
+        return [("corpus", ""), ("author", data["author_id"]), ("century", data["century"])]
+
+    # add (sign 1) or take out (sign -1) one sidecar from the deltas of every group it belongs to
+    def _collect(self, deltas, totals, data, sign):
+        for group in self._groups(data):
+            counts = deltas.setdefault(group, {field: Counter() for field in FIELDS})
+            for field in FIELDS:
+                if sign > 0:
+                    counts[field].update(data[field])
+                else:
+                    counts[field].subtract(data[field])
+            total = totals.setdefault(group, [0, 0, 0])
+            for n, value in enumerate((1, data["pages"], data["tokens"])):
+                total[n] += sign * value
+
+    def _apply(self, deltas, totals):
+        for (level, key), counts in deltas.items():
+            for field in FIELDS:
+                changed = [(level, key, field, value, count) for value, count in counts[field].items() if count]
+                self.connection.executemany(
+                    "INSERT INTO counts (level, key, field, value, count) VALUES (?, ?, ?, ?, ?)"
+                    " ON CONFLICT (level, key, field, value) DO UPDATE SET count = count + excluded.count",
+                    changed)
+                self.connection.executemany(
+                    "DELETE FROM counts WHERE level = ? AND key = ? AND field = ? AND value = ? AND count <= 0",
+                    [row[:4] for row in changed if row[4] < 0])
+        for (level, key), (texts, pages, tokens) in totals.items():
+            self.connection.execute(
+                "INSERT INTO totals (level, key, texts, pages, tokens) VALUES (?, ?, ?, ?, ?)"
+                " ON CONFLICT (level, key) DO UPDATE SET texts = texts + excluded.texts,"
+                " pages = pages + excluded.pages, tokens = tokens + excluded.tokens",
+                (level, key, texts, pages, tokens))
+        self.connection.execute("DELETE FROM totals WHERE texts <= 0")
+
+    # fold new and changed sidecars in and take out texts whose sidecar was removed, in one transaction
+    # a sidecar is only read when its size or modification time differs from the one merged
+    def merge(self, stats_path):
+        texts_path = os.path.join(stats_path, "texts")
+        sidecars = {}
+        if os.path.isdir(texts_path):
+            for name in os.listdir(texts_path):
+                if name.endswith(".json") and not name.endswith(".part.json"):
+                    sidecars[name[:-len(".json")]] = os.path.join(texts_path, name)
+        applied = {text_id: (size, mtime_ns, sha256) for text_id, size, mtime_ns, sha256
+                   in self.connection.execute("SELECT text_id, size, mtime_ns, sha256 FROM applied")}
+
+        deltas = {}
+        totals = {}
+        changes = {"added": 0, "updated": 0, "removed": 0}
+        with self.connection:
+            for text_id, path in sorted(sidecars.items()):
+                stat = os.stat(path)
+                if text_id in applied and applied[text_id][:2] == (stat.st_size, stat.st_mtime_ns):
+                    continue
+                with open(path, 'rb') as file:
+                    raw = file.read()
+                sha256 = hashlib.sha256(raw).hexdigest()
+                if text_id in applied and applied[text_id][2] == sha256:
+                    self.connection.execute("UPDATE applied SET size = ?, mtime_ns = ? WHERE text_id = ?",
+                                            (stat.st_size, stat.st_mtime_ns, text_id))
+                    continue
+                if text_id in applied:
+                    self._collect(deltas, totals, self._applied_sidecar(text_id), -1)
+                    changes["updated"] += 1
+                else:
+                    changes["added"] += 1
+                self._collect(deltas, totals, json.loads(raw), 1)
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO applied (text_id, size, mtime_ns, sha256, sidecar) VALUES (?, ?, ?, ?, ?)",
+                    (text_id, stat.st_size, stat.st_mtime_ns, sha256, raw.decode('utf-8')))
+            for text_id in applied.keys() - sidecars.keys():
+                self._collect(deltas, totals, self._applied_sidecar(text_id), -1)
+                self.connection.execute("DELETE FROM applied WHERE text_id = ?", (text_id,))
+                changes["removed"] += 1
+            self._apply(deltas, totals)
+        logging.info(f"Corpus statistics merged; {changes['added']} added; {changes['updated']} updated;"
+                     f" {changes['removed']} removed")
+        return changes
+
+    def _applied_sidecar(self, text_id):
+        row = self.connection.execute("SELECT sidecar FROM applied WHERE text_id = ?", (text_id,)).fetchone()
+        return json.loads(row[0])
+
+    # the most frequent values of a field for the corpus ("corpus", ""), an author or a century
+    def top(self, level, key, field, limit=100):
+        return self.connection.execute(
+            "SELECT value, count FROM counts WHERE level = ? AND key = ? AND field = ?"
+            " ORDER BY count DESC, value LIMIT ?", (level, key, field, limit)).fetchall()
+
+    def totals(self, level, key):
+        row = self.connection.execute("SELECT texts, pages, tokens FROM totals WHERE level = ? AND key = ?",
+                                      (level, key)).fetchone()
+        return dict(zip(("texts", "pages", "tokens"), row)) if row else None
+
+    def close(self):
+        self.connection.close()
+
+
+def merge_corpus_stats(stats_path):
+    corpus_stats = CorpusStats(os.path.join(stats_path, DB_NAME))
+    try:
+        return corpus_stats.merge(stats_path)
+    finally:
+        corpus_stats.close()
+
+
+def main(argv=None):
+    from config import Config
+    config = Config()
+    arg_parser = argparse.ArgumentParser(description="Merge per-text corpus statistics and show frequencies")
+    arg_parser.add_argument("command", choices=["merge", "top"])
+    arg_parser.add_argument("--stats-path", default=config.corpus_stats_path)
+    arg_parser.add_argument("--level", choices=["corpus", "author", "century"], default="corpus")
+    arg_parser.add_argument("--key", default="", help="author_id or century for --level author/century")
+    arg_parser.add_argument("--field", choices=FIELDS, default="lem")
+    arg_parser.add_argument("-n", type=int, default=50)
+    args = arg_parser.parse_args(argv)
+
+    if args.command == "merge":
+        print(merge_corpus_stats(args.stats_path))
+        return
+    corpus_stats = CorpusStats(os.path.join(args.stats_path, DB_NAME))
+    print(json.dumps(corpus_stats.totals(args.level, args.key), ensure_ascii=False))
+    for value, count in corpus_stats.top(args.level, args.key, args.field, args.n):
+        print(f"{count}\t{value}")
+    corpus_stats.close()
+
+
+if __name__ == "__main__":
+    main()
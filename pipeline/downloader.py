@@ -1,42 +1,203 @@
 import os
+import json
+import time
 import logging
+import threading
 import requests
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
 
 # set up logging
 logging.basicConfig(filename='download_logs.log', level=logging.INFO, format='%(asctime)s - %(message)s')
 
+CACHE_FILE = '.download_cache.json'  # ETag, Last-Modified and size of every file downloaded, per destination
+_local = threading.local()
+
+
+# one keep-alive session per download thread
+def get_session():
+    if not hasattr(_local, 'session'):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=1)  # a thread holds one connection per host
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _local.session = session
+    return _local.session
+
+
+def read_json(path):
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as file:
+            return json.load(file)
+    return {}
+
+
+# for servers that ignore conditional requests: same validators, or no validators and the same size
+def unchanged(response, filename, cached):
+    if not os.path.exists(filename) or os.path.getsize(filename) != cached.get('size'):
+        return False
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    if etag or last_modified:
+        return etag == cached.get('etag') and last_modified == cached.get('last_modified')
+    length = response.headers.get('Content-Length')
+    return length is not None and int(length) == cached.get('size')
+
+
+def remove_part(part_name):
+    for name in (part_name, part_name + '.json'):
+        if os.path.exists(name):
+            os.remove(name)
+
 
 # function to download file
-def download_file(url, destination_folder):
-    try:
-        response = requests.get(url)
-        if response.status_code == 200:
-            filename = os.path.join(destination_folder, os.path.basename(url))
-            with open(filename, 'wb') as file:
-                file.write(response.content)
+# the body is streamed into <name>.part and renamed when complete. A file already downloaded is requested
+# with its cached ETag/Last-Modified and skipped on 304. A .part left by an earlier run is resumed with a
+# Range request guarded by If-Range, using the validators saved next to it in <name>.part.json, so a file
+# that changed on the server in the meantime is fetched again instead of being spliced. The body is asked for
+# without content coding, so the .part holds the bytes Range offsets and Content-Range count
+def download_file(url, destination_folder, cached=None, retries=3, chunk_size=64 * 1024, timeout=60):
+    filename = os.path.join(destination_folder, os.path.basename(url))
+    part_name = filename + '.part'
+    part_meta_name = part_name + '.json'
+    cached = cached or {}
+    result = {'url': url, 'status': 'failed', 'bytes': 0}
+
+    for attempt in range(retries + 1):
+        headers = {'Accept-Encoding': 'identity'}
+        part_meta = read_json(part_meta_name) if os.path.exists(part_name) else {}
+        resume_validator = part_meta.get('etag') or part_meta.get('last_modified')
+        if resume_validator and os.path.getsize(part_name):
+            headers['Range'] = f'bytes={os.path.getsize(part_name)}-'
+            headers['If-Range'] = resume_validator
+        elif os.path.exists(filename):
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+
+        try:
+            with get_session().get(url, headers=headers, stream=True, timeout=timeout) as response:
+                if response.status_code == 304:
+                    response.content  # read the empty body so the connection goes back to the pool
+                    result.update(status='skipped', **cached)
+                    return result
+                if response.status_code == 416:
+                    # the .part already holds as many bytes as the file has, or more, so it is fetched again
+                    response.content
+                    remove_part(part_name)
+                    raise IOError("requested range not satisfiable, the partial download was removed")
+                if response.status_code >= 500 and attempt < retries:
+                    raise requests.HTTPError(f"server error {response.status_code}")
+                if response.status_code not in (200, 206):
+                    response.content
+                    logging.error(f"Failed to download: {url} ({response.status_code})")
+                    result['error'] = f"HTTP {response.status_code}"
+                    return result
+
+                resumed = response.status_code == 206
+                if resumed:
+                    validators = part_meta
+                    expected = int(response.headers['Content-Range'].rsplit('/', 1)[1])
+                else:
+                    validators = {'etag': response.headers.get('ETag'),
+                                  'last_modified': response.headers.get('Last-Modified')}
+                    if unchanged(response, filename, cached):
+                        result.update(status='skipped', **cached)
+                        return result
+                    length = response.headers.get('Content-Length')
+                    expected = int(length) if length is not None else None
+                    part_meta = validators
+                    if response.headers.get('Content-Encoding', 'identity') != 'identity':
+                        # a server coding the body anyway: Content-Length counts the coded bytes and the .part
+                        # holds the decoded ones, so it can be neither checked nor resumed
+                        expected = None
+                        part_meta = {}
+                    with open(part_meta_name, 'w', encoding='utf-8') as file:
+                        json.dump(part_meta, file)
+
+                with open(part_name, 'ab' if resumed else 'wb') as file:
+                    for chunk in response.iter_content(chunk_size):
+                        file.write(chunk)
+                        result['bytes'] += len(chunk)
+
+            size = os.path.getsize(part_name)
+            if expected is not None and size != expected:
+                if size > expected:
+                    remove_part(part_name)  # a Range request would only ask for bytes past the end
+                raise IOError(f"incomplete download: {size} of {expected} bytes")
+            os.replace(part_name, filename)
+            os.remove(part_meta_name)
+            result.update(status='resumed' if resumed else 'downloaded', size=size,
+                          etag=validators.get('etag'), last_modified=validators.get('last_modified'))
             logging.info(f"Downloaded: {url}")
-            return True
-        else:
-            logging.error(f"Failed to download: {url}")
-            return False
-    except Exception as e:
-        logging.exception(f"Exception occurred while downloading {url}: {e}")
-        return False
+            return result
+        except Exception as e:
+            result['error'] = str(e)
+            if attempt < retries:
+                logging.warning(f"Retrying {url} after error: {e}")
+                time.sleep(2 ** attempt)
+            else:
+                logging.exception(f"Exception occurred while downloading {url}: {e}")
+    return result
+
+
+def load_cache(destination_folder):
+    return read_json(os.path.join(destination_folder, CACHE_FILE))
+
+
+def save_cache(cache, destination_folder):
+    cache_path = os.path.join(destination_folder, CACHE_FILE)
+    with open(cache_path + '.part', 'w', encoding='utf-8') as file:
+        json.dump(cache, file, ensure_ascii=False, indent=1)
+    os.replace(cache_path + '.part', cache_path)
+
+
+def read_manifest(manifest_file):
+    # read manifest file, use header=None to avoid treating the first row as column names
+    df = pd.read_excel(manifest_file, header=None, usecols=[8])
+    return [row[8] for _, row in df.iterrows() if pd.notna(row[8])]  # column 9 (index 8) holds the file URL
+
+
+# download every URL with max_workers threads and write a summary of the run next to the files
+def download_all(urls, destination_folder, max_workers=8, save_every=50):
+    os.makedirs(destination_folder, exist_ok=True)
+    cache = load_cache(destination_folder)
+    start_time = time.time()
+    counts = {'downloaded': 0, 'resumed': 0, 'skipped': 0, 'failed': 0}
+    failures = []
+    total_bytes = 0
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(download_file, url, destination_folder, cache.get(url)) for url in urls]
+        for done, future in enumerate(as_completed(futures), start=1):
+            result = future.result()
+            counts[result['status']] += 1
+            total_bytes += result['bytes']
+            if result['status'] == 'failed':
+                failures.append({'url': result['url'], 'error': result.get('error')})
+            elif result['status'] != 'skipped':
+                cache[result['url']] = {key: result[key] for key in ('etag', 'last_modified', 'size')}
+            if done % save_every == 0:
+                save_cache(cache, destination_folder)
+    save_cache(cache, destination_folder)
+
+    summary = dict(counts, urls=len(urls), bytes=total_bytes, seconds=round(time.time() - start_time, 2),
+                   failures=failures)
+    summary_name = time.strftime('download_summary_%Y%m%d_%H%M%S.json')
+    with open(os.path.join(destination_folder, summary_name), 'w', encoding='utf-8') as file:
+        json.dump(summary, file, ensure_ascii=False, indent=4)
+    logging.info(f"Download run: {counts['downloaded']} downloaded; {counts['resumed']} resumed;"
+                 f" {counts['skipped']} unchanged; {counts['failed']} failed; {total_bytes} bytes;"
+                 f" {summary['seconds']} secs")
+    return summary
 
 
 # function to start downloading
-def start_downloading(manifest_file, destination_folder):
+def start_downloading(manifest_file, destination_folder, max_workers=8):
     try:
-        # read manifest file
-        df = pd.read_excel(manifest_file, header=None,
-                           usecols=[8])  # use header=None to avoid treating the first row as column names
-
-        # iterate through each row in the manifest file
-        for index, row in df.iterrows():
-            file_url = row[8]  # access column 9 (index 8) for file URL
-            if pd.notna(file_url):  # check if the URL is not NaN
-                download_file(file_url, destination_folder)
+        return download_all(read_manifest(manifest_file), destination_folder, max_workers)
     except Exception as e:
         logging.exception(f"Exception occurred while processing manifest file: {e}")
 
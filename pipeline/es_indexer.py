@@ -0,0 +1,155 @@
+import json
+import time
+import queue
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+_DONE = object()
+
+
+# streams documents into Elasticsearch _bulk requests from a background thread over one pooled session
+# a batch is sent once it holds max_docs documents or max_bytes of NDJSON. Batches wait in a bounded queue,
+# so when the cluster is slow or answers 429 add() blocks and the analysis feeding it is held back
+# an error that stops a batch is raised by the next add() or flush() and then cleared: the batches queued after
+# it are dropped, so the indexer shared by the texts of a worker only fails the text that was being indexed
+class EsBulkIndexer:
+    def __init__(self, url, max_docs=1000, max_bytes=10 * 1024 * 1024, queue_size=4, max_retries=6,
+                 backoff=1.0, timeout=120, auth=None, max_logged_failures=100):
+        self.bulk_url = url.rstrip('/') + '/_bulk'
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.max_retries = max_retries
+        self.backoff = backoff  # seconds before the first retry, doubled on every further retry
+        self.timeout = timeout
+        self.max_logged_failures = max_logged_failures
+
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        self.session.headers['Content-Type'] = 'application/x-ndjson'
+        if auth:
+            self.session.auth = tuple(auth)
+
+        self.batch = []  # (action line, document line) pairs not yet queued
+        self.batch_bytes = 0
+        self.indexed = 0
+        self.failed = 0
+        self.retried = 0
+        self.requests = 0
+        self.failures = []  # (document id, error) of the first max_logged_failures failed documents
+        self.error = None
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self._run, name="es-indexer", daemon=True)
+        self.thread.start()
+
+    def add(self, index, doc_id, document):
+        if self.error is not None:
+            self.flush()
+        action = json.dumps({"index": {"_index": index, "_id": doc_id}}, ensure_ascii=False)
+        source = json.dumps(document, ensure_ascii=False, separators=(',', ':'))
+        self.batch.append((action, source))
+        self.batch_bytes += len(action.encode('utf-8')) + len(source.encode('utf-8')) + 2
+        if len(self.batch) >= self.max_docs or self.batch_bytes >= self.max_bytes:
+            self._submit()
+
+    def _submit(self):
+        if self.batch:
+            self.queue.put(self.batch)  # blocks while queue_size batches are already waiting
+            self.batch = []
+            self.batch_bytes = 0
+
+    # send what is buffered and wait until every queued batch has been answered
+    def flush(self):
+        self._submit()
+        self.queue.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _run(self):
+        while True:
+            batch = self.queue.get()
+            try:
+                if batch is _DONE:
+                    return
+                if self.error is None:
+                    self._send(batch)
+            except Exception as e:
+                logging.error(f"Elasticsearch bulk indexing stopped: {str(e)}")
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _wait(self, attempt, response=None):
+        delay = self.backoff * 2 ** attempt
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, int(retry_after))
+        self.retried += 1
+        time.sleep(delay)
+
+    # post a batch, retrying the whole request on connection errors, timeouts, 429 and 5xx answers, and then only
+    # the documents rejected with 429
+    def _send(self, batch):
+        attempt = 0
+        while batch:
+            body = "".join(f"{action}\n{source}\n" for action, source in batch).encode('utf-8')
+            try:
+                response = self.session.post(self.bulk_url, data=body, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.max_retries:
+                    raise
+                logging.warning(f"Elasticsearch bulk request failed, retrying: {str(e)}")
+                self._wait(attempt)
+                attempt += 1
+                continue
+            self.requests += 1
+            if (response.status_code == 429 or response.status_code >= 500) and attempt < self.max_retries:
+                self._wait(attempt, response)
+                attempt += 1
+                continue
+            response.raise_for_status()
+
+            result = response.json()
+            if not result.get("errors"):
+                self.indexed += len(batch)
+                return
+
+            rejected = []
+            for pair, item in zip(batch, result["items"]):
+                outcome = next(iter(item.values()))
+                status = outcome.get("status", 500)
+                if status < 300:
+                    self.indexed += 1
+                elif status == 429 and attempt < self.max_retries:
+                    rejected.append(pair)
+                else:
+                    self._record_failure(outcome.get("_id"), outcome.get("error", status))
+            batch = rejected
+            if batch:
+                self._wait(attempt)
+                attempt += 1
+
+    def _record_failure(self, doc_id, error):
+        self.failed += 1
+        if len(self.failures) < self.max_logged_failures:
+            self.failures.append((doc_id, error))
+            logging.error(f"Elasticsearch rejected document {doc_id}: {error}")
+
+    def stats(self):
+        return {
+            "indexed": self.indexed,
+            "failed": self.failed,
+            "retried": self.retried,
+            "requests": self.requests,
+        }
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.queue.put(_DONE)
+            self.thread.join()
+            self.session.close()
@@ -0,0 +1,205 @@
+import io
+import os
+import re
+import bz2
+import gzip
+import lzma
+import time
+import atexit
+import shutil
+import tarfile
+import tempfile
+import zipfile
+import hashlib
+import threading
+import contextlib
+
+# where raw OpenITI files are read from: Config.rawdata_path is a directory of raw files, a release archive
+# (.zip or .tar, optionally compressed), or a folder inside an archive such as "releases/2023.1.8.zip/data"
+#
+# a raw file is referred to by a path string everywhere in the pipeline. Files of an archive are referred to
+# as <archive path>/<member name>, so os.path.basename still gives the OpenITI file name the checkpoint,
+# metadata and output names are keyed on. Archives are indexed once per process; pool workers forked after
+# the listing inherit the index and only open their own handle on the archive
+
+ARCHIVE_EXTENSIONS = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+# stream openers of the compressed tar extensions
+TAR_DECOMPRESSORS = {".tar.gz": gzip.open, ".tgz": gzip.open, ".tar.bz2": bz2.open, ".tbz2": bz2.open,
+                     ".tar.xz": lzma.open, ".txz": lzma.open}
+# extensions OpenITI gives text files after the -ara<n> of their name, by annotation status
+TEXT_EXTENSIONS = (".completed", ".mARkdown", ".inProgress")
+TEXT_NAME_PATTERN = re.compile(r'-ara\d*$')
+
+
+def is_archive(path):
+    return path.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+# OpenITI text name of a raw file name, without the annotation status extension
+def text_name(file_name):
+    for extension in TEXT_EXTENSIONS:
+        if file_name.endswith(extension):
+            return file_name[:-len(extension)]
+    return file_name
+
+
+# text files only, not the -ara1.yml version metadata that ships next to them in the releases
+def is_raw_text(file_name):
+    return TEXT_NAME_PATTERN.search(text_name(file_name)) is not None
+
+
+# raw files lying in a directory, the original layout
+class DirectorySource:
+    def __init__(self, path=None):
+        self.path = path
+
+    def list(self):
+        return [os.path.join(self.path, name) for name in sorted(os.listdir(self.path)) if is_raw_text(name)]
+
+    @staticmethod
+    def stat(path):
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime_ns
+
+    @staticmethod
+    def open_binary(path):
+        return open(path, 'rb')
+
+    @staticmethod
+    def open_text(path):
+        return open(path, 'r', encoding='utf-8')
+
+
+# members of a zip or tar archive, read in place without extracting it
+# members are read through one handle on the archive per process, a tar member by seeking to its data. A
+# compressed tar can only be read from its start, so it is decompressed once into a temporary plain tar, which
+# is removed when the process that made it exits
+class ArchiveSource:
+    def __init__(self, path):
+        self.path = path
+        self.is_zip = path.lower().endswith(".zip")
+        self.tar_path = None  # plain tar the members are read from
+        self._handle = None
+        self._pid = None
+        self._lock = threading.Lock()
+        start_time = time.time()
+        self.members = {}  # member name -> ZipInfo or TarInfo of the files in the archive
+        if self.is_zip:
+            with zipfile.ZipFile(path) as archive:
+                self.members = {info.filename: info for info in archive.infolist() if not info.is_dir()}
+        else:
+            self.tar_path = path if path.lower().endswith(".tar") else self._decompress(path)
+            with tarfile.open(self.tar_path) as archive:
+                self.members = {info.name: info for info in archive.getmembers() if info.isfile()}
+        self.index_seconds = time.time() - start_time
+
+    @staticmethod
+    def _decompress(path):
+        opener = next(opener for extension, opener in TAR_DECOMPRESSORS.items() if path.lower().endswith(extension))
+        descriptor, tar_path = tempfile.mkstemp(suffix=".tar", prefix="mutun-")
+        with os.fdopen(descriptor, 'wb') as outfile, opener(path, 'rb') as infile:
+            shutil.copyfileobj(infile, outfile, 1024 * 1024)
+        atexit.register(_remove_copy, tar_path, os.getpid())
+        return tar_path
+
+    def member(self, path):
+        return self.members[path[len(self.path) + 1:]]
+
+    def list(self, prefix=""):
+        prefix = prefix.strip("/")
+        return sorted(os.path.join(self.path, name) for name in self.members
+                      if (not prefix or name.startswith(prefix + "/")) and is_raw_text(os.path.basename(name)))
+
+    def stat(self, path):
+        info = self.member(path)
+        if self.is_zip:
+            return info.file_size, int(time.mktime(info.date_time + (0, 0, -1))) * 1_000_000_000
+        return info.size, int(info.mtime) * 1_000_000_000
+
+    # the archive handle of this process, a handle inherited through fork shares its file offset with the parent
+    def _archive_handle(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._handle = zipfile.ZipFile(self.path) if self.is_zip else tarfile.open(self.tar_path)
+                self._pid = os.getpid()
+            return self._handle
+
+    @contextlib.contextmanager
+    def open_binary(self, path):
+        info = self.member(path)
+        archive = self._archive_handle()
+        with (archive.open(info) if self.is_zip else archive.extractfile(info)) as member:
+            yield member
+
+    @contextlib.contextmanager
+    def open_text(self, path):
+        with self.open_binary(path) as member:
+            yield io.TextIOWrapper(member, encoding='utf-8')
+
+
+def _remove_copy(path, pid):
+    if os.getpid() == pid and os.path.exists(path):
+        os.remove(path)
+
+
+_directory_source = DirectorySource()
+_archives = {}  # archive path -> ArchiveSource of this process
+_archives_lock = threading.Lock()
+
+
+def archive_source(path):
+    with _archives_lock:
+        if path not in _archives:
+            _archives[path] = ArchiveSource(path)
+        return _archives[path]
+
+
+# the archive a path lies in and the path within it, (None, None) for a path outside of any archive
+def _split_archive_path(path):
+    if is_archive(path) and os.path.isfile(path):
+        return path, ""
+    parent = path
+    while True:
+        inner = parent
+        parent = os.path.dirname(parent)
+        if not parent or parent == inner:
+            return None, None
+        if parent in _archives or (is_archive(parent) and os.path.isfile(parent)):
+            return parent, path[len(parent) + 1:]
+
+
+def source_of(path):
+    if os.path.isfile(path) and not is_archive(path):
+        return _directory_source
+    archive_path, _ = _split_archive_path(path)
+    if archive_path is None:
+        raise FileNotFoundError(f"no raw file or archive member at {path}")
+    return archive_source(archive_path)
+
+
+# raw files under rawdata_path, sorted by name
+def list_raw_files(path):
+    archive_path, prefix = _split_archive_path(path)
+    if archive_path is None:
+        return DirectorySource(path).list()
+    return archive_source(archive_path).list(prefix)
+
+
+def file_stat(path):
+    return source_of(path).stat(path)
+
+
+def file_size(path):
+    return file_stat(path)[0]
+
+
+def open_text(path):
+    return source_of(path).open_text(path)
+
+
+def file_hash(path, block_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with source_of(path).open_binary(path) as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
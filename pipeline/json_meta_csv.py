@@ -1,40 +1,131 @@
 import os
-import json
 import csv
+import json
+import hashlib
+import argparse
 import logging
+from config import Config
 
 # set up logging
 
 logging.basicConfig(filename='json_to_csv.log', level=logging.DEBUG, format='%(asctime)s %(levelname)s:%(message)s')
 
-# json folder
-json_folder = '../json/author_meta'
+# fixed CSV schemas, in the column order of author_master.csv and text_master.csv
+AUTHOR_FIELDS = ["author_id", "author_ar", "author_ar_shuhra", "author_lat", "author_lat_shuhra", "author_auto",
+                 "au_death"]
+TEXT_FIELDS = ["text_id", "text_uri", "title_ar", "title_lat", "ed_info", "collection", "tok_length", "volumes",
+               "page_count", "author_id", "tags"]
+
+
+def file_hash(path):
+    with open(path, 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()
 
-# output CSV
-output_csv = '../author_master.csv'
 
+def read_json(path):
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as file:
+            return json.load(file)
+    return {}
 
-def load_json_data(json_folder):
-    json_data = []
-    for filename in os.listdir(json_folder):
-        if filename.endswith('.json'):
-            file_path = os.path.join(json_folder, filename)
-            with open(file_path, 'r', encoding='utf-8') as json_file:
-                try:
-                    data = json.load(json_file)
-                    json_data.append(data)
-                except json.JSONDecodeError as e:
-                    logging.error(f"Error decoding JSON from file '{filename}': {e}")
-    return json_data
 
+def write_json(path, data):
+    with open(path + '.part', 'w', encoding='utf-8') as file:
+        json.dump(data, file, ensure_ascii=False)
+    os.replace(path + '.part', path)
 
-def write_csv_data(csv_filename, data, fieldnames):
-    with open(csv_filename, mode='w', newline='', encoding='utf-8-sig') as csv_file:
-        csv_writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
+
+def read_csv_rows(csv_filename, key):
+    rows = {}
+    if os.path.exists(csv_filename):
+        with open(csv_filename, newline='', encoding='utf-8-sig') as csv_file:
+            for row in csv.DictReader(csv_file):
+                rows[row[key]] = row
+    return rows
+
+
+# written under a temporary name and renamed, so readers never see a half written CSV
+def write_csv_data(csv_filename, rows, fieldnames):
+    with open(csv_filename + '.part', mode='w', newline='', encoding='utf-8-sig') as csv_file:
+        csv_writer = csv.DictWriter(csv_file, fieldnames=fieldnames, extrasaction='ignore')
         csv_writer.writeheader()
-        csv_writer.writerows(data)
+        csv_writer.writerows(rows)
+    os.replace(csv_filename + '.part', csv_filename)
+
+
+# bring csv_filename up to date with the JSON files of json_folder, one row per key (an author has a JSON file
+# for each of its texts). Only JSON files whose size or modification time changed since the last run are read,
+# and only those whose content hash changed replace their row. What was merged is kept in
+# <csv_filename>.state.json; without it, or without the CSV, every file is read. Rows already in the CSV are
+# kept, a row only goes once the JSON files recorded in the state for its key are gone
+def update_csv(json_folder, csv_filename, fieldnames, key):
+    state_filename = csv_filename + '.state.json'
+    state = read_json(state_filename) if os.path.exists(csv_filename) else {}
+    rows = read_csv_rows(csv_filename, key)
+    new_state = {}
+    changes = {"added": 0, "updated": 0, "removed": 0, "errors": 0}
+
+    entries = os.scandir(json_folder) if os.path.isdir(json_folder) else []
+    for entry in entries:
+        if not entry.name.endswith('.json'):
+            continue
+        stat = entry.stat()
+        previous = state.get(entry.name)
+        if previous and previous["size"] == stat.st_size and previous["mtime_ns"] == stat.st_mtime_ns:
+            new_state[entry.name] = previous
+            continue
+        sha256 = file_hash(entry.path)
+        new_state[entry.name] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": sha256,
+                                 "key": previous["key"] if previous else None}
+        if previous and previous["sha256"] == sha256:
+            continue
+        try:
+            with open(entry.path, 'r', encoding='utf-8') as json_file:
+                data = json.load(json_file)
+        except json.JSONDecodeError as e:
+            logging.error(f"Error decoding JSON from file '{entry.name}': {e}")
+            data = {}
+        if not data.get(key):
+            logging.error(f"No {key} in '{entry.name}'")
+            changes["errors"] += 1
+            del new_state[entry.name]  # read again on the next run
+            continue
+        changes["updated" if data[key] in rows else "added"] += 1
+        rows[data[key]] = {field: data.get(field, "") for field in fieldnames}
+        new_state[entry.name]["key"] = data[key]
+
+    # keys whose JSON files were merged before and have all disappeared or now give another key
+    live_keys = {entry["key"] for entry in new_state.values()}
+    recorded_keys = {entry["key"] for entry in state.values() if entry.get("key")}
+    for row_key in (recorded_keys - live_keys) & rows.keys():
+        del rows[row_key]
+        changes["removed"] += 1
+
+    if changes["added"] or changes["updated"] or changes["removed"] or not os.path.exists(csv_filename):
+        write_csv_data(csv_filename, [rows[row_key] for row_key in sorted(rows)], fieldnames)
+    write_json(state_filename, new_state)
+    logging.info(f"{csv_filename}: {changes['added']} added; {changes['updated']} updated;"
+                 f" {changes['removed']} removed; {changes['errors']} unreadable; {len(rows)} rows")
+    return changes
+
+
+# author_master.csv from the author JSON files and text_master.csv from the text JSON files
+def consolidate_metadata(config=None, authors=True, texts=True):
+    config = config or Config()
+    changes = {}
+    if authors:
+        changes["authors"] = update_csv(config.author_meta_path, config.author_csv_path, AUTHOR_FIELDS, "author_id")
+    if texts:
+        changes["texts"] = update_csv(config.text_meta_path, config.text_csv_path, TEXT_FIELDS, "text_id")
+    return changes
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description="Update the author and text metadata CSVs from the JSON files")
+    arg_parser.add_argument("which", nargs="?", choices=["all", "authors", "texts"], default="all")
+    args = arg_parser.parse_args(argv)
+    print(consolidate_metadata(authors=args.which in ("all", "authors"), texts=args.which in ("all", "texts")))
 
 
-json_data = load_json_data(json_folder)
-fieldnames = json_data[0].keys()
-write_csv_data(output_csv, json_data, fieldnames)
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,10 @@
 import oimdp
 import os
 import re
+import time
+import importlib
+from oimdp import tags as oi_tags
+from pipeline.metrics import get_metrics
 
 path = os.getcwd()
 fileNames = []
@@ -14,22 +18,72 @@ def reg_replace(text, replacements):
     return text
 
 
-# preprocessing to preserve structural elements before openITI cleaner
+# applies a replacement table with every pattern compiled once, in the original order
+# a rule can be given an equivalent pattern that skips matches which would be replaced by themselves, and a
+# literal the pattern cannot match without, so a pass whose literal is absent from the text is skipped
+class RewriteEngine:
+    def __init__(self, rules, equivalents=None, guards=None):
+        equivalents = equivalents or {}
+        guards = guards or {}
+        self.passes = []
+        for pattern, replacement in rules:
+            guard = guards.get(pattern, pattern if self._is_literal(pattern) else None)
+            compiled = re.compile(equivalents.get(pattern, pattern), re.MULTILINE)
+            self.passes.append((pattern, compiled, replacement, guard))
+        self.timings = {label: [0, 0.0, 0] for label, _, _, _ in self.passes}  # calls, seconds, matches
 
-def replace_chapter_headings(text):
+    @staticmethod
+    def _is_literal(pattern):
+        return re.escape(pattern).replace('\\ ', ' ') == pattern
+
+    def __call__(self, text):
+        for label, compiled, replacement, guard in self.passes:
+            start = time.perf_counter()
+            matches = 0
+            if guard is None or guard in text:
+                text, matches = compiled.subn(replacement, text)
+            timing = self.timings[label]
+            timing[0] += 1
+            timing[1] += time.perf_counter() - start
+            timing[2] += matches
+        return text
+
+    # per-pass totals, slowest first
+    def report(self):
+        return sorted(({"rule": label, "calls": calls, "seconds": round(seconds, 6), "matches": matches}
+                       for label, (calls, seconds, matches) in self.timings.items()),
+                      key=lambda row: row["seconds"], reverse=True)
+
+
+# preprocessing to preserve structural elements before openITI cleaner, applied in order
+
+chapter_heading_rules = [
     # replace chapter headings
-    text = re.sub(r'###\s*\|+\s*(.*?)(?=P|$)', r'~~<h1>\1</h1>', text, flags=re.MULTILINE)
+    (r'###\s*\|+\s*(.*?)(?=P|$)', r'~~<h1>\1</h1>'),
     # fix erroneous annotations
-    text = re.sub(r'PageVPP', r'PageV01P', text, flags=re.MULTILINE)
-    text = re.sub(r'PageV(\D)', r'PageV01P000\1', text, flags=re.MULTILINE)
-    text = re.sub(r'#\d{1,}#', r'', text, flags=re.MULTILINE)
-    text = re.sub(r'(PageV\d+P) (\d+)', r'\1\2', text, flags=re.MULTILINE)
-    text = re.sub(r'\n (PageV\d+P\d+)', r'\n\1', text, flags=re.MULTILINE)
-    text = re.sub(r'^# (?!PageV\d+P\d+)(.*)', r'~~<p>\1', text, flags=re.MULTILINE)
+    (r'PageVPP', r'PageV01P'),
+    (r'PageV(\D)', r'PageV01P000\1'),
+    (r'#\d{1,}#', r''),
+    (r'(PageV\d+P) (\d+)', r'\1\2'),
+    (r'\n (PageV\d+P\d+)', r'\n\1'),
+    (r'^# (?!PageV\d+P\d+)(.*)', r'~~<p>\1'),
     # replace pagination with unique substitution characters for text_parser
-    text = re.sub(r'PageV(\d+)P(\d+)', r'~~a11b\g<1>a11b\2', text, flags=re.MULTILINE)
+    (r'PageV(\d+)P(\d+)', r'~~a11b\g<1>a11b\2'),
+]
 
-    return text
+chapter_heading_guards = {
+    r'###\s*\|+\s*(.*?)(?=P|$)': '###',
+    r'PageV(\D)': 'PageV',
+    r'(PageV\d+P) (\d+)': 'PageV',
+    r'\n (PageV\d+P\d+)': '\n PageV',
+}
+
+chapter_heading_engine = RewriteEngine(chapter_heading_rules, guards=chapter_heading_guards)
+
+
+def replace_chapter_headings(text):
+    with get_metrics().timer("replace_chapter_headings"):
+        return chapter_heading_engine(text)
 
 
 # list of replacements for leftover annotations and extraneous characters not removed by openITI cleaner
@@ -56,55 +110,380 @@ replacements = {
 
 }
 
+# a single space or newline is replaced by itself, so only runs of two or more need rewriting
+replacement_equivalents = {
+    '\\n+': '\\n{2,}',
+    '[ ]+': ' {2,}',
+}
 
-# chunk texts that have no pages into 1800 character segments and paginate
+# literals the non-literal rules cannot match without
+replacement_guards = {
+    '\\n<p> $': '\n<p> ',
+    '-+NO PAGE NO-+': 'NO PAGE NO',
+}
+
+replacement_engine = RewriteEngine(list(replacements.items()), replacement_equivalents, replacement_guards)
+
+
+# page sizes: texts without page markers are cut into pages of about budget characters (text without tags) or
+# estimated tokens (words), and printed pages above the budget can be cut into sub pages.
+# Pages are made of whole paragraphs and headings, a heading is never cut; with split_paragraphs a paragraph
+# above the budget is cut at spaces. Pieces are collected in lists and joined once, so cutting is linear
 
+PART_PATTERN = re.compile(r'(</p>|<p>.*?</p>|<h1>.*?</h1>)', re.DOTALL)
+HEADING_PATTERN = re.compile(r'(<h1>.*?</h1>)', re.DOTALL)
+TAG_PATTERN = re.compile(r'<[^>]+>')
+TOKEN_PATTERN = re.compile(r'\w+')
 
+
+class PageBudget:
+    def __init__(self, budget=1800, unit="chars", split_paragraphs=False):
+        if unit not in ("chars", "tokens"):
+            raise ValueError(f"unknown page budget unit: {unit}")
+        self.budget = budget
+        self.unit = unit
+        self.split_paragraphs = split_paragraphs
+
+    def size(self, text):
+        if self.unit == "chars":
+            return len(TAG_PATTERN.sub('', text))
+        return len(TOKEN_PATTERN.findall(TAG_PATTERN.sub('', text)))
+
+    # (piece, size) of a part, cut at spaces when it is above the budget and may be cut
+    def _pieces(self, part, size, split):
+        if not split or size <= self.budget or part.startswith("<h1>"):
+            return [(part, size)]
+        return [(word, self.size(word)) for word in re.split(r'(?<= )', part) if word]
+
+    # consecutive pieces joined into chunks of at most budget, a piece above the budget is a chunk of its own
+    def _pack(self, pieces):
+        chunks = []
+        current = []
+        current_size = 0
+        for piece, size in pieces:
+            if current_size + size <= self.budget:
+                current.append(piece)
+                current_size += size
+            else:
+                chunks.append("".join(current))
+                current = [piece]
+                current_size = size
+        if current:
+            chunks.append("".join(current))
+        return chunks
+
+    # number the chunks of a text without page markers as pages of volume 1
+    def paginate(self, input_text):
+        if re.search(r'a11b\d{2}a11b\d{3,}', input_text):
+            return input_text
+        size = self.size
+        pieces = []
+        for part in PART_PATTERN.findall(input_text):
+            part_size = size(part)
+            if self.split_paragraphs and part_size > self.budget:
+                pieces.extend(self._pieces(part, part_size, True))
+            else:
+                pieces.append((part, part_size))
+        return "".join(f"{chunk}a11b01a11b{str(number).zfill(3)}\n"
+                       for number, chunk in enumerate(self._pack(pieces), start=1))
+
+    # the text of a printed page, or the texts of its sub pages in order when it is above the budget
+    def split_page(self, text):
+        if self.size(text) <= self.budget:
+            return [text]
+        pieces = []
+        for n, segment in enumerate(HEADING_PATTERN.split(text)):
+            for part in ([segment] if n % 2 else re.split(r'(?=<p>)', segment)):
+                if part:
+                    pieces.extend(self._pieces(part, self.size(part), True))
+        return self._balance([chunk.strip() for chunk in self._pack(pieces) if chunk.strip()])
+
+    # a paragraph cut between two sub pages is closed at the end of the first and opened again at the start of the
+    # second, so every sub page is well-formed markup
+    @staticmethod
+    def _balance(chunks):
+        for n in range(len(chunks) - 1):
+            before, after = chunks[n], chunks[n + 1]
+            if after.startswith("</p>"):
+                before, after = before + "</p>", after[len("</p>"):].lstrip()
+            closing = after.find("</p>")
+            opening = after.find("<p>")
+            if before.rfind("<p>") > before.rfind("</p>") or (closing != -1 and (opening == -1 or closing < opening)):
+                before, after = before + "</p>", "<p>" + after
+            chunks[n], chunks[n + 1] = before, after
+        return [chunk for chunk in chunks if chunk not in ("", "<p></p>")]
+
+
+default_page_budget = PageBudget()
+
+
+# chunk texts that have no pages into 1800 character segments and paginate
 def chunk_and_page(input_text):
-    if re.search(r'a11b\d{2}a11b\d{3,}', input_text):
-        return (input_text)
-    # define a regular expression to match </p> and <p>
-    pattern = re.compile(r'(</p>|<p>.*?</p>|<h1>.*?</h1>)', re.DOTALL)
-
-    # split the input text into chunks of up to 300 characters
-    chunks = []
-    current_chunk = ""
-    current_length = 0
-
-    for match in pattern.finditer(input_text):
-        part = match.group(0)
-
-        # calculate the length of the content (excluding tags)
-        content_length = len(re.sub(r'<[^>]+>', '', part))
-
-        # check if adding the content to the current chunk would exceed 1800 characters
-        if current_length + content_length <= 1800:
-            current_chunk += part
-            current_length += content_length
-        else:
-            # save the current chunk and start a new one
-            chunks.append(current_chunk)
-            current_chunk = part
-            current_length = content_length
-
-    # add the last chunk to the list
-    if current_chunk:
-        chunks.append(current_chunk)
-
-    # number the chunks as requested
-    result = []
-    for i, chunk in enumerate(chunks):
-        if i == 0:
-            result.append(f"{chunk}a11b01a11b001\n")
+    return default_page_budget.paginate(input_text)
+
+
+# single pass replacement for oimdp.parse(text).get_clean_text(): every line is rendered to the strings the
+# oimdp document would print for it, in the same order, without building the document. Patterns and tags are
+# oimdp's own so both read a line the same way, and lines whose clean text oimdp fails on fail here too.
+# "python -m pipeline.benchmark clean_text" compares the two on a corpus
+
+oi_parser = importlib.import_module("oimdp.parser")  # the package exports a function of the same name
+MAGIC_VALUE = "######OpenITI#"
+_PARAGRAPH_RE = re.compile(r"^#($|[^#])")
+_BIO_RE = re.compile(rf"{re.escape(oi_tags.BIO_MAN)}[^#]")
+_MORPHOLOGICAL_RE = re.compile(r"#~:([^:]+?):")
+_REGION_RE = re.compile(rf"({oi_tags.PROV}|{oi_tags.REG}\d) .*? {oi_tags.GEO_TYPE} .*? ({oi_tags.REG}\d|{oi_tags.STTL})"
+                        rf" ([\w# ]+) $")
+_HEADER_RE = re.compile(oi_parser.HEADER_PATTERN_GROUPED)
+_MILESTONE_RE = re.compile(oi_parser.MILESTONE_PATTERN)
+_LINE_SPLIT_RE = re.compile(
+    rf"({oi_parser.PAGE_PATTERN}|{oi_parser.MILESTONE_PATTERN}|{oi_parser.OPEN_TAG_AUTO_PATTERN}"
+    rf"|{oi_parser.OPEN_TAG_CUSTOM_PATTERN}|{'|'.join(re.escape(tag) for tag in oi_tags.PHRASE_LV_TAGS)}"
+    rf"|{'|'.join(oi_parser.NAMED_ENTITIES_PATTERN)})")
+# a line with none of these has no phrase level tags and is its own clean text
+_PHRASE_TAG_RE = re.compile("|".join(["@", re.escape(oi_tags.PAGE), oi_parser.MILESTONE_PATTERN,
+                                      *(re.escape(tag) for tag in oi_tags.PHRASE_LV_TAGS)]))
+# tokens printed as they are, and named entity tags in the order oimdp tries them
+_KEPT_TAGS = (oi_tags.HEMI, oi_tags.MATN, oi_tags.HUKM, oi_tags.ROUTE_FROM, oi_tags.ROUTE_TOWA, oi_tags.ROUTE_DIST,
+              oi_tags.YEAR_BIRTH, oi_tags.YEAR_DEATH, oi_tags.YEAR_OTHER, oi_tags.YEAR_AGE)
+_ENTITY_TAGS = (oi_tags.SRC, oi_tags.SOC_FULL, oi_tags.SOC, oi_tags.TOP_FULL, oi_tags.TOP, oi_tags.PER_FULL,
+                oi_tags.PER)
+
+
+# clean text of one line as oimdp's parse_line and Line.__str__ give it, None where oimdp has no line
+def _line_text(tagged_line, index):
+    line = tagged_line.replace(oi_tags.LINE, '')
+    if not _PHRASE_TAG_RE.search(line):
+        return line or None
+    if oi_parser.remove_phrase_lv_tags(line) == "":
+        return None
+
+    parts = []  # [text, takes words]: words a named entity covers are added to the part before them
+    include_words = 0
+    for token in _LINE_SPLIT_RE.split(line):
+        if token == '':
+            continue
+        if oi_tags.PAGE in token:
+            match = oi_parser.PAGE_RE.search(token)
+            if match is None:
+                raise Exception('Could not parse page number at line: ' + str(index + 1))
+            parts.append([f"Vol. {match.group(1)}, p. {match.group(2)}", False])
+        elif _MILESTONE_RE.match(token):
+            parts.append(["", False])
+        elif token.startswith('@') and (oi_parser.OPEN_TAG_CUSTOM_PATTERN_GROUPED.match(token)
+                                        or oi_parser.OPEN_TAG_AUTO_PATTERN_GROUPED.match(token)):
+            raise ValueError(f"open tag at line {index + 1} has no clean text in oimdp")
+        elif any(tag in token for tag in _KEPT_TAGS):
+            parts.append([token, False])
         else:
-            result.append(f"{chunk}a11b01a11b{str(i + 1).zfill(3)}\n")
+            entity = next((tag for tag in _ENTITY_TAGS if tag in token), None)
+            if entity is not None:
+                value = token.replace(entity, '')
+                include_words = int(value[1])
+                int(value[0])  # read by oimdp as well, a malformed tag fails the same way
+                parts.append(["", True])
+            elif include_words > 0:
+                words = token.strip().split()
+                if parts[-1][1]:
+                    parts[-1][0] += "".join(word + " " for word in words[:include_words])
+                rest = "".join(word + " " for word in words[include_words:])
+                if rest:
+                    parts.append([rest, True])
+                include_words = 0
+            else:
+                parts.append([token, True])
+    return "".join(part[0] for part in parts)
+
+
+def extract_clean_text(text):
+    lines = text.splitlines()
+    if not lines or not lines[0].strip().encode('ascii', 'ignore').decode('ascii').startswith(MAGIC_VALUE):
+        raise Exception("This does not appear to be an OpenITI mARkdown document")
+
+    output = []
+    append = output.append
+    for index, line in enumerate(lines):
+        # in the order of oimdp's parser, tags are prefixes of one another
+        if line.startswith(oi_tags.META):
+            continue
+        elif line.startswith(oi_tags.PAGE):
+            match = oi_parser.PAGE_RE.search(line)
+            if match is None:
+                raise Exception('Could not parse page number at line: ' + str(index + 1))
+            append(f"Vol. {match.group(1)}, p. {match.group(2)}")
+        elif line.startswith(oi_tags.RWY):
+            append("")
+            rendered = _line_text(line[7:], index)
+            if rendered is not None:
+                append(rendered)
+        elif line.startswith(oi_tags.ROUTE_FROM):
+            append(str(_line_text(line, index)))
+        elif "#~:" in line and _MORPHOLOGICAL_RE.search(line):
+            append("")
+        elif _PARAGRAPH_RE.search(line):
+            if oi_tags.HEMI in line:
+                append(str(_line_text(line[1:], index)))
+            else:
+                append("")
+                rendered = _line_text(line[1:], index)
+                if rendered is not None:
+                    append(rendered)
+        elif line.startswith(oi_tags.LINE):
+            append(str(_line_text(line, index)))
+        elif line.startswith((oi_tags.EDITORIAL, oi_tags.APPENDIX, oi_tags.PARATEXT)):
+            append("")
+        elif line.startswith(oi_tags.HEADER):
+            append(oi_parser.remove_phrase_lv_tags(_HEADER_RE.sub('', line)))
+        elif line.startswith(oi_tags.DIC):
+            _append_unit(append, line, oi_tags.DICTIONARIES, index)
+        elif line.startswith(oi_tags.DOX):
+            raise ValueError(f"doxographical item at line {index + 1} has no clean text in oimdp")
+        elif _BIO_RE.search(line) or line.startswith(oi_tags.BIO) or line.startswith(oi_tags.EVENT):
+            _append_unit(append, line, oi_tags.BIOS_EVENTS, index)
+        elif _REGION_RE.search(line):
+            append("")
+    return "\n".join(output)
+
+
+# dictionary units, biographies and events print nothing for the tag and then their first line
+def _append_unit(append, line, unit_tags, index):
+    for tag in unit_tags:
+        line = line.replace(tag, '')
+    append("")
+    rendered = _line_text(line, index)
+    if rendered is not None:
+        append(rendered)
+
+
+def oimdp_clean_text(text):
+    return oimdp.parse(text).get_clean_text()
 
-    return "".join(result)
 
+# Config.clean_text_engine, with the metrics stage each one is timed under
+clean_text_engines = {"fast": (extract_clean_text, "extract"), "oimdp": (oimdp_clean_text, "oimdp")}
 
-def clean_text(text):
+
+# clean text, leftover replacements and, for texts without page markers, pagination
+def _clean_piece(text, paginate, engine="fast", page_budget=default_page_budget):
+    metrics = get_metrics()
+    extract, stage = clean_text_engines[engine]
+    with metrics.timer(stage):
+        oi_clean = extract(text)
+    with metrics.timer("replacements"):
+        cleaned = replacement_engine(oi_clean)
+    if not paginate:
+        return cleaned
+    with metrics.timer("chunk_and_page"):
+        return page_budget.paginate(cleaned)
+
+
+def clean_text(text, engine="fast", page_budget=default_page_budget):
     text = replace_chapter_headings(text)
-    oi_parsed = oimdp.parse(text)
-    oi_clean = oi_parsed.get_clean_text()
-    mutun_clean = chunk_and_page(reg_replace(oi_clean, replacements))
-    return mutun_clean
+    return _clean_piece(text, paginate=True, engine=engine, page_budget=page_budget)
+
+
+# streaming cleaner for very large files: the raw text is read line by line and cleaned a batch of pages at a
+# time, so memory follows the batch size instead of the file size
+
+PAGE_MARKER_PATTERN = re.compile(r'~~a11b\d+a11b\d+')
+MORPHOLOGICAL_PATTERN = re.compile(r'#~:[^:]+?:')
+
+
+# a page marker can only be cut after when the rest of its line survives oimdp as a "~~" continuation line
+def _splittable_line(line):
+    return (line.startswith("# ") or line.startswith("~~")) and not MORPHOLOGICAL_PATTERN.search(line)
+
+
+# end of the last page marker of text that can be cut after, text starts at the start of a line
+def _last_split_point(text):
+    for match in reversed(list(PAGE_MARKER_PATTERN.finditer(text))):
+        line_start = text.rfind("\n", 0, match.start()) + 1
+        line_end = text.find("\n", match.end())
+        if _splittable_line(text[line_start:line_end if line_end != -1 else len(text)]):
+            return match.end()
+    return None
+
+
+# the "\n<p> $" replacement strips an empty paragraph before a line break or at the end of the text, a piece
+# after the first needs the line break the pages before it ended with
+EMPTY_PARAGRAPH_LINE_PATTERN = re.compile(r'\n<p> $', re.MULTILINE)
+
+
+# replace_chapter_headings can run on the raw lines before a line break apart from the lines after it, unless one
+# of its rules can match across the break: "\n (PageV..." needs the break before a line starting with a space,
+# and the whitespace of "###\s*\|+\s*" runs on past the end of a line ending in ### or pipes, through blank lines
+HEADING_CONTINUATION_PATTERN = re.compile(r'###[\s|]*$')
+
+
+def _separable(line, next_line):
+    return line.strip() and not HEADING_CONTINUATION_PATTERN.search(line) and not next_line[:1].isspace()
+
+
+# number of leading lines that can be converted without the rest
+def _separable_lines(lines):
+    for n in range(len(lines) - 1, 0, -1):
+        if _separable(lines[n - 1], lines[n]):
+            return n
+    return 0
+
+
+def iter_clean_pages(file, chunk_size=1 << 20, engine="fast", page_budget=default_page_budget):
+    # text after the last cut, already through replace_chapter_headings, as a list of parts each starting at the
+    # start of a line; parts before `scanned` hold no page marker to cut after, so each part is scanned once
+    parts = []
+    scanned = 0
+    buffer = []  # raw lines not converted yet
+    buffered = 0
+    first_piece = True
+    seen_marker = False
+    eof = False
+
+    while not eof:
+        line = file.readline()
+        if line:
+            buffer.append(line)
+            buffered += len(line)
+            if buffered < chunk_size:
+                continue
+        else:
+            eof = True
+
+        separable = len(buffer) if eof else _separable_lines(buffer)
+        if not separable and not eof:
+            continue
+        parts.append(replace_chapter_headings("".join(buffer[:separable])))
+        buffer = buffer[separable:]
+        buffered = sum(len(line) for line in buffer)
+
+        if eof:
+            piece, carry = "".join(parts), ""
+        else:
+            cut = None
+            for index in range(len(parts) - 1, scanned - 1, -1):
+                cut = _last_split_point(parts[index])
+                if cut is not None:
+                    break
+            if cut is None:
+                # no page boundary yet, keep the converted text and read further
+                scanned = len(parts)
+                continue
+            piece = "".join(parts[:index]) + parts[index][:cut]
+            carry = parts[index][cut:] + "".join(parts[index + 1:])
+        if carry.startswith("\n"):
+            carry = "#" + carry  # an empty paragraph stands in for the content the next line was joined to
+        elif carry:
+            carry = "~~" + carry  # the rest of the cut line continues as a line of its own
+        parts = [carry] if carry else []
+        scanned = 0
+        seen_marker = seen_marker or PAGE_MARKER_PATTERN.search(piece) is not None
+
+        if not first_piece:
+            piece = MAGIC_VALUE + "\n" + piece
+        cleaned = _clean_piece(piece, paginate=eof and not seen_marker, engine=engine, page_budget=page_budget)
+        if not first_piece:
+            cleaned = EMPTY_PARAGRAPH_LINE_PATTERN.sub('', "\n" + cleaned)[1:]
+        pages = cleaned.splitlines()
+        if not eof and pages:
+            pages.pop()  # what follows the last marker belongs to the next piece
+        first_piece = False
+        yield from pages
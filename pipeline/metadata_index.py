@@ -0,0 +1,126 @@
+import os
+import re
+import pickle
+import logging
+from pipeline.name_parser import NameParser
+
+INDEX_VERSION = 1  # bump when the fields computed by resolve_metadata change
+
+collection_mappings = {
+    'ALCorpus': 'Arabic and Latin',
+    'AOCP': 'Arabic OCR Catalyst Project',
+    'ArabCommAph': 'Arabic Hippocratic Aphorisms',
+    'BibleCorpus': 'Bible Corpus',
+    'DARE': 'Digital Averroes',
+    'DSS': 'Dept. of Syriac Studies',
+    'EScr': 'Escriptorium',
+    'Filaha': 'The Filāḥa Project',
+    'JMIHE': 'Jewish-Muslim History',
+    'Kraken': 'Kraken',
+    'GRAR': 'Graeco-Arabic Studies',
+    'Hindawi': 'Hindāwī',
+    'JK': 'al-Jāmiʿ al-Kabīr',
+    'LAL': 'Library of Arabic Lit.',
+    'Masaha': 'Masāḥa',
+    'MP': 'Muslim Philosophy',
+    'SAWS': 'Sharing Ancient Wisdoms',
+    'PAL': 'Ptolemaeus Arabus',
+    'Sham': 'al-Maktaba al-Shāmila',
+    'Sham30K': 'al-Maktaba al-Shāmila 30k',
+    'ShamAY': 'al-Maktaba al-Shāmila AY',
+    'ShamIbadiyya': 'al-Shāmila al-Ibāḍiyya',
+    'Shamela': 'al-Maktaba al-Shāmila',
+    'Shia': 'al-Shāmila al-Shīʿiyya',
+    'Tafsir': 'al-Tafāsīr',
+    'Wiki': 'Wīkī Maṣdar',
+    'Zaydiyya': 'al-Shāmila al-Zaydiyya'
+}
+
+
+# work out the author and text fields MetaDataManager fills from one row of the master sheet
+def resolve_metadata(metadata, name_parser):
+    import pandas as pd
+    author_meta = {}
+    text_meta = {}
+    author_meta["author_lat"] = metadata.get("author_lat", "")
+    text_meta["ed_info"] = metadata.get("ed_info", "")
+    text_meta["tok_length"] = metadata.get("tok_length", "")
+    text_meta["tags"] = metadata.get("tags", "")
+    author_meta["author_auto"] = metadata.get("author_from_uri", "")
+    collection = re.match(r'^([A-Za-z]+)', metadata.get("Version", "")).group(0)
+
+    if collection in collection_mappings:
+        text_meta["collection"] = collection_mappings[collection]
+
+    # only the first of several titles is kept
+    text_meta["title_lat"] = str(metadata.get("title_lat", "")).split(" :: ")[0]
+    text_meta["title_ar"] = str(metadata.get("title_ar", "")).split(" :: ")[0]
+
+    author_lat_shuhra = metadata.get("author_lat_shuhra", "")
+    if not pd.isna(author_lat_shuhra):
+        author_meta["author_lat_shuhra"] = author_lat_shuhra
+
+    author_lat_full_name = metadata.get("author_lat_full_name", "")
+    if not pd.isna(author_lat_full_name):
+        if not pd.isna(author_lat_shuhra):
+            author_meta["author_lat"] = f"{author_lat_shuhra}, {author_lat_full_name}"
+        else:
+            author_meta["author_lat"] = author_lat_full_name
+
+    author_ar = str(metadata.get("author_ar", ""))
+    if " :: " in author_ar:
+        parts = author_ar.split(" :: ")
+        author_meta["author_ar_shuhra"] = parts[0]
+        author_meta["author_ar"] = name_parser.parse_arabic_name(parts[1])
+    else:
+        author_meta["author_ar"] = name_parser.parse_arabic_name(author_ar)
+    return author_meta, text_meta
+
+
+# convert the OpenITI master sheet into a dict of Version -> {"author_meta", "text_meta"} with every
+# derived field already computed, the first row wins when a Version appears more than once
+def compile_metadata(xlsx_path):
+    import pandas as pd  # only needed to compile the index, a run that loads the pickled index skips it
+    df = pd.read_excel(xlsx_path)
+    name_parser = NameParser()
+    index = {}
+    for metadata in df.to_dict('records'):
+        version = metadata.get("Version")
+        if not isinstance(version, str) or version in index:
+            continue
+        try:
+            author_meta, text_meta = resolve_metadata(metadata, name_parser)
+            index[version] = {"author_meta": author_meta, "text_meta": text_meta}
+        except Exception as e:
+            # kept so the text fails on lookup the way it did when the row was resolved per text
+            index[version] = {"error": f"{type(e).__name__}: {e}"}
+    return index
+
+
+def _signature(xlsx_path):
+    stat = os.stat(xlsx_path)
+    return INDEX_VERSION, stat.st_size, stat.st_mtime_ns
+
+
+# load the compiled index, rebuilding it only when the xlsx has changed since it was compiled
+def load_metadata_index(xlsx_path, index_path):
+    signature = _signature(xlsx_path)
+    if os.path.exists(index_path):
+        try:
+            with open(index_path, 'rb') as file:
+                stored = pickle.load(file)
+            if stored["signature"] == signature:
+                return stored["index"]
+        except Exception as e:
+            logging.error(f"Error loading metadata index {index_path}: {str(e)}")
+
+    print(f"Compiling metadata index from {xlsx_path}...")
+    index = compile_metadata(xlsx_path)
+    directory = os.path.dirname(index_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    part_path = f"{index_path}.{os.getpid()}.part"
+    with open(part_path, 'wb') as file:
+        pickle.dump({"signature": signature, "index": index}, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(part_path, index_path)
+    return index
@@ -0,0 +1,191 @@
+import os
+import sys
+import json
+import time
+import threading
+from collections import defaultdict, Counter
+from contextlib import contextmanager
+
+
+# resident and peak resident memory of this process in bytes
+def memory_usage():
+    rss = peak = None
+    try:
+        with open('/proc/self/status', 'r') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1]) * 1024
+                elif line.startswith('VmHWM:'):
+                    peak = int(line.split()[1]) * 1024
+    except OSError:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak *= 1 if sys.platform == 'darwin' else 1024
+    return rss, peak
+
+
+# resident memory of this process split by sharing, in bytes: pss divides each shared page among the
+# processes mapping it and private is what the process alone costs, so a worker sharing the parent's model
+# shows a large rss but a small private size
+def memory_breakdown():
+    fields = {'Rss:': 'rss', 'Pss:': 'pss', 'Shared_Clean:': 'shared', 'Shared_Dirty:': 'shared',
+              'Private_Clean:': 'private', 'Private_Dirty:': 'private'}
+    breakdown = {}
+    try:
+        with open('/proc/self/smaps_rollup', 'r') as rollup:
+            for line in rollup:
+                parts = line.split()
+                if parts and parts[0] in fields:
+                    key = fields[parts[0]]
+                    breakdown[key] = breakdown.get(key, 0) + int(parts[1]) * 1024
+    except OSError:
+        breakdown['rss'] = memory_usage()[0]
+    return breakdown
+
+
+# stage durations and counters of the file being processed, shared by the threads of one process
+# stage times are summed over threads, so a stage running in four analysis threads can add up to more
+# than the wall time of the file
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stages = defaultdict(float)
+        self.counters = defaultdict(int)
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def add_time(self, stage, seconds):
+        with self._lock:
+            self.stages[stage] += seconds
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    # add a record produced elsewhere, e.g. by the pool worker that analyzed a page range of this file
+    def merge(self, record):
+        with self._lock:
+            for stage, seconds in record.get("stages", {}).items():
+                self.stages[stage] += seconds
+            for name, value in record.get("counters", {}).items():
+                self.counters[name] += value
+
+    # return what was recorded since the last call and start over
+    def collect(self):
+        with self._lock:
+            record = {"stages": {stage: round(seconds, 6) for stage, seconds in self.stages.items()},
+                      "counters": dict(self.counters)}
+            self.stages.clear()
+            self.counters.clear()
+        return record
+
+    # the record of one processed file, with the memory of the process that finished it
+    def file_record(self, file_name, seconds, error=None):
+        record = self.collect()
+        rss, peak = memory_usage()
+        record.update(file=file_name, seconds=round(seconds, 6), pid=os.getpid(), rss_bytes=rss,
+                      peak_rss_bytes=peak, private_bytes=memory_breakdown().get('private'), time=time.time())
+        if error is not None:
+            record["error"] = error
+        return record
+
+
+_metrics = Metrics()
+
+
+# one Metrics per process, the pipeline modules record into it
+def get_metrics():
+    return _metrics
+
+
+# collects the file records returned by the pool workers in the parent process, appends them to a JSON
+# lines file and keeps the totals that are written as a Prometheus textfile
+class MetricsAggregator:
+    def __init__(self, metrics_path, prefix="mutun"):
+        self.metrics_path = metrics_path
+        self.prefix = prefix
+        os.makedirs(metrics_path, exist_ok=True)
+        self.jsonl_path = os.path.join(metrics_path, "files.jsonl")
+        self.prom_path = os.path.join(metrics_path, f"{prefix}_pipeline.prom")
+        self.stages = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.files = Counter()
+        self.file_seconds = 0.0
+        self.workers = {}  # pid -> (rss, peak rss, private) from its latest record
+
+    def add(self, record):
+        with open(self.jsonl_path, 'a', encoding='utf-8') as outfile:
+            outfile.write(json.dumps(record, ensure_ascii=False) + "\n")
+        for stage, seconds in record.get("stages", {}).items():
+            self.stages[stage] += seconds
+        for name, value in record.get("counters", {}).items():
+            self.counters[name] += value
+        self.files["failed" if "error" in record else "done"] += 1
+        self.file_seconds += record.get("seconds", 0.0)
+        if record.get("pid") is not None:
+            self.workers[record["pid"]] = (record.get("rss_bytes"), record.get("peak_rss_bytes"),
+                                           record.get("private_bytes"))
+
+    # written under a temporary name and renamed, as the node exporter textfile collector expects
+    def write_prometheus(self):
+        p = self.prefix
+        lines = [f"# HELP {p}_stage_seconds_total Time spent per pipeline stage, summed over threads",
+                 f"# TYPE {p}_stage_seconds_total counter"]
+        lines += [f'{p}_stage_seconds_total{{stage="{stage}"}} {seconds:.6f}'
+                  for stage, seconds in sorted(self.stages.items())]
+        for name, value in sorted(self.counters.items()):
+            lines += [f"# TYPE {p}_{name}_total counter", f"{p}_{name}_total {value}"]
+        lines += [f"# TYPE {p}_files_total counter"]
+        lines += [f'{p}_files_total{{status="{status}"}} {value}' for status, value in sorted(self.files.items())]
+        lines += [f"# TYPE {p}_file_seconds_total counter", f"{p}_file_seconds_total {self.file_seconds:.6f}"]
+        for n, gauge in enumerate(["worker_rss_bytes", "worker_peak_rss_bytes", "worker_private_bytes"]):
+            lines += [f"# TYPE {p}_{gauge} gauge"]
+            lines += [f'{p}_{gauge}{{pid="{pid}"}} {memory[n]}' for pid, memory in sorted(self.workers.items())
+                      if memory[n] is not None]
+        part_path = self.prom_path + ".part"
+        with open(part_path, 'w', encoding='utf-8') as outfile:
+            outfile.write("\n".join(lines) + "\n")
+        os.replace(part_path, self.prom_path)
+
+
+# opt-in sampling profiler: a thread samples the stacks of all other threads every interval seconds and
+# counts them in the folded format flamegraph.pl and speedscope read
+class SamplingProfiler:
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.samples[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self, output_path):
+        self._stop.set()
+        self._thread.join()
+        directory = os.path.dirname(output_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(output_path, 'w', encoding='utf-8') as outfile:
+            for stack, count in self.samples.most_common():
+                outfile.write(f"{stack} {count}\n")
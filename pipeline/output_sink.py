@@ -0,0 +1,283 @@
+import os
+import re
+import gzip
+import json
+import hashlib
+import logging
+from pipeline.metrics import get_metrics
+
+
+# clean text name used for output files, e.g. 0179MalikIbnAnas.Muwatta.Shamela0001234
+def clean_text_name(base_filename):
+    return re.sub(r'-ara\d*', '', base_filename)
+
+
+# document id of a page, the sub pages of a printed page cut by Config.split_oversized_pages get _1, _2, ...
+def document_id(id_template, page_data):
+    if "sub_page" in page_data:
+        return f"{id_template.format(**page_data)}_{page_data['sub_page']}"
+    return id_template.format(**page_data)
+
+
+# base class of the page output sinks, one sink is opened per text
+# pages are buffered and written out every flush_pages pages and when the sink is closed, _write_batch returns
+# the number of bytes it wrote, or None when the pages leave the process some other way
+class PageSink:
+    def __init__(self, output_path, base_filename, flush_pages=256):
+        self.output_path = output_path
+        self.base_filename = base_filename
+        self.flush_pages = flush_pages
+        self.buffer = []
+        self.pages_written = 0
+
+    def write(self, page_data, volume_num):
+        self.buffer.append((page_data, volume_num))
+        if len(self.buffer) >= self.flush_pages:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            metrics = get_metrics()
+            with metrics.timer("write"):
+                written = self._write_batch(self.buffer)
+            if written is not None:
+                metrics.count("bytes_written", written)
+            self.pages_written += len(self.buffer)
+            self.buffer = []
+
+    def _write_batch(self, batch):
+        raise NotImplementedError
+
+    # make every page written so far durable, used before a checkpoint records them
+    def sync(self):
+        self.flush()
+
+    def close(self):
+        self.flush()
+
+    # called in place of close when the text failed part way
+    def abort(self):
+        self.close()
+
+
+# the original layout: one indented JSON file per page in a folder per text
+class PerPageJsonSink(PageSink):
+    def __init__(self, output_path, base_filename, flush_pages=256):
+        super().__init__(output_path, base_filename, flush_pages)
+        self.output_folder = os.path.join(output_path, base_filename)
+        os.makedirs(self.output_folder, exist_ok=True)
+        self.file_prefix = clean_text_name(base_filename).split('.')[-1]
+
+    def page_file_name(self, page_data, volume_num):
+        if "sub_page" in page_data:
+            return f"{self.file_prefix}-{volume_num}-{page_data['page_num']}_{page_data['sub_page']}.json"
+        return f"{self.file_prefix}-{volume_num}-{page_data['page_num']}.json"
+
+    def _write_batch(self, batch):
+        written = 0
+        for page_data, volume_num in batch:
+            output_filename = self.page_file_name(page_data, volume_num)
+            with open(os.path.join(self.output_folder, output_filename), 'w', encoding='utf-8') as outfile:
+                json.dump(page_data, outfile, ensure_ascii=False, indent=4)
+                written += outfile.tell()
+        return written
+
+
+def _read_json(path, default):
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as file:
+            return json.load(file)
+    return default
+
+
+def _write_json(path, data):
+    with open(path + ".tmp", 'w', encoding='utf-8') as outfile:
+        json.dump(data, outfile, ensure_ascii=False, separators=(',', ':'))
+    os.replace(path + ".tmp", path)
+
+
+# per-page JSON files that are only rewritten when their content changed
+# <output_path>/<base_filename>.manifest.json maps every page file of the text to the sha256 of its JSON, which
+# holds the page text, the tokens and the page numbering. A page whose hash is unchanged and whose file exists is
+# left untouched, and the files of the previous run that were not produced again are deleted on close.
+# <base_filename>.changes.json then lists the added, changed and removed page files, so an indexer only has to
+# push the deltas of a reprocessed text
+class ContentAddressedPageSink(PerPageJsonSink):
+    def __init__(self, output_path, base_filename, flush_pages=256, resume=False):
+        super().__init__(output_path, base_filename, flush_pages)
+        self.manifest_path = os.path.join(output_path, base_filename + ".manifest.json")
+        self.part_path = os.path.join(output_path, base_filename + ".manifest.part.json")
+        self.changes_path = os.path.join(output_path, base_filename + ".changes.json")
+        self.previous = _read_json(self.manifest_path, {})  # file name -> sha256 of the last finished run
+        self.pages = {}  # file name -> sha256 of the pages produced by this run
+        self.complete = True
+        if resume:
+            # the manifest so far was saved with the progress record the run resumes from
+            part = _read_json(self.part_path, None)
+            if part is None:
+                logging.warning(f"No partial page manifest for {base_filename}, stale pages are kept this run")
+                self.complete = False
+            else:
+                self.pages = part
+
+    def _write_batch(self, batch):
+        written = 0
+        for page_data, volume_num in batch:
+            output_filename = self.page_file_name(page_data, volume_num)
+            data = json.dumps(page_data, ensure_ascii=False, indent=4).encode('utf-8')
+            sha256 = hashlib.sha256(data).hexdigest()
+            path = os.path.join(self.output_folder, output_filename)
+            current = self.pages[output_filename] if output_filename in self.pages \
+                else self.previous.get(output_filename)
+            self.pages[output_filename] = sha256
+            if current == sha256 and os.path.exists(path):
+                continue
+            with open(path, 'wb') as outfile:
+                outfile.write(data)
+            written += len(data)
+        return written
+
+    def sync(self):
+        self.flush()
+        _write_json(self.part_path, self.pages)
+
+    # a page is compared with the previous run by its final hash, a page number that occurs twice in the text is
+    # written twice but listed by what ends up in its file
+    def close(self):
+        self.flush()
+        added = [name for name in self.pages if name not in self.previous]
+        changed = [name for name in self.pages if name in self.previous and self.pages[name] != self.previous[name]]
+        unchanged = len(self.pages) - len(added) - len(changed)
+        removed = [name for name in self.previous if name not in self.pages]
+        if self.complete:
+            for name in removed:
+                path = os.path.join(self.output_folder, name)
+                if os.path.exists(path):
+                    os.remove(path)
+            manifest = self.pages
+        else:
+            # pages written before the crash are unknown, so nothing is taken as stale
+            manifest = {**self.previous, **self.pages}
+            removed = []
+        _write_json(self.manifest_path, manifest)
+        _write_json(self.changes_path, {"added": added, "changed": changed, "removed": removed,
+                                        "unchanged": unchanged, "complete": self.complete})
+        if os.path.exists(self.part_path):
+            os.remove(self.part_path)
+        logging.info(f"Pages of {self.base_filename}; {len(added)} added; {len(changed)} changed;"
+                     f" {len(removed)} removed; {unchanged} unchanged")
+
+    # the manifest and the stale pages stay as they are, a resumed run carries on from the partial manifest
+    def abort(self):
+        self.flush()
+
+
+# one compact JSON document per line in a single file per text, optionally gzip compressed
+# the file is written under a temporary name and renamed on close, so a failed run leaves no partial text
+class NdjsonSink(PageSink):
+    extension = ".ndjson"
+
+    def __init__(self, output_path, base_filename, flush_pages=256, compress=False):
+        super().__init__(output_path, base_filename, flush_pages)
+        os.makedirs(output_path, exist_ok=True)
+        file_name = clean_text_name(base_filename) + self.extension + (".gz" if compress else "")
+        self.file_path = os.path.join(output_path, file_name)
+        self.part_path = self.file_path + ".part"
+        if compress:
+            self.file = gzip.open(self.part_path, 'wt', encoding='utf-8', compresslevel=6)
+        else:
+            self.file = open(self.part_path, 'w', encoding='utf-8')
+
+    @staticmethod
+    def dumps(data):
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+    def _lines(self, page_data, volume_num):
+        return [self.dumps(page_data)]
+
+    def _write_batch(self, batch):
+        lines = []
+        for page_data, volume_num in batch:
+            lines.extend(self._lines(page_data, volume_num))
+        lines.append("")
+        data = "\n".join(lines)
+        self.file.write(data)
+        return len(data.encode('utf-8'))  # before compression
+
+    def close(self):
+        self.flush()
+        self.file.close()
+        os.replace(self.part_path, self.file_path)
+
+    # the pages written so far are dropped with the temporary file, an earlier finished file stays in place
+    def abort(self):
+        self.buffer = []
+        try:
+            self.file.close()
+        finally:
+            if os.path.exists(self.part_path):
+                os.remove(self.part_path)
+
+
+# NDJSON ready to be posted to the Elasticsearch _bulk API: an index action line before every page
+class EsBulkSink(NdjsonSink):
+    extension = ".bulk.ndjson"
+
+    def __init__(self, output_path, base_filename, flush_pages=256, compress=False, index="pages",
+                 id_template="{text_id}-{volume_num}-{page_num}"):
+        super().__init__(output_path, base_filename, flush_pages, compress)
+        self.index = index
+        self.id_template = id_template
+
+    def document_id(self, page_data):
+        return document_id(self.id_template, page_data)
+
+    def _lines(self, page_data, volume_num):
+        action = {"index": {"_index": self.index, "_id": self.document_id(page_data)}}
+        return [self.dumps(action), self.dumps(page_data)]
+
+
+# sends pages straight to Elasticsearch through an EsBulkIndexer shared by every text of the worker
+class EsIndexSink(PageSink):
+    def __init__(self, indexer, base_filename, flush_pages=256, index="pages",
+                 id_template="{text_id}-{volume_num}-{page_num}"):
+        super().__init__(None, base_filename, flush_pages)
+        self.indexer = indexer
+        self.index = index
+        self.id_template = id_template
+
+    def _write_batch(self, batch):
+        for page_data, volume_num in batch:
+            self.indexer.add(self.index, document_id(self.id_template, page_data), page_data)
+
+    def sync(self):
+        self.flush()
+        self.indexer.flush()
+
+    # the text only counts as written once Elasticsearch has answered for all of its pages
+    def close(self):
+        self.sync()
+
+
+# sinks whose pages written before a crash stay valid, so a partial text can be resumed after them
+# the ndjson and es_bulk files are only renamed into place on close and start over
+resumable_sinks = {"pages", "es"}
+
+
+# sink selected by Config.output_sink, resume is set when an interrupted run of the text is carried on
+def make_sink(config, base_filename, output_path=None, indexer=None, resume=False):
+    output_path = output_path or config.text_content_path
+    if config.output_sink == "es":
+        if indexer is None:
+            raise ValueError("the es output sink needs Config.es_url to be set")
+        return EsIndexSink(indexer, base_filename, config.sink_flush_pages, config.es_page_index, config.es_doc_id)
+    if config.output_sink == "pages" and config.page_manifests:
+        return ContentAddressedPageSink(output_path, base_filename, config.sink_flush_pages, resume)
+    if config.output_sink == "pages":
+        return PerPageJsonSink(output_path, base_filename, config.sink_flush_pages)
+    if config.output_sink == "ndjson":
+        return NdjsonSink(output_path, base_filename, config.sink_flush_pages, config.compress_output)
+    if config.output_sink == "es_bulk":
+        return EsBulkSink(output_path, base_filename, config.sink_flush_pages, config.compress_output,
+                          config.es_page_index, config.es_doc_id)
+    raise ValueError(f"unknown output sink: {config.output_sink}")
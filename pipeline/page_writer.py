@@ -0,0 +1,46 @@
+import queue
+import threading
+
+_DONE = object()
+
+
+# background I/O stage: pages are handed over in order through a bounded queue and written by one thread,
+# so writing overlaps with analysis while the page order on disk stays the order pages were queued
+class PageWriter:
+    def __init__(self, write_func, queue_size=64):
+        self.write_func = write_func
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name="page-writer", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is _DONE:
+                return
+            if self.error is None:
+                func, args = item
+                try:
+                    func(*args)
+                except Exception as e:
+                    self.error = e  # keep draining so put() never blocks on a dead writer
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    # blocks while the queue is full, which holds back analysis when the disk falls behind
+    def put(self, *args):
+        self._raise_error()
+        self.queue.put((self.write_func, args))
+
+    # run func in the writer thread once every page queued before it has been written
+    def call(self, func, *args):
+        self._raise_error()
+        self.queue.put((func, args))
+
+    def close(self):
+        self.queue.put(_DONE)
+        self.thread.join()
+        self._raise_error()
@@ -0,0 +1,139 @@
+import re
+import sys
+import threading
+import unicodedata
+import regex
+from camel_tools.utils.normalize import normalize_unicode, normalize_alef_maksura_ar, normalize_alef_ar, \
+    normalize_teh_marbuta_ar
+from camel_tools.utils.charmap import CharMapper
+from camel_tools.utils.charsets import UNICODE_PUNCT_SYMBOL_CHARSET
+
+
+# translation table that works out the entry for a character the first time str.translate asks for it
+class _CharTable(dict):
+    def __init__(self, char_func):
+        super().__init__()
+        self.char_func = char_func
+
+    def __missing__(self, code):
+        image = self.char_func(chr(code))
+        self[code] = image if image else None  # None deletes the character
+        return self[code]
+
+
+# fused replacement for the nine-step TextAnalyzer preprocessing chain
+# the per-character steps (arclean, punctuation, latin and digit removal, the unicode fixups and the
+# alef/alef maksura/ta marbuta normalizations) go into two translation tables, so a page takes one html
+# pattern pass, one translate, NFKC and a final translate, all running in C
+class Preprocessor:
+    def __init__(self):
+        self.arclean = CharMapper.builtin_mapper('arclean')
+        self._html_tags_pattern = re.compile(r'<[^>]+>')
+        self._latin_pattern = regex.compile(r'[\p{Latin}]')
+        self.clean_table = _CharTable(self._clean_char)
+        self.normalize_table = _CharTable(
+            lambda c: normalize_teh_marbuta_ar(normalize_alef_maksura_ar(normalize_alef_ar(c))))
+        self.html_pattern = self._build_html_pattern()
+
+    def _stripped(self, c):
+        return c in UNICODE_PUNCT_SYMBOL_CHARSET or c.isdigit() or self._latin_pattern.match(c) is not None
+
+    # normalize_unicode fixes a few characters before NFKC, NFKC itself is left to the final pass
+    def _unicode_fix(self, c):
+        fixed = normalize_unicode(c)
+        return fixed if fixed != unicodedata.normalize('NFKC', c) else c
+
+    def _clean_char(self, c):
+        return "".join(self._unicode_fix(x) for x in self.arclean(c) if not self._stripped(x))
+
+    # tags are matched on the raw text, so the brackets arclean produces and the characters it deletes are
+    # taken into account: a tag needs at least one character that survives arclean between its brackets
+    def _build_html_pattern(self):
+        newline = ord("\n")
+        chars = [chr(i) for i in range(sys.maxunicode + 1) if i != newline]
+        images = self.arclean("\n".join(chars)).split("\n")
+        if len(images) != len(chars):
+            images = [self.arclean(c) for c in chars]
+        chars.append("\n")
+        images.append(self.arclean("\n"))
+
+        opening = [c for c, image in zip(chars, images) if image == "<"]
+        closing = [c for c, image in zip(chars, images) if image == ">"]
+        kept = [c for c, image in zip(chars, images) if image and image != ">"]
+        for c, image in zip(chars, images):
+            if len(image) > 1 and ("<" in image or ">" in image):
+                raise ValueError(f"arclean maps {c!r} to a string containing a tag bracket")
+
+        def char_class(class_chars, negate=False):
+            return "[" + ("^" if negate else "") + "".join(re.escape(c) for c in class_chars) + "]"
+
+        return re.compile(char_class(opening) + char_class(closing + kept, negate=True) + "*"
+                          + char_class(kept) + char_class(closing, negate=True) + "*" + char_class(closing))
+
+    def __call__(self, text):
+        text = self.html_pattern.sub('', text)  # remove HTML tags
+        text = text.translate(self.clean_table)  # arclean, punctuation, latin, digits and unicode fixes
+        text = unicodedata.normalize('NFKC', text)  # normalize Unicode characters
+        return text.translate(self.normalize_table)  # normalize alif, alif maksura and ta marbuta
+
+    # the words of the preprocessed text as (word, start, end), start and end being the span of text it comes from
+    # characters outside of tags are cleaned one at a time so each keeps its position, whitespace splits them
+    # into words and each word is normalized on its own: NFKC never combines across whitespace, so the words
+    # joined by spaces are __call__(text) up to the whitespace between them
+    def words(self, text):
+        kept = []
+        position = 0
+        for match in self.html_pattern.finditer(text):
+            kept.append(range(position, match.start()))
+            position = match.end()
+        kept.append(range(position, len(text)))
+
+        words = []
+        chars = []
+        start = end = 0
+        clean_table = self.clean_table
+        for positions in kept:
+            for i in positions:
+                image = clean_table[ord(text[i])]
+                if image is None:
+                    continue
+                for c in image:
+                    if c.isspace():
+                        if chars:
+                            words.append(("".join(chars), start, end))
+                            chars = []
+                        continue
+                    if not chars:
+                        start = i
+                    chars.append(c)
+                    end = i + 1
+        if chars:
+            words.append(("".join(chars), start, end))
+        return [(unicodedata.normalize('NFKC', word).translate(self.normalize_table), start, end)
+                for word, start, end in words]
+
+    # the original step-by-step chain, kept to check the fused tables against
+    def reference(self, text):
+        text = self.arclean(text)  # clean Arabic characters
+        text = self._html_tags_pattern.sub('', text)  # remove HTML tags
+        text = ''.join(c for c in text if c not in UNICODE_PUNCT_SYMBOL_CHARSET)  # remove punctuation
+        text = regex.sub(r'[\p{Latin}]', '', text)  # remove Latin characters
+        text = ''.join(c for c in text if not c.isdigit())  # remove digits
+        text = normalize_unicode(text)  # normalize Unicode characters
+        text = normalize_alef_ar(text)  # normalize Arabic alif characters
+        text = normalize_alef_maksura_ar(text)  # normalize alif maksura characters
+        text = normalize_teh_marbuta_ar(text)  # normalize ta marbuta characters
+        return text
+
+
+_preprocessor = None
+_preprocessor_lock = threading.Lock()
+
+
+# one Preprocessor per process, shared by every page and analysis thread
+def get_preprocessor():
+    global _preprocessor
+    with _preprocessor_lock:
+        if _preprocessor is None:
+            _preprocessor = Preprocessor()
+    return _preprocessor
@@ -0,0 +1,45 @@
+import time
+import logging
+
+
+def format_bytes(size):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if size < 1024 or unit == "GB":
+            return f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def format_seconds(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+# live progress of a run, measured in raw bytes since processing time follows file size far better than
+# file count, the ETA assumes the remaining bytes go at the rate seen so far
+class ProgressReporter:
+    def __init__(self, total_files, total_bytes):
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.done_files = 0
+        self.done_bytes = 0
+        self.failed_files = 0
+        self.start_time = time.time()
+
+    def update(self, file_name, size, error=None):
+        self.done_files += 1
+        self.done_bytes += size
+        if error is not None:
+            self.failed_files += 1
+        elapsed = time.time() - self.start_time
+        fraction = self.done_bytes / self.total_bytes if self.total_bytes else 1.0
+        eta = elapsed * (1 - fraction) / fraction if fraction else 0
+        message = (f"[{self.done_files}/{self.total_files}] {fraction:.1%} of {format_bytes(self.total_bytes)};"
+                   f" elapsed {format_seconds(elapsed)}; ETA {format_seconds(eta)}; {file_name}"
+                   + (f" FAILED: {error}" if error is not None else ""))
+        print(message)
+        logging.info(message)
+
+    def summary(self):
+        elapsed = time.time() - self.start_time
+        return (f"Processed {self.done_files - self.failed_files} files, {self.failed_files} failed,"
+                f" {format_bytes(self.done_bytes)} in {format_seconds(elapsed)}")
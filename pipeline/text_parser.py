@@ -1,25 +1,57 @@
 import os
 import logging
 import re
-import json
 import time
-import pandas as pd
+import itertools
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor
 
+from config import Config
 from pipeline.metadata_manager import MetaDataManager
+from pipeline.metadata_index import load_metadata_index
 from pipeline.file_manager import FileManager
 from pipeline.utility import Utility
-from pipeline.markdown_cleaner import clean_text
-from pipeline.camel_analyzer import TextAnalyzer
+from pipeline.markdown_cleaner import clean_text, iter_clean_pages, PageBudget
+from pipeline.page_writer import PageWriter
+from pipeline.input_source import open_text, file_size, text_name
+from pipeline.output_sink import make_sink, resumable_sinks
+from pipeline.checkpoint import ResumeState
+from pipeline.metrics import get_metrics, SamplingProfiler
+from pipeline.token_codec import make_token_encoder
+from pipeline.corpus_stats import TextStats, save_sidecar, load_partial, remove_partial
 
 logging.basicConfig(filename='file_processing.log', level=logging.INFO, format='%(asctime)s - %(message)s')
 
 
 class TextParser:
-    def __init__(self, disambiguator):
-        self.master_metadata = pd.read_excel("master_meta.xlsx")  # load master metadata xlsx from OpenITI
-        self.meta_data_manager = MetaDataManager(self.master_metadata)
+    def __init__(self, disambiguator, cache=None, scheduler=None, indexer=None, metadata_index=None,
+                 checkpoint=None, range_analyzer=None, analysis_client=None):
+        self.config = Config()
+        if metadata_index is None:
+            # compiled once from the OpenITI master metadata xlsx, usually loaded in the parent process
+            metadata_index = load_metadata_index(self.config.metadata_path, self.config.metadata_index_path)
+        self.meta_data_manager = MetaDataManager(metadata_index)
         self.disambiguator = disambiguator
+        self.cache = cache
+        self.scheduler = scheduler  # BatchScheduler used in place of per-page analysis (BERT)
+        self.indexer = indexer  # EsBulkIndexer when Config.es_url is set
+        self.checkpoint = checkpoint  # CheckpointStore recording finished and partial files
+        # callable taking a list of page texts and returning an async result of their analyses and the metrics
+        # recorded while analyzing them, set when the pages of a file are analyzed by pool workers while this
+        # process cleans, numbers and writes them
+        self.range_analyzer = range_analyzer
+        self.analysis_client = analysis_client  # AnalysisClient of a running analysis service, analyzes all pages
+        self.metrics = get_metrics()
+        self.token_encoder = make_token_encoder(self.config)  # None keeps the analyzer's token dicts
+        self.page_budget = PageBudget(self.config.page_budget, self.config.page_budget_unit,
+                                      self.config.page_split_paragraphs)
+        self.stats = None  # TextStats of the current text when Config.corpus_stats_path is set
+        self.file_metrics = None  # metrics record of the last file processed, returned to the pool parent
+        self.indexer_stats = None  # indexer totals when the current file started, the indexer is shared by texts
+        self.raw_file = None
+        self.sink = None
+        self.resume_from = 0  # page lines already written by an interrupted run of the current file
+        self.pages_seen = 0
         self.file_manager = FileManager(self.meta_data_manager)
         self.utility = Utility()
         self.page_count = 1
@@ -27,15 +59,6 @@ class TextParser:
         self.last_page_num = 0
         self.total_tokens = 0
 
-    def save_page_json(self, page_data, base_filename, volume_num):
-        output_folder = os.path.join(self.file_manager.text_content_path, base_filename)
-        os.makedirs(output_folder, exist_ok=True)
-        clean_name = re.sub(r'-ara\d*', '', base_filename)
-        output_filename = f"{clean_name.split('.')[-1]}-{volume_num}-{page_data['page_num']}.json"
-        output_file_path = os.path.join(output_folder, output_filename)
-        with open(output_file_path, 'w', encoding='utf-8') as outfile:
-            json.dump(page_data, outfile, ensure_ascii=False, indent=4)
-
     def parse_page(self, page):
         chapters = []
         if not re.search(r"^$", page) and not re.search(r"a11b\d{2}a11b\d{3,}", page):
@@ -63,56 +86,276 @@ class TextParser:
             chapters = re.findall(r"<h1>(.*?)</h1>", text, re.DOTALL)
         return text, vol_num, page_num, chapters
 
+    # pages as (text, vol_num, page_num, chapters, sub_page), sub_page is None unless the page is above the page
+    # budget with Config.split_oversized_pages, then its sub pages are numbered from 1 under the same page number
+    def sub_pages(self, parsed_pages):
+        for text, vol_num, page_num, chapters in parsed_pages:
+            pieces = self.page_budget.split_page(text) if self.config.split_oversized_pages else [text]
+            if len(pieces) == 1:
+                yield text, vol_num, page_num, chapters, None
+                continue
+            for sub_page, piece in enumerate(pieces, start=1):
+                sub_chapters = re.findall(r"<h1>(.*?)</h1>", piece, re.DOTALL) if "h1" in piece else []
+                yield piece, vol_num, page_num, sub_chapters, sub_page
+
     def parse_text(self, text, base_filename, disambiguator):
-        cleaned_text = clean_text(text)
-        lines = cleaned_text.splitlines()
-        if lines and lines[0] == "a11b00a11b000":
-            lines = lines[1:]
-
-        with ThreadPoolExecutor() as executor:
-            futures = [executor.submit(self.parse_and_save_line, line, base_filename, disambiguator) for line in lines]
-            for future in futures:
-                future.result()
-
-    def parse_and_save_line(self, line, base_filename, disambiguator):
-        parsed_data = self.parse_page(line)
-        if parsed_data:
-            text, vol_num, page_num, chapters = parsed_data
-            analyzer = TextAnalyzer(text, disambiguator)
-            tokens = analyzer.get_analysis_result()
-
-            if isinstance(tokens, dict) and "error" in tokens:
-                logging.error(
-                    f"Error processing page {page_num} of volume {vol_num} in file {base_filename}: {tokens['error']}")
-                return
-
-            page_data = {
-                "text_uri": self.meta_data_manager.text_meta["text_uri"],
-                "text_id": self.meta_data_manager.text_meta["text_id"],
-                "volume_num": int(vol_num.lstrip('0')),
-                "page_num": int(page_num.lstrip('0')),
-                "page_text": text,
-                "chapter_headings": chapters,
-                "order": int(self.page_count),
-                "tokens": tokens
-            }
-            self.total_tokens += len(tokens)
-            self.save_page_json(page_data, base_filename, vol_num)
-            self.page_count += 1
+        cleaned_text = clean_text(text, self.config.clean_text_engine, self.page_budget)
+        self.parse_lines(cleaned_text.splitlines(), base_filename, disambiguator)
+
+    # pages go through three stages: numbering runs sequentially in this thread, analysis runs in worker
+    # threads (or the batch scheduler) and JSON writing runs in a PageWriter thread, with bounded hand-offs
+    # between them. Results are consumed in page order, so order and page numbers do not depend on timing
+    def parse_lines(self, lines, base_filename, disambiguator):
+        lines = iter(lines)
+        first_line = next(lines, None)
+        if first_line is not None and first_line != "a11b00a11b000":
+            lines = itertools.chain([first_line], lines)
+        parsed_pages = (self.parse_page(line) for line in lines)
+        if self.resume_from:
+            # pages already written are still parsed so volume and page number inference carries on as before
+            parsed_pages = itertools.islice(parsed_pages, self.resume_from, None)
+        parsed_pages = self.sub_pages(parsed_pages)
+
+        sink = self.sink = make_sink(self.config, base_filename, self.file_manager.text_content_path, self.indexer,
+                                     resume=bool(self.resume_from))
+        writer = PageWriter(sink.write, self.config.write_queue_size)
+        completed = False
+        try:
+            if self.range_analyzer is not None:
+                self.parse_text_ranges(parsed_pages, base_filename, writer)
+            elif self.scheduler is not None or self.analysis_client is not None:
+                self.parse_text_batched(parsed_pages, base_filename, disambiguator, writer)
+            else:
+                self.parse_text_threaded(parsed_pages, base_filename, disambiguator, writer)
+            completed = True
+        finally:
+            try:
+                writer.close()  # raises the error of the writer thread, the sink is still closed or aborted
+            except BaseException:
+                completed = False
+                raise
+            finally:
+                if completed:
+                    sink.close()
+                else:
+                    sink.abort()
+
+    # MLE analysis is mostly pure Python and holds the GIL, BERT spends its time in torch which releases it
+    def analysis_workers(self):
+        if self.config.analysis_workers:
+            return self.config.analysis_workers
+        return 4 if self.config.disambiguator == "BERT" else 2
+
+    def parse_text_threaded(self, parsed_pages, base_filename, disambiguator, writer):
+        with ThreadPoolExecutor(max_workers=self.analysis_workers()) as executor:
+            futures = deque()
+            for parsed in parsed_pages:
+                futures.append((parsed, executor.submit(self.analyze_page, parsed, disambiguator)))
+                if len(futures) >= self.config.max_pages_in_flight:
+                    parsed, future = futures.popleft()
+                    self.save_analyzed_page(parsed, future.result(), base_filename, writer)
+            while futures:
+                parsed, future = futures.popleft()
+                self.save_analyzed_page(parsed, future.result(), base_filename, writer)
+
+    # pages are parsed in order and their tokens disambiguated together in length-bucketed batches, or sent a
+    # batch at a time to the analysis service
+    def parse_text_batched(self, parsed_pages, base_filename, disambiguator, writer):
+        pages_per_batch = self.config.bert_pages_per_batch
+        while True:
+            batch = list(itertools.islice(parsed_pages, pages_per_batch))
+            if not batch:
+                break
+            results = self.analyze_texts([parsed[0] for parsed in batch], disambiguator)
+            for parsed, tokens in zip(batch, results):
+                self.save_analyzed_page(parsed, tokens, base_filename, writer)
+
+    # the page range split mode: page ranges go out to the pool as soon as they are numbered, results come
+    # back oldest first, so order, page_count and total_tokens are assigned here exactly as in a single process
+    def parse_text_ranges(self, parsed_pages, base_filename, writer):
+        ranges = deque()
+        for batch in iter(lambda: list(itertools.islice(parsed_pages, self.config.split_pages)), []):
+            ranges.append((batch, self.range_analyzer([parsed[0] for parsed in batch])))
+            if len(ranges) >= self.config.split_ranges_in_flight:
+                self.save_range(*ranges.popleft(), base_filename, writer)
+        while ranges:
+            self.save_range(*ranges.popleft(), base_filename, writer)
+
+    def save_range(self, batch, result, base_filename, writer):
+        analyses, range_metrics = result.get()
+        self.metrics.merge(range_metrics)
+        for parsed, tokens in zip(batch, analyses):
+            self.save_analyzed_page(parsed, tokens, base_filename, writer)
+
+    # analyses of a list of page texts, used for batches, for the page ranges a pool worker receives and for
+    # the batches sent to the analysis service
+    def analyze_texts(self, texts, disambiguator):
+        if self.analysis_client is not None:
+            return self.analysis_client.analyze(texts, self.config.token_offsets)
+        # camel_tools takes about a second to import, a parser using the analysis service never needs it
+        from pipeline.camel_analyzer import analyze_texts
+        return analyze_texts(texts, disambiguator, self.cache, self.scheduler, self.config.token_offsets)
+
+    # runs in the analysis threads, touches no parser state
+    def analyze_page(self, parsed_data, disambiguator):
+        from pipeline.camel_analyzer import TextAnalyzer
+        return TextAnalyzer(parsed_data[0], disambiguator, self.cache,
+                            offsets=self.config.token_offsets).get_analysis_result()
+
+    # runs in the parsing thread in page order, so order and the running totals are assigned deterministically
+    # pages_seen counts page lines, so progress is only recorded before the first sub page of a line
+    def save_analyzed_page(self, parsed_data, tokens, base_filename, writer):
+        text, vol_num, page_num, chapters, sub_page = parsed_data
+        if sub_page is None or sub_page == 1:
+            if self.checkpoint is not None and self.pages_seen \
+                    and self.pages_seen % self.config.checkpoint_every == 0:
+                # everything queued so far, recorded once the writer has written it
+                writer.call(self.record_progress, ResumeState(self.pages_seen, self.page_count, self.total_tokens),
+                            self.stats.snapshot(self.pages_seen) if self.stats is not None else None)
+            self.pages_seen += 1
+        if isinstance(tokens, dict) and "error" in tokens:
+            logging.error(
+                f"Error processing page {page_num} of volume {vol_num} in file {base_filename}: {tokens['error']}")
+            self.metrics.count("page_errors")
+            return
 
+        page_data = {
+            "text_uri": self.meta_data_manager.text_meta["text_uri"],
+            "text_id": self.meta_data_manager.text_meta["text_id"],
+            "volume_num": int(vol_num.lstrip('0')),
+            "page_num": int(page_num.lstrip('0')),
+            "page_text": text,
+            "chapter_headings": chapters,
+            "order": int(self.page_count),
+        }
+        if sub_page is not None:
+            page_data["sub_page"] = sub_page
+        if self.token_encoder is not None:
+            page_data["token_encoding"] = self.config.token_encoding
+            page_data["tokens"] = self.token_encoder(tokens)
+        else:
+            page_data["tokens"] = tokens
+        self.total_tokens += len(tokens)
+        if self.stats is not None:
+            self.stats.add(tokens)
+        self.metrics.count("pages")
+        self.metrics.count("tokens", len(tokens))
+        writer.put(page_data, vol_num)
+        self.page_count += 1
+
+    # runs in the writer thread after the pages before it are written
+    def record_progress(self, state, stats=None):
+        self.sink.sync()
+        if stats is not None:
+            save_sidecar(self.config.corpus_stats_path, self.stats_data(stats), partial=True)
+        self.checkpoint.progress(self.raw_file, state)
+
+    def stats_data(self, stats):
+        return stats.to_dict(self.meta_data_manager.text_meta, self.meta_data_manager.author_meta)
+
+    # text and author metadata go to their own indices, keyed so a rerun overwrites the previous documents
+    def index_metadata(self):
+        text_meta = self.meta_data_manager.text_meta
+        author_meta = self.meta_data_manager.author_meta
+        self.indexer.add(self.config.es_author_index, author_meta["author_id"], author_meta)
+        self.indexer.add(self.config.es_text_index, text_meta["text_id"], text_meta)
+        self.indexer.flush()
+
+    # the sampling profiler runs for the files named in Config.profile_files
+    def start_profiler(self, raw_file):
+        base_filename = os.path.basename(raw_file)
+        if not any(name in base_filename for name in self.config.profile_files):
+            return None
+        profiler = SamplingProfiler(self.config.profile_interval)
+        profiler.start()
+        return profiler
+
+    # returns the metrics record of the file, also kept in file_metrics when processing fails
     def get_data(self, raw_file, disambiguator):
-        self.page_count = 1
-        self.total_tokens = 0
+        self.file_metrics = None
+        self.metrics.collect()  # drop anything recorded outside of a file
+        resume = ResumeState()
+        if self.checkpoint is not None:
+            resume = self.checkpoint.begin(raw_file, self.config.disambiguator, self.config.pipeline_version,
+                                           self.config.output_sink, self.config.output_sink in resumable_sinks)
+        self.raw_file = raw_file
+        self.resume_from = self.pages_seen = resume.pages_seen
+        self.page_count = resume.page_count
+        self.last_vol_num = None
+        self.last_page_num = 0
+        self.total_tokens = resume.total_tokens
         self.meta_data_manager.reset_metadata()
+        if self.indexer is not None:
+            self.indexer_stats = self.indexer.stats()
+        start_time = time.time()
+        profiler = self.start_profiler(raw_file)
+        error = None
+        try:
+            base_filename = self.write_text(raw_file, disambiguator)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            if self.checkpoint is not None:
+                self.checkpoint.fail(raw_file, e)
+            raise
+        finally:
+            self.file_metrics = self.metrics.file_record(os.path.basename(raw_file), time.time() - start_time, error)
+            if profiler is not None:
+                profile_name = f"profile-{os.path.basename(raw_file)}.folded"
+                profiler.stop(os.path.join(self.config.metrics_path or "metrics", profile_name))
+        if self.checkpoint is not None:
+            self.checkpoint.finish(raw_file, self.page_count, self.total_tokens, time.time() - start_time)
+
+        end_time = time.time()
+        logging.info(f"Processed file {base_filename};"
+                     f" {self.meta_data_manager.text_meta['page_count']} pgs;"
+                     f" {self.total_tokens} toks;"
+                     f" {end_time - start_time:.2f} secs;"
+                     f" {self.total_tokens / (end_time - start_time):.2f} tok/sec")
+
+        if self.indexer is not None:
+            totals = self.indexer.stats()
+            stats = {key: totals[key] - self.indexer_stats[key] for key in totals}
+            logging.info(f"Elasticsearch {base_filename};"
+                         f" {stats['indexed']} indexed;"
+                         f" {stats['failed']} failed;"
+                         f" {stats['retried']} retries;"
+                         f" {stats['requests']} bulk requests")
+
+        if self.cache is not None:
+            self.cache.flush()
+            self.cache.log_stats(base_filename)
+        if self.scheduler is not None:
+            logging.info(f"Batch scheduler {base_filename};"
+                         f" {self.scheduler.windows_run} windows;"
+                         f" {self.scheduler.padding_ratio():.2f} padded/real tokens")
+
+        print(f"Processed {self.total_tokens} tokens from"
+              f" {base_filename} in {end_time - start_time:.2f} seconds. "
+              f"at {self.total_tokens / (end_time - start_time):.2f} tokens/sec.")
+        return self.file_metrics
+
+    # clean, analyze and write the pages of one raw file, then its text and author metadata
+    def write_text(self, raw_file, disambiguator):
         text_id = self.file_manager.parse_file_name(raw_file)
+        if self.config.corpus_stats_path:
+            # a resumed text carries on from the counts saved with its last progress record
+            self.stats = load_partial(self.config.corpus_stats_path, text_id, self.resume_from) \
+                if self.resume_from else TextStats()
 
-        with open(raw_file, 'r', encoding='utf-8') as file:
-            file_contents = file.read()
-            base_filename = os.path.basename(raw_file)
-            start_time = time.time()
+        with open_text(raw_file) as file:
+            base_filename = text_name(os.path.basename(raw_file))
             self.meta_data_manager.set_metadata(text_id)
-            self.parse_text(file_contents, base_filename, disambiguator)
+            if self.config.stream_large_files and file_size(raw_file) >= self.config.stream_threshold:
+                # clean and parse page batches as they are read instead of holding the whole file
+                pages = iter_clean_pages(file, self.config.stream_chunk_size, self.config.clean_text_engine,
+                                         self.page_budget)
+                self.parse_lines(pages, base_filename, disambiguator)
+            else:
+                self.parse_text(file.read(), base_filename, disambiguator)
             self.meta_data_manager.text_meta["page_count"] = self.page_count
+            if self.stats is not None:
+                save_sidecar(self.config.corpus_stats_path, self.stats_data(self.stats.snapshot(self.pages_seen)))
+                remove_partial(self.config.corpus_stats_path, text_id)
             jsons = [self.meta_data_manager.author_meta, self.meta_data_manager.text_meta]
             for data in jsons:
                 self.utility.fill_empty_nodata(data)
@@ -121,14 +364,6 @@ class TextParser:
                                          self.file_manager.author_meta_path)
         self.file_manager.save_meta_json(self.meta_data_manager.text_meta, base_filename,
                                          self.file_manager.text_meta_path)
-
-        end_time = time.time()
-        logging.info(f"Processed file {base_filename};"
-                     f" {self.meta_data_manager.text_meta['page_count']} pgs;"
-                     f" {self.total_tokens} toks;"
-                     f" {end_time - start_time:.2f} secs;"
-                     f" {self.total_tokens / (end_time - start_time):.2f} tok/sec")
-
-        print(f"Processed {self.total_tokens} tokens from"
-              f" {base_filename} in {end_time - start_time:.2f} seconds. "
-              f"at {self.total_tokens / (end_time - start_time):.2f} tokens/sec.")
+        if self.indexer is not None:
+            self.index_metadata()
+        return base_filename
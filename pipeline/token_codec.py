@@ -0,0 +1,170 @@
+import os
+import sys
+import gzip
+import json
+import sqlite3
+import argparse
+import threading
+
+# compact forms of the token list of a page, selected by Config.token_encoding
+#
+# "dicts" is the original form, one {"index", "tok", "lem", "rt", "pos"} object per token
+# "columnar" stores the fields as parallel arrays: {"tok": [...], "lem": [...], "rt": [...], "pos": [...]}
+# "interned" is columnar with lem, rt and pos given as integer ids into a Vocabulary shared by the corpus
+#
+# index is left out while it runs 1..n, as the analyzers produce it. Tokens that failed analysis keep null
+# fields and their message in "errors", a list of [position, message] pairs. The "start" and "end" offsets of
+# Config.token_offsets become two more arrays, present only when the tokens have them
+
+FIELDS = ("lem", "rt", "pos")
+OFFSETS = ("start", "end")
+
+
+def encode_columnar(tokens):
+    columns = {"tok": [token.get("tok") for token in tokens]}
+    for field in FIELDS:
+        columns[field] = [token.get(field) for token in tokens]
+    if any("start" in token for token in tokens):
+        for field in OFFSETS:
+            columns[field] = [token.get(field) for token in tokens]
+    errors = [[n, token["error"]] for n, token in enumerate(tokens) if "error" in token]
+    if errors:
+        columns["errors"] = errors
+    indices = [token["index"] for token in tokens]
+    if indices != list(range(1, len(tokens) + 1)):
+        columns["index"] = indices
+    return columns
+
+
+def decode_columnar(columns, values=None):
+    errors = dict(columns.get("errors", ()))
+    indices = columns.get("index") or range(1, len(columns["tok"]) + 1)
+    fields = [columns[field] for field in FIELDS]
+    if values is not None:
+        fields = [[values.get(value) if value is not None else None for value in column] for column in fields]
+
+    tokens = []
+    for n, (index, tok, lem, rt, pos) in enumerate(zip(indices, columns["tok"], *fields)):
+        if n in errors:
+            tokens.append({"index": index, "tok": tok, "error": errors[n]})
+        else:
+            tokens.append({"index": index, "tok": tok, "lem": lem, "rt": rt, "pos": pos})
+    if "start" in columns:
+        for token, start, end in zip(tokens, columns["start"], columns["end"]):
+            if start is not None:
+                token["start"] = start
+                token["end"] = end
+    return tokens
+
+
+# lemma, root and part-of-speech strings of the corpus and their integer ids, shared by all pool workers
+# ids never change once assigned, so pages written by any worker or run decode against the same table
+class Vocabulary:
+    def __init__(self, path):
+        self.path = path
+        self._ids = {field: {} for field in FIELDS}  # in-process copy, field -> value -> id
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS vocabulary (
+                    id INTEGER PRIMARY KEY,
+                    field TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    UNIQUE (field, value)
+                )""")
+
+    # ids of a list of values, values not seen before are added in one transaction
+    def ids(self, field, values):
+        known = self._ids[field]
+        missing = [value for value in dict.fromkeys(values) if value is not None and value not in known]
+        if missing:
+            self._add(field, missing)
+        return [known[value] if value is not None else None for value in values]
+
+    def _add(self, field, values):
+        with self._lock:
+            with self.connection:
+                self.connection.executemany("INSERT OR IGNORE INTO vocabulary (field, value) VALUES (?, ?)",
+                                            [(field, value) for value in values])
+            # another worker may have added some of them first, read back whichever ids were stored
+            for start in range(0, len(values), 500):
+                chunk = values[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self.connection.execute(
+                    f"SELECT value, id FROM vocabulary WHERE field = ? AND value IN ({placeholders})",
+                    [field, *chunk])
+                self._ids[field].update(rows)
+
+    def encode(self, tokens):
+        columns = encode_columnar(tokens)
+        for field in FIELDS:
+            columns[field] = self.ids(field, columns[field])
+        return columns
+
+    # id -> value for the whole table, used to decode interned pages
+    def values(self):
+        return dict(self.connection.execute("SELECT id, value FROM vocabulary"))
+
+    def close(self):
+        self.connection.close()
+
+
+# callable turning an analysis result into the configured encoding, None for the original dicts
+def make_token_encoder(config):
+    if config.token_encoding == "dicts":
+        return None
+    if config.token_encoding == "columnar":
+        return encode_columnar
+    if config.token_encoding == "interned":
+        return Vocabulary(config.token_vocab_path).encode
+    raise ValueError(f"unknown token encoding: {config.token_encoding}")
+
+
+# expand a page document back into the original dict-per-token form, values is Vocabulary.values() for
+# interned pages
+def decode_page(page_data, values=None):
+    encoding = page_data.get("token_encoding", "dicts")
+    if encoding == "dicts":
+        return page_data
+    if encoding == "interned" and values is None:
+        raise ValueError("interned pages need the vocabulary values to be decoded")
+    page_data = dict(page_data)
+    del page_data["token_encoding"]
+    page_data["tokens"] = decode_columnar(page_data["tokens"], values if encoding == "interned" else None)
+    return page_data
+
+
+def _open_text(path):
+    return gzip.open(path, 'rt', encoding='utf-8') if path.endswith('.gz') else open(path, 'r', encoding='utf-8')
+
+
+# decode an ndjson file (or one JSON page) to the original page documents, one per line on stdout
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description="Expand compact token encodings back into token dicts")
+    arg_parser.add_argument("path", help="ndjson(.gz) file or per-page JSON file")
+    arg_parser.add_argument("--vocab", help="vocabulary database of interned pages (Config.token_vocab_path)")
+    args = arg_parser.parse_args(argv)
+
+    values = None
+    if args.vocab:
+        vocabulary = Vocabulary(args.vocab)
+        values = vocabulary.values()
+        vocabulary.close()
+    with _open_text(args.path) as file:
+        if args.path.endswith('.json'):
+            documents = [json.load(file)]
+        else:
+            documents = (json.loads(line) for line in file if line.strip())
+        for page_data in documents:
+            if "tokens" in page_data:
+                page_data = decode_page(page_data, values)
+            sys.stdout.write(json.dumps(page_data, ensure_ascii=False) + "\n")
+
+
+if __name__ == "__main__":
+    main()
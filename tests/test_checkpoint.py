@@ -0,0 +1,62 @@
+from pipeline.checkpoint import CheckpointStore
+
+LOG = ("2024-05-01 10:00:00,000 - Processed file 0001Abc.Kitab.Shamela0001-ara1; 12 pgs; 3400 toks; 2.10 secs;"
+       " 1619.05 tok/sec\n"
+       "2024-05-01 10:00:05,000 - Processed file 0002Def.Kitab.JK0002-ara1; 3 pgs; 800 toks; 0.52 secs;"
+       " 1538.46 tok/sec\n"
+       "2024-05-01 10:00:06,000 - some other message\n")
+
+
+def raw_files(tmp_path):
+    paths = []
+    for name in ("0001Abc.Kitab.Shamela0001-ara1", "0002Def.Kitab.JK0002-ara1.completed",
+                 "0003Ghi.Kitab.Shamela0003-ara1"):
+        path = tmp_path / name
+        path.write_text("######OpenITI#\nنص\n", encoding="utf-8")
+        paths.append(str(path))
+    return paths
+
+
+def test_empty_store_is_seeded_from_the_log(tmp_path):
+    paths = raw_files(tmp_path)
+    log_path = tmp_path / "file_processing.log"
+    log_path.write_text(LOG, encoding="utf-8")
+    store = CheckpointStore(str(tmp_path / "checkpoint.db"))
+    try:
+        assert store.import_log(str(log_path), paths, "MLE", "1", "pages") == 2
+        assert store.pending(paths, "MLE", "1") == paths[2:]
+        assert store.pending(paths, "BERT", "1") == paths  # another setup still processes them again
+
+        # seeded once: files processed since then are recorded by the store, not the log
+        store.begin(paths[2], "MLE", "1", "pages")
+        store.fail(paths[2], "stopped")
+        log_path.write_text(LOG + LOG.replace("0001Abc.Kitab.Shamela0001", "0003Ghi.Kitab.Shamela0003"),
+                            encoding="utf-8")
+        assert store.import_log(str(log_path), paths, "MLE", "1", "pages") == 0
+        assert store.pending(paths, "MLE", "1") == paths[2:]
+    finally:
+        store.close()
+
+
+def test_changed_file_is_processed_again_after_seeding(tmp_path):
+    paths = raw_files(tmp_path)
+    log_path = tmp_path / "file_processing.log"
+    log_path.write_text(LOG, encoding="utf-8")
+    store = CheckpointStore(str(tmp_path / "checkpoint.db"))
+    try:
+        store.import_log(str(log_path), paths, "MLE", "1", "pages")
+        with open(paths[0], "a", encoding="utf-8") as raw_file:
+            raw_file.write("نص جديد\n")
+        assert store.pending(paths, "MLE", "1") == [paths[0], paths[2]]
+    finally:
+        store.close()
+
+
+def test_missing_log_seeds_nothing(tmp_path):
+    paths = raw_files(tmp_path)
+    store = CheckpointStore(str(tmp_path / "checkpoint.db"))
+    try:
+        assert store.import_log(str(tmp_path / "file_processing.log"), paths, "MLE", "1", "pages") == 0
+        assert store.pending(paths, "MLE", "1") == paths
+    finally:
+        store.close()
@@ -0,0 +1,96 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from pipeline import downloader
+from pipeline.downloader import download_file
+
+
+# stand-in for the file server: serves `data` under `etag`, honours Range when If-Range still matches the ETag
+# (unless honour_range is off) and cuts the next `cut` responses off half way
+class FileServer:
+    def __init__(self, data, etag='"v1"'):
+        self.data = data
+        self.etag = etag
+        self.honour_range = True
+        self.cut = 0
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server.requests.append(dict(self.headers))
+                data = server.data
+                start = 0
+                requested = self.headers.get("Range")
+                if requested and server.honour_range and self.headers.get("If-Range") == server.etag:
+                    start = int(requested[len("bytes="):-1])
+                    self.send_response(206)
+                    self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+                else:
+                    self.send_response(200)
+                self.send_header("ETag", server.etag)
+                self.send_header("Content-Length", str(len(data) - start))
+                self.end_headers()
+                body = data[start:]
+                if server.cut:
+                    server.cut -= 1
+                    body = body[:len(body) // 2]
+                    self.close_connection = True
+                self.wfile.write(body)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}/0001Abc.Kitab.Shamela0001-ara1"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(downloader.time, "sleep", lambda seconds: None)
+    server = FileServer(os.urandom(300000))
+    yield server
+    server.close()
+
+
+def downloaded(tmp_path, server):
+    with open(tmp_path / os.path.basename(server.url), "rb") as file:
+        return file.read()
+
+
+def test_cut_download_is_resumed(tmp_path, server):
+    server.cut = 1
+    result = download_file(server.url, str(tmp_path))
+    assert result["status"] == "resumed"
+    assert downloaded(tmp_path, server) == server.data
+    assert 0 < int(server.requests[1]["Range"][len("bytes="):-1]) <= len(server.data) // 2
+    assert server.requests[1]["If-Range"] == '"v1"'
+    assert sorted(os.listdir(tmp_path)) == [os.path.basename(server.url)]
+
+
+def test_changed_file_is_downloaded_again(tmp_path, server):
+    server.cut = 1
+    assert download_file(server.url, str(tmp_path), retries=0)["status"] == "failed"
+    server.data, server.etag = os.urandom(200000), '"v2"'
+    result = download_file(server.url, str(tmp_path))
+    assert server.requests[1]["If-Range"] == '"v1"'
+    assert result["status"] == "downloaded" and result["etag"] == '"v2"'
+    assert downloaded(tmp_path, server) == server.data
+    assert sorted(os.listdir(tmp_path)) == [os.path.basename(server.url)]
+
+
+def test_server_ignoring_range_is_not_spliced(tmp_path, server):
+    server.cut = 1
+    server.honour_range = False
+    result = download_file(server.url, str(tmp_path))
+    assert "Range" in server.requests[1]
+    assert result["status"] == "downloaded"
+    assert downloaded(tmp_path, server) == server.data
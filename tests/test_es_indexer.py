@@ -0,0 +1,101 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from pipeline.es_indexer import EsBulkIndexer
+
+
+# stand-in for the Elasticsearch _bulk endpoint: answers with the statuses queued in `responses`, then 200
+class BulkServer:
+    def __init__(self):
+        self.responses = []
+        self.bodies = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"])).decode("utf-8")
+                status = server.responses.pop(0) if server.responses else 200
+                if status == 200:
+                    server.bodies.append(body)
+                    documents = body.splitlines()[::2]
+                    items = [{"index": {"_id": json.loads(action)["index"]["_id"], "status": 201}}
+                             for action in documents]
+                    data = json.dumps({"errors": False, "items": items}).encode("utf-8")
+                else:
+                    data = b'{"error": "unavailable"}'
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def server():
+    server = BulkServer()
+    yield server
+    server.close()
+
+
+def make_indexer(url, **options):
+    return EsBulkIndexer(url, max_docs=10, backoff=0.01, max_retries=3, timeout=5, **options)
+
+
+@pytest.mark.parametrize("status", [429, 502, 503, 504])
+def test_retries_until_indexed(server, status):
+    server.responses = [status, status]
+    indexer = make_indexer(server.url)
+    for n in range(5):
+        indexer.add("pages", f"doc-{n}", {"page_num": n})
+    indexer.flush()
+    stats = indexer.stats()
+    indexer.close()
+    assert stats == {"indexed": 5, "failed": 0, "retried": 2, "requests": 3}
+    assert len(server.bodies) == 1
+
+
+def test_retries_connection_errors(server, monkeypatch):
+    indexer = make_indexer(server.url)
+    post = indexer.session.post
+    calls = []
+
+    def flaky_post(*args, **kwargs):
+        calls.append(1)
+        if len(calls) == 1:
+            raise requests.ConnectionError("connection reset")
+        return post(*args, **kwargs)
+
+    monkeypatch.setattr(indexer.session, "post", flaky_post)
+    indexer.add("pages", "doc-1", {"page_num": 1})
+    indexer.flush()
+    assert indexer.stats()["indexed"] == 1
+    indexer.close()
+
+
+# an error that outlasts the retries fails the text being indexed, the next text is indexed again
+def test_error_is_cleared_after_it_was_raised(server):
+    server.responses = [400]
+    indexer = make_indexer(server.url)
+    indexer.add("pages", "failed-1", {"page_num": 1})
+    with pytest.raises(requests.HTTPError):
+        indexer.flush()
+    indexer.add("pages", "next-1", {"page_num": 1})
+    indexer.flush()
+    indexer.close()
+    assert indexer.stats()["indexed"] == 1
+    assert "next-1" in server.bodies[0] and "failed-1" not in server.bodies[0]
@@ -0,0 +1,87 @@
+import io
+import os
+import tarfile
+import zipfile
+
+import pytest
+
+from pipeline import input_source
+from pipeline.input_source import list_raw_files, open_text, file_hash, text_name, is_raw_text
+from pipeline.output_sink import PerPageJsonSink
+
+TEXTS = {
+    "data/0001Abc/0001Abc.Kitab/0001Abc.Kitab.Shamela0001-ara1": "######OpenITI#\nنص الأول\n",
+    "data/0002Def/0002Def.Kitab/0002Def.Kitab.JK0002-ara1.completed": "######OpenITI#\nنص الثاني\n",
+    "data/0003Ghi/0003Ghi.Kitab/0003Ghi.Kitab.Shamela0003-ara2.mARkdown": "######OpenITI#\nنص الثالث\n",
+}
+OTHER = {
+    "data/0001Abc/0001Abc.Kitab/0001Abc.Kitab.Shamela0001-ara1.yml": "00#VERS#LENGTH###: 2\n",
+    "data/0001Abc/0001Abc.yml": "00#AUTH#URI######: 0001Abc\n",
+    "README.md": "release notes\n",
+}
+
+
+def write_archive(path):
+    members = {**TEXTS, **OTHER}
+    if path.endswith(".zip"):
+        with zipfile.ZipFile(path, "w") as archive:
+            archive.writestr("data/0001Abc/", "")
+            for name, text in members.items():
+                archive.writestr(name, text)
+        return
+    with tarfile.open(path, "w:gz" if path.endswith(".gz") else "w") as archive:
+        for name, text in members.items():
+            data = text.encode("utf-8")
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+
+
+def test_text_names():
+    assert text_name("0002Def.Kitab.JK0002-ara1.completed") == "0002Def.Kitab.JK0002-ara1"
+    assert text_name("0001Abc.Kitab.Shamela0001-ara1") == "0001Abc.Kitab.Shamela0001-ara1"
+    assert is_raw_text("0003Ghi.Kitab.Shamela0003-ara2.mARkdown")
+    assert not is_raw_text("0001Abc.Kitab.Shamela0001-ara1.yml")
+    assert not is_raw_text("0001Abc.yml")
+
+
+@pytest.mark.parametrize("archive_name", ["release.zip", "release.tar", "release.tar.gz"])
+def test_archive_lists_and_reads_only_texts(tmp_path, archive_name):
+    archive_path = str(tmp_path / archive_name)
+    write_archive(archive_path)
+    files = list_raw_files(archive_path)
+    assert files == sorted(os.path.join(archive_path, name) for name in TEXTS)
+    for path, name in zip(files, sorted(TEXTS)):
+        with open_text(path) as file:
+            assert file.read() == TEXTS[name]
+    assert list_raw_files(os.path.join(archive_path, "data/0002Def")) == [
+        os.path.join(archive_path, "data/0002Def/0002Def.Kitab/0002Def.Kitab.JK0002-ara1.completed")]
+
+
+# a compressed tar is decompressed once, every member is then read from the same plain tar handle
+def test_compressed_tar_is_read_in_one_pass(tmp_path, monkeypatch):
+    archive_path = str(tmp_path / "release.tar.gz")
+    write_archive(archive_path)
+    opened = []
+    tar_open = tarfile.open
+    monkeypatch.setattr(input_source.tarfile, "open", lambda path, *args: opened.append(path) or tar_open(path, *args))
+    files = list_raw_files(archive_path)
+    hashes = [file_hash(path) for path in files] + [file_hash(path) for path in files]
+    assert len(set(hashes)) == len(TEXTS)
+    assert archive_path not in opened and len(opened) == 2  # indexing, then the reading handle
+    assert opened[0].endswith(".tar") and os.path.exists(opened[0])
+
+
+def test_directory_skips_version_metadata(tmp_path):
+    names = ["0001Abc.Kitab.Shamela0001-ara1", "0001Abc.Kitab.Shamela0001-ara1.yml",
+             "0002Def.Kitab.JK0002-ara1.completed"]
+    for name in names:
+        (tmp_path / name).write_text("######OpenITI#\n", encoding="utf-8")
+    assert [os.path.basename(path) for path in list_raw_files(str(tmp_path))] == [
+        "0001Abc.Kitab.Shamela0001-ara1", "0002Def.Kitab.JK0002-ara1.completed"]
+
+
+def test_page_files_are_named_after_the_text(tmp_path):
+    sink = PerPageJsonSink(str(tmp_path), text_name("0002Def.Kitab.JK0002-ara1.completed"))
+    assert sink.file_prefix == "JK0002"
+    assert sink.page_file_name({"page_num": 3}, "01") == "JK0002-01-3.json"
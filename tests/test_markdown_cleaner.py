@@ -0,0 +1,69 @@
+import io
+import random
+
+import pytest
+
+from pipeline import markdown_cleaner
+from pipeline.benchmark import synthetic_markdown
+from pipeline.markdown_cleaner import clean_text, iter_clean_pages
+
+HEADER = "######OpenITI#\n\n#META# 000.SortField :: synthetic\n\n#META#Header#End#\n\n"
+# lines whose cleaning depends on the lines around them, the ones that put streamed cleaning at odds with
+# cleaning the whole text: page markers after a line break and a space, headings whose whitespace runs on into
+# the next lines, and #~: lines, whose markers cannot be cut after
+TRICKY_LINES = ["### |\n", "### | \n", "\n", "   \n", " PageV01P{page:03d} نص\n", "| باب\n",
+                "### ||| عنوان PageV01P{page:03d}\n", "# نص PageV01P{page:03d}\n", "~~ تكملة\n", "###\n",
+                "# PageV01P{page:03d}\n", "### | باب الصلاة\n", "#~:topic: PageV01P{page:03d} نص\n",
+                "#~:topic: نص PageV01P{page:03d}\n", "#~:topic: نص\n"]
+
+
+def tricky_markdown(rng):
+    lines = synthetic_markdown(rng, paragraphs=40).splitlines(keepends=True)
+    page = 500
+    for _ in range(25):
+        page += 1
+        lines.insert(rng.randrange(len(lines) // 3, len(lines)), rng.choice(TRICKY_LINES).format(page=page))
+    if rng.random() < 0.3:
+        lines.append("#~:topic: PageV01P999 نص\n")  # a marker that cannot be cut after, after the last one
+    return "".join(lines)
+
+
+def streamed(text, chunk_size):
+    return list(iter_clean_pages(io.StringIO(text), chunk_size))
+
+
+@pytest.mark.parametrize("text", [
+    HEADER + "# xxx PageV01P000 yyy\n# aaa PageV01P001 bbb\n PageV01P002 ccc\n# ddd PageV01P003 eee\n",
+    HEADER + "# aaa PageV01P001 bbb\n# ccc PageV01P002\n#~:topic: PageV01P003 ddd\n",
+    HEADER + "# aaa PageV01P001 bbb\n### |\n\nباب PageV01P002\n# ccc PageV01P003\n",
+])
+@pytest.mark.parametrize("chunk_size", [1, 10, 40, 1000])
+def test_streamed_edge_cases_match_clean_text(text, chunk_size):
+    assert streamed(text, chunk_size) == clean_text(text).splitlines()
+
+
+def test_streamed_pages_match_clean_text():
+    rng = random.Random(5)
+    compared = 0
+    for _ in range(40):
+        text = tricky_markdown(rng)
+        try:
+            expected = clean_text(text).splitlines()
+        except Exception:
+            continue  # a text oimdp fails on fails streamed too
+        for chunk_size in (1, 200, 5000):
+            assert streamed(text, chunk_size) == expected
+        compared += 1
+    assert compared >= 30
+
+
+# a text without page markers is scanned for a place to cut once, not again with every chunk read
+def test_text_without_markers_is_scanned_once(monkeypatch):
+    text = "".join(synthetic_markdown(random.Random(1), paragraphs=400, paginated=False) for _ in range(3))
+    scanned = []
+    last_split_point = markdown_cleaner._last_split_point
+    monkeypatch.setattr(markdown_cleaner, "_last_split_point", lambda part: scanned.append(len(part))
+                        or last_split_point(part))
+    pages = streamed(text, 4096)
+    assert pages == clean_text(text).splitlines()
+    assert len(scanned) > 20 and sum(scanned) <= 2 * len(text)  # a rescan of the carry would be quadratic
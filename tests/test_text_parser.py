@@ -0,0 +1,49 @@
+import os
+import pytest
+
+from pipeline.benchmark import StubDisambiguator
+from pipeline.output_sink import NdjsonSink
+from pipeline.text_parser import TextParser
+
+
+def make_parser(tmp_path, output_sink="ndjson"):
+    parser = TextParser(StubDisambiguator(), metadata_index={})
+    parser.config.output_sink = output_sink
+    parser.config.sink_flush_pages = 2
+    parser.config.corpus_stats_path = None
+    parser.file_manager.text_content_path = str(tmp_path)
+    parser.meta_data_manager.text_meta.update(text_uri="0001Abc.Kitab.Shamela0001-ara1", text_id="Shamela0001")
+    return parser
+
+
+def page_lines(count):
+    return [f"<p>قال حدثنا عن رسول الله </p>a11b01a11b{n:03d}" for n in range(1, count + 1)]
+
+
+# a sink failing part way through a text leaves neither the temporary file nor an open handle behind
+def test_failed_sink_is_aborted(tmp_path, monkeypatch):
+    write_batch = NdjsonSink._write_batch
+    calls = []
+    files = []
+
+    def failing_write_batch(self, batch):
+        files.append(self.file)
+        calls.append(len(batch))
+        if len(calls) == 3:
+            raise OSError("disk full")
+        return write_batch(self, batch)
+
+    monkeypatch.setattr(NdjsonSink, "_write_batch", failing_write_batch)
+    parser = make_parser(tmp_path)
+    with pytest.raises(OSError, match="disk full"):
+        parser.parse_lines(page_lines(40), "0001Abc.Kitab.Shamela0001-ara1", parser.disambiguator)
+    assert os.listdir(tmp_path) == []
+    assert files[-1].closed
+
+
+def test_finished_text_is_renamed_into_place(tmp_path):
+    parser = make_parser(tmp_path)
+    parser.parse_lines(page_lines(5), "0001Abc.Kitab.Shamela0001-ara1", parser.disambiguator)
+    assert os.listdir(tmp_path) == ["0001Abc.Kitab.Shamela0001.ndjson"]
+    with open(tmp_path / "0001Abc.Kitab.Shamela0001.ndjson", encoding="utf-8") as file:
+        assert len(file.read().splitlines()) == 5